@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+from dbconnect import *
+from properties import Properties
+import imagetools
+import logging
+import sys
+
+db = DBConnect.getInstance()
+
+USAGE = '''
+ABOUT:
+This script crops the tiles of every object and saves them in the tile
+store (the tile_store_dir in your properties file), so that Classifier
+shows them without reading any images.  Images whose objects are all in the
+store already are skipped, so an interrupted run can simply be rerun.
+
+USAGE:
+python buildtiles.py [options] <propertiesfile>
+'''
+
+def build_tiles(filter_name=None, callback=None):
+    '''
+    Stores the tiles of all objects in the images of the given filter (or
+    of all images).  callback(fraction) is called after each image.
+    Returns the number of images that were read.
+    '''
+    store = imagetools.tile_store()
+    assert store is not None, 'tile_store_dir is not set in the properties file.'
+    if filter_name:
+        imKeys = db.GetFilteredImages(filter_name)
+    else:
+        imKeys = db.GetAllImageKeys()
+    nread = 0
+    for i, imKey in enumerate(imKeys):
+        imKey = tuple(imKey)
+        plate = imagetools.ImagePlate(imKey)
+        obKeys = [tuple(obKey) for obKey in db.GetObjectsFromImage(imKey)]
+        missing = [obKey for obKey in obKeys if not store.contains(plate, obKey)]
+        if missing:
+            try:
+                imagetools.FetchTilesFromImage(imKey, missing)
+                nread += 1
+            except Exception, e:
+                logging.error('Error loading tiles from image %s: %s'%(imKey, e))
+        if callback:
+            callback(float(i + 1) / len(imKeys))
+    return nread
+
+
+if __name__ == "__main__":
+    from optparse import OptionParser
+    logging.basicConfig(level=logging.INFO)
+
+    parser = OptionParser(USAGE)
+    parser.add_option('-f', '--filter', dest='filter', help='only store tiles of images in this filter from the properties file')
+    parser.add_option('-d', '--directory', dest='directory', help='tile store directory, overriding tile_store_dir')
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error('Incorrect number of arguments')
+
+    p = Properties.getInstance()
+    p.LoadFile(args[0])
+    if options.directory:
+        p.tile_store_dir = options.directory
+    if not p.tile_store_dir:
+        parser.error('No tile store directory: set tile_store_dir in the properties file or use --directory')
+    if options.filter and options.filter not in p._filters.keys():
+        parser.error('Filter %s not found in properties file.  Valid filters are: %s'%(options.filter, ','.join(p._filters.keys())))
+
+    def progress(fraction):
+        sys.stdout.write('\r%3d%%'%(fraction * 100))
+        sys.stdout.flush()
+    nread = build_tiles(options.filter, progress)
+    print
+    logging.info('Read %d images into the tile store in %s'%(nread, p.tile_store_dir))
@@ -19,13 +19,17 @@ import icons
 import dbconnect
 import dirichletintegrate
 import fastgentleboostingmulticlass     
+import imageprefetcher
 import imagetools
 import multiclasssql
+import objectscores
+from objectprefetcher import ObjectPrefetcher
 import polyafit
 import sortbin
 import logging
 import numpy as np
 import os
+import random
 import sys
 import wx
 import re
@@ -89,6 +93,10 @@ class Classifier(wx.Frame):
         self.defaultTSFileName = None
         self.defaultModelFileName = None
         self.lastScoringFilter = None
+        self.enrichmentAlpha = None
+        self.objectScores = None
+        self.objectScoresThread = None
+        self.prefetcher = None
 
         self.menuBar = wx.MenuBar()
         self.SetMenuBar(self.menuBar)
@@ -316,6 +324,7 @@ class Classifier(wx.Frame):
 
         # Make sure the classifier is cleared before running a new training session
         self.algorithm.ClearModel()
+        self.InvalidateObjectScores()
 
         # Update the classBins in the model
         self.algorithm.UpdateBins(self.classBins)
@@ -598,6 +607,7 @@ class Classifier(wx.Frame):
         self.algorithm.UpdateBins([]);
         if clearModel:
             self.algorithm.ClearModel()
+            self.InvalidateObjectScores()
         self.rules_text.SetValue('')
         for bin in self.classBins:
             bin.trained = False
@@ -685,6 +695,17 @@ class Classifier(wx.Frame):
         
         statusMsg = 'Fetched %d %s %s'%(nObjects, obClassName, p.object_name[1])
         
+        # Use objects that were fetched in the background if there are enough
+        sourceKey = self.GetFetchSourceKey(fltr_sel)
+        prefetched = self.prefetcher and self.prefetcher.Take(sourceKey, obClass, nObjects)
+        if prefetched:
+            # prefetched holds the tile data until the tiles are created
+            tilecollection.TileCollection.getInstance().AddTiles(prefetched)
+            self.unclassifiedBin.AddObjects([obKey for obKey, tile in prefetched], self.chMap, pos='last')
+            imageprefetcher.PrefetchObjectImages([obKey for obKey, tile in prefetched])
+            self.PostMessage(statusMsg + self.GetFetchSourceMessage(fltr_sel) + ' (prefetched)')
+            return
+        
         # Get object keys
         obKeys = []
         # unclassified:
@@ -694,7 +715,8 @@ class Classifier(wx.Frame):
                 statusMsg += ' from whole experiment'
             elif fltr_sel == 'image':
                 imKey = self.GetGroupKeyFromGroupSizer()
-                obKeys = dm.GetRandomObjects(nObjects, [imKey])
+                filteredImKeys = [imKey]
+                obKeys = dm.GetRandomObjects(nObjects, filteredImKeys)
                 statusMsg += ' from image %s'%(imKey,)
             elif fltr_sel in p._filters_ordered:
                 filteredImKeys = db.GetFilteredImages(fltr_sel)
@@ -745,8 +767,23 @@ class Classifier(wx.Frame):
                         return
                     
             total_attempts = attempts = 0
+            if self.objectScores is not None:
+                # Every object has been scored with the current rules
+                obKeys = self.objectScores.GetRandomObjects(nObjects, obClass,
+                            None if fltr_sel == 'experiment' else filteredImKeys)
+                if fltr_sel == 'experiment':
+                    loopMsg = ' from whole experiment'
+                elif fltr_sel == 'image':
+                    loopMsg = ' from image %s'%(imKey,)
+                elif fltr_sel in p._filters_ordered:
+                    loopMsg = ' from filter %s'%(fltr_sel)
+                else:
+                    loopMsg = ' from group %s: %s'%(fltr_sel,
+                                        ', '.join(['%s=%s'%(n,v) for n, v in zip(colNames,groupKey)]))
+                if len(obKeys) < nObjects:
+                    statusMsg = 'Fetched %d %s %s'%(len(obKeys), obClassName, p.object_name[1])
             # Now check which objects fall within the classification
-            while len(obKeys) < nObjects:
+            while len(obKeys) < nObjects and self.objectScores is None:
                 self.PostMessage('Gathering random %s.'%(p.object_name[1]))
                 if fltr_sel == 'experiment':
                     if 0 and p.db_sqlite_file:
@@ -790,15 +827,79 @@ class Classifier(wx.Frame):
             statusMsg += loopMsg
             
         self.unclassifiedBin.AddObjects(obKeys[:nObjects], self.chMap, pos='last')
+        imageprefetcher.PrefetchObjectImages(obKeys[:nObjects])
         self.PostMessage(statusMsg)
+        self.PrefetchObjects(sourceKey, fltr_sel, None if fltr_sel == 'experiment' else filteredImKeys, nObjects)
+
+    def GetFetchSourceKey(self, fltr_sel):
+        ''' Returns a key identifying where objects are currently fetched from. '''
+        if fltr_sel == 'image':
+            return (fltr_sel, self.GetGroupKeyFromGroupSizer())
+        elif fltr_sel in p._groups_ordered:
+            return (fltr_sel, self.GetGroupKeyFromGroupSizer(fltr_sel))
+        return (fltr_sel,)
+
+    def GetFetchSourceMessage(self, fltr_sel):
+        ''' Returns the " from ..." part of the Fetch status message. '''
+        if fltr_sel == 'experiment':
+            return ' from whole experiment'
+        elif fltr_sel == 'image':
+            return ' from image %s'%(self.GetGroupKeyFromGroupSizer(),)
+        elif fltr_sel in p._filters_ordered:
+            return ' from filter "%s"'%(fltr_sel)
+        groupKey = self.GetGroupKeyFromGroupSizer(fltr_sel)
+        colNames = dm.GetGroupColumnNames(fltr_sel)
+        return ' from group %s: %s'%(fltr_sel,
+                    ', '.join(['%s=%s'%(n,v) for n, v in zip(colNames,groupKey)]))
+
+    def PrefetchObjects(self, sourceKey, fltr_sel, imKeys, nObjects):
+        '''
+        Keeps twice nObjects objects of each class fetched and tiled in the
+        background so the next Fetch from the same source is immediate.
+        '''
+        if self.prefetcher is None:
+            self.prefetcher = ObjectPrefetcher()
+        if self.algorithm.IsTrained():
+            classes = range(len(self.obClassChoice.GetItems()))
+        else:
+            classes = [0]
+        self.prefetcher.SetSource(sourceKey, 
+                lambda obClass, n: self.SampleObjects(obClass, n, fltr_sel, imKeys),
+                classes, 2 * nObjects)
+
+    def SampleObjects(self, obClass, n, fltr_sel, imKeys):
+        '''
+        Returns up to n random objects of class obClass (0 for unclassified)
+        from the given images (None for the whole experiment).  Unlike 
+        OnFetch, this gives up after MAX_ATTEMPTS objects have been tried.
+        Called from the prefetch thread.
+        '''
+        if obClass == 0:
+            return dm.GetRandomObjects(n, imKeys)
+        scores = self.objectScores
+        if scores is not None:
+            return scores.GetRandomObjects(n, obClass, imKeys)
+        if fltr_sel == 'image':
+            obKeys = self.algorithm.FilterObjectsFromClassN(obClass, imKeys)
+            return random.sample(obKeys, min(n, len(obKeys)))
+        obKeys = []
+        attempts = 0
+        while len(obKeys) < n and attempts < MAX_ATTEMPTS:
+            obKeysToTry = dm.GetRandomObjects(100, imKeys)
+            if not obKeysToTry:
+                break
+            obKeysToTry.sort()
+            obKeys += self.algorithm.FilterObjectsFromClassN(obClass, obKeysToTry)
+            attempts += len(obKeysToTry)
+        return obKeys[:n]
     
     def OnTileUpdated(self, evt):
         '''
-        When the tile loader returns the tile image update the tile.
+        When the tile loader returns the tile images update the tiles.
         '''
-        self.unclassifiedBin.UpdateTile(evt.data)
+        self.unclassifiedBin.UpdateTiles(evt.data)
         for bin in self.classBins:
-            bin.UpdateTile(evt.data)
+            bin.UpdateTiles(evt.data)
 
     # JEN - Start Add
     def OnLoadModel(self, evt):
@@ -838,6 +939,7 @@ class Classifier(wx.Frame):
             self.UpdateClassChoices()
             self.rules_text.Value = self.algorithm.ShowModel()
             self.keysAndCounts = None
+            self.InvalidateObjectScores()
 
     def SaveModel(self, evt=None):
         if not self.defaultModelFileName:
@@ -1002,7 +1104,12 @@ class Classifier(wx.Frame):
             logging.error('Unable to parse number of rules')
             return
         
-        self.keysAndCounts = None    # Must erase current keysAndCounts so they will be recalculated from new rules
+        # Must erase current keysAndCounts so they will be recalculated
+        # from new rules, unless warm-starting leaves the rules unchanged.
+        # When rules change, UpdateObjectScores applies the removed and added
+        # rules to the object scores, which ScoreAll then counts per image.
+        keysAndCounts = self.keysAndCounts
+        self.keysAndCounts = None
 
         if not self.UpdateTrainingSet():
             return
@@ -1021,10 +1128,24 @@ class Classifier(wx.Frame):
                 dlg = wx.ProgressDialog('Training classifier...', '0% Complete', 100, self, wx.PD_ELAPSED_TIME | wx.PD_ESTIMATED_TIME | wx.PD_REMAINING_TIME | wx.PD_CAN_ABORT)
                 # JK - Start Modification
                 # Train the desired algorithm
-                self.algorithm.Train(
-                    self.trainingSet.colnames, nRules, self.trainingSet.label_matrix,
-                    self.trainingSet.values, output, callback=cb
-                )
+                if isinstance(self.algorithm, FastGentleBoosting):
+                    # resume from the previous rules when only rules or
+                    # examples were added
+                    self.algorithm.Train(
+                        self.trainingSet.colnames, nRules, self.trainingSet.label_matrix,
+                        self.trainingSet.values, output, callback=cb,
+                        keys=self.trainingSet.get_object_keys(), warm_start=True
+                    )
+                    removed, added = self.algorithm.changed_learners
+                    if not removed and not added:
+                        self.keysAndCounts = keysAndCounts
+                    self.UpdateObjectScores(self.algorithm.changed_learners)
+                else:
+                    self.algorithm.Train(
+                        self.trainingSet.colnames, nRules, self.trainingSet.label_matrix,
+                        self.trainingSet.values, output, callback=cb
+                    )
+                    self.InvalidateObjectScores()
                 # JK - End Modification
 
                 self.PostMessage('Classifier trained in %.1fs.' % (time()-t1))
@@ -1043,6 +1164,45 @@ class Classifier(wx.Frame):
                 bin.trained = False
         self.UpdateClassChoices()
         
+    def UpdateObjectScores(self, changed_learners=None):
+        '''
+        Scores every object with the current rules in the background so
+        that classified objects can be fetched without querying the
+        database.  If changed_learners lists the (removed, added) rules
+        since the last scoring, only the columns of these rules are fetched.
+        '''
+        previous = self.objectScores
+        self.InvalidateObjectScores()
+        if p.classifier_score_cache != 'yes' or not self.algorithm.model:
+            return
+        if previous is not None and changed_learners is not None:
+            removed, added = changed_learners
+            num_kept = len(self.algorithm.model) - len(added)
+            if not objectscores.same_learners(previous.learners, 
+                                              list(self.algorithm.model[:num_kept]) + list(removed)):
+                changed_learners = None
+        thread = objectscores.ObjectScoresThread(self.algorithm.model, 
+                    lambda scores: wx.CallAfter(self.OnObjectScoresReady, thread, scores),
+                    previous, changed_learners)
+        self.objectScoresThread = thread
+        thread.start()
+
+    def OnObjectScoresReady(self, thread, scores):
+        if thread is not self.objectScoresThread:
+            return
+        self.objectScoresThread = None
+        if scores is not None and objectscores.same_learners(scores.learners, self.algorithm.model):
+            self.objectScores = scores
+            self.PostMessage('Finished scoring all %s.'%(p.object_name[1]))
+
+    def InvalidateObjectScores(self):
+        ''' Drops the object scores and prefetched objects, e.g., when the rules change. '''
+        self.objectScores = None
+        if self.prefetcher is not None:
+            self.prefetcher.Clear()
+        if self.objectScoresThread is not None:
+            self.objectScoresThread.abort()
+            self.objectScoresThread = None
         
     def OnScoreImage(self, evt):
         # Get the image key
@@ -1154,7 +1314,13 @@ class Classifier(wx.Frame):
                 if not cont: # cancel was pressed
                     raise StopCalculating()
             try:
-                self.keysAndCounts = self.algorithm.PerImageCounts(filter_name=filter, cb=update)
+                if self.objectScores is not None and p.area_scoring_column is None:
+                    # the object scores follow the rules as they change, so
+                    # counting them doesn't need to query the database
+                    imKeys = [imKey for imKey, count in dm.GetImageKeysAndObjectCounts(filter)]
+                    self.keysAndCounts = self.objectScores.PerImageCounts(imKeys)
+                else:
+                    self.keysAndCounts = self.algorithm.PerImageCounts(filter_name=filter, cb=update)
             except StopCalculating:
                 dlg.Destroy()
                 self.SetStatusText('Scoring canceled.')      
@@ -1202,12 +1368,33 @@ class Classifier(wx.Frame):
         if wants_enrichments:
             self.PostMessage('Fitting beta binomial distribution to data...')
             counts = groupedKeysAndCounts[:,-nClasses:]
-            alpha, converged = polyafit.fit_betabinom_minka_alternating(counts)
+            # start from the previous fit, which is usually close
+            initial_guess = self.enrichmentAlpha
+            if initial_guess is not None and len(initial_guess) != nClasses:
+                initial_guess = None
+            diagnostics = []
+            alpha, converged = polyafit.fit_betabinom_minka_alternating(counts, initial_guess=initial_guess, 
+                                                                        diagnostics=diagnostics)
+            if converged:
+                self.enrichmentAlpha = alpha
             logging.info('   alpha = %s   converged = %s'%( alpha, converged))
+            if diagnostics:
+                logging.info('   iterations = %d   log likelihood = %s'%(diagnostics[-1][0], diagnostics[-1][2]))
             logging.info('   alpha/Sum(alpha) = %s'%([a/sum(alpha) for a in alpha]))
             t4 = time()
             logging.info('time to fit beta binomial: %.3fs'%(t4-t3))
             self.PostMessage('Computing enrichment scores for each group...')
+            # Only calculate enrichment scores if the beta binomial distribution has been fitted properly
+            if not np.isnan(alpha).any():
+                # compute enrichment probabilities of each class for each image OR group
+                enrichments = dirichletintegrate.score_batch(alpha, np.asarray(counts, dtype=np.float64).astype(int),
+                                                             n_workers=int(p.classifier_workers) or None)
+                # compute logit of each probability
+                # Special case: only calculate logit of "positives" for 2-classes
+                if two_classes:
+                    logits = np.log10(enrichments[:,:1]) - np.log10(1 - enrichments[:,:1])
+                else:
+                    logits = np.log10(enrichments) - np.log10(1 - enrichments)
             
         # CONSTRUCT ARRAY OF TABLE DATA
         tableData = []
@@ -1233,21 +1420,10 @@ class Classifier(wx.Frame):
                 tableRow += countsRow
             
             if wants_enrichments:
-                # Only calculate enrichment scores if the beta binomial distribution has been fitted properly
                 if not np.isnan(alpha).any():
-                    # Append the scores:
-                    #   compute enrichment probabilities of each class for this image OR group
-                    scores = np.array(dirichletintegrate.score(alpha, np.array(countsRow)))
-                    #   clamp to [0,1] to 
-                    scores[scores>1.] = 1.
-                    scores[scores<0.] = 0.
-                    tableRow += scores.tolist()
-                    # Append the logit scores:
-                    # Special case: only calculate logit of "positives" for 2-classes
-                    if two_classes:
-                        tableRow += [np.log10(scores[0])-(np.log10(1-scores[0]))]   # compute logit of each probability
-                    else:
-                        tableRow += [np.log10(score)-(np.log10(1-score)) for score in scores]   # compute logit of each probability
+                    # Append the scores and logit scores
+                    tableRow += enrichments[i].tolist()
+                    tableRow += logits[i].tolist()
                 else:
                     tableRow += ['NaN']*2*len(countsRow)
             tableData.append(tableRow)
@@ -1325,6 +1501,8 @@ class Classifier(wx.Frame):
     def OnSelectFilter(self, evt):
         ''' Handler for fetch filter selection. '''
         filter = self.filterChoice.GetStringSelection()
+        if self.prefetcher is not None:
+            self.prefetcher.Clear()
         # Select from a specific image
         if filter == 'experiment' or filter in p._filters_ordered:
             self.fetchSizer.Hide(self.fetchFromGroupSizer, True)
@@ -1470,6 +1648,7 @@ class Classifier(wx.Frame):
                 self.OnRulesEdit(evt)
                 return
             self.keysAndCounts = None
+            self.InvalidateObjectScores()
             self.rules_text.Value = self.algorithm.ShowModel()
             self.scoreAllBtn.Enable(True if self.algorithm.IsTrained() else False)
             self.scoreImageBtn.Enable(True if self.algorithm.IsTrained() else False)
@@ -1517,6 +1696,9 @@ class Classifier(wx.Frame):
     
     def Destroy(self):
         ''' Kill off all threads before combusting. '''
+        self.InvalidateObjectScores()
+        if self.prefetcher is not None:
+            self.prefetcher.abort()
         super(Classifier, self).Destroy()
         import threading
         for thread in threading.enumerate():
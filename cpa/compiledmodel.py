@@ -0,0 +1,213 @@
+'''
+Compact binary format for fast gentle boosting models.
+
+A compiled model holds the weak learners as arrays: for each learner the
+index of its feature in the model's column list, its threshold and its
+class weights above (a) and below (b) the threshold.  Optional per-column
+scaling (offset and scale) is applied to values before thresholding.  The
+arrays are what NumPy scoring, the SQLite classifier function and the
+MySQL classifier plugin all use, so applying a saved model involves no
+text parsing.
+
+File layout (little endian):
+    MAGIC, then a header of
+        uint32 version, # learners, # classes, # columns
+        40 bytes: hex sha1 of the classifier columns of the object table
+                  the model was trained on (see dbconnect.schema_hash)
+        uint32 length + newline-separated column names
+        uint32 length + newline-separated class labels
+    followed by the arrays
+        int32   features[# learners]
+        float64 thresholds[# learners]
+        float64 a[# learners, # classes], b[# learners, # classes]
+        float64 offset[# columns], scale[# columns]
+'''
+import logging
+import struct
+import numpy as np
+from dbconnect import DBConnect, schema_hash
+
+db = DBConnect.getInstance()
+
+MAGIC = 'CPAMODEL'
+VERSION = 1
+
+def is_compiled_model(filename):
+    ''' Returns whether the file starts like a compiled model. '''
+    f = open(filename, 'rb')
+    try:
+        return f.read(len(MAGIC)) == MAGIC
+    finally:
+        f.close()
+
+
+class CompiledModel(object):
+    '''
+    columns: names of the feature columns used by the model
+    features: index into columns of the feature of each weak learner
+    thresholds, a, b: threshold and class weights of each weak learner
+    labels: class labels
+    offset, scale: values are compared to thresholds after
+        (value - offset) * scale, with scale positive; defaults to no 
+        scaling
+    schema: schema_hash of the classifier columns the model was trained on
+    '''
+    def __init__(self, columns, features, thresholds, a, b, labels,
+                 offset=None, scale=None, schema=None):
+        self.columns = list(columns)
+        self.features = np.asarray(features, np.int32)
+        self.thresholds = np.asarray(thresholds, np.float64)
+        self.a = np.asarray(a, np.float64).reshape((len(self.features), -1))
+        self.b = np.asarray(b, np.float64).reshape((len(self.features), -1))
+        self.labels = list(labels)
+        if offset is None:
+            offset = np.zeros(len(self.columns))
+        if scale is None:
+            scale = np.ones(len(self.columns))
+        self.offset = np.asarray(offset, np.float64)
+        self.scale = np.asarray(scale, np.float64)
+        self.schema = schema or '0' * 40
+
+    @classmethod
+    def FromLearners(cls, learners, labels=None, colnames=None):
+        '''
+        Compiles weak learners from FastGentleBoosting.Train.
+        colnames: the classifier columns of the object table, to record the
+            schema hash of; taken from the database if not given.
+        '''
+        columns = []
+        for learner in learners:
+            if learner[0] not in columns:
+                columns.append(learner[0])
+        num_classes = len(learners[0][2])
+        if labels is None:
+            labels = ['class%d'%(n + 1) for n in range(num_classes)]
+        if colnames is None:
+            colnames = db.GetColnamesForClassifier() or []
+        return cls(columns, [columns.index(l[0]) for l in learners],
+                   [l[1] for l in learners], [l[2] for l in learners],
+                   [l[3] for l in learners], labels, schema=schema_hash(colnames))
+
+    def learners(self):
+        ''' Returns the model as a list of weak learner tuples. '''
+        return [(self.columns[f], float(t), a, b, None) for f, t, a, b in
+                zip(self.features, self.thresholds, self.a, self.b)]
+
+    def num_classes(self):
+        return self.a.shape[1]
+
+    def margins(self, values):
+        '''
+        Returns the per-class margins of each row of values, an n by
+        len(columns) array with NaN for NULL values.
+        '''
+        values = (np.asarray(values, np.float64) - self.offset) * self.scale
+        # like SQL, a comparison with NULL selects b
+        above = values[:, self.features] > self.thresholds
+        return np.dot(above, self.a - self.b) + self.b.sum(axis=0)
+
+    def classify(self, values):
+        ''' Returns the class number (starting at 1) of each row of values. '''
+        return self.margins(values).argmax(axis=1) + 1
+
+    def feature_names(self):
+        ''' Returns the column name of each weak learner. '''
+        return [self.columns[f] for f in self.features]
+
+    def setup_sqlite(self):
+        '''
+        Sets up the SQLite classifier() function with this model's arrays.
+        Returns the expression classifying an object.
+        '''
+        db.setup_sqlite_classifier(self._scaled_thresholds(), self.a, self.b)
+        return 'classifier(%s)'%(','.join(self.feature_names()))
+
+    def mysql_expression(self):
+        '''
+        Returns the expression classifying an object with the MySQL
+        classifier plugin (see mysql_plugins/classify.c).
+        '''
+        base = self.b.sum(axis=0)
+        weights = np.vstack([base, self.a - self.b]).T
+        return '(classifier(%d, 1,%s, 0,%s, %s)+1)'%(
+            len(self.features) + 1, ','.join(self.feature_names()),
+            ','.join([repr(float(t)) for t in self._scaled_thresholds()]),
+            ','.join([repr(float(w)) for w in weights.ravel()]))
+
+    def _scaled_thresholds(self):
+        ''' Thresholds on the unscaled values of each learner's feature. '''
+        scale = self.scale[self.features]
+        return self.thresholds / scale + self.offset[self.features]
+
+    def Validate(self, colnames=None):
+        '''
+        Checks the model against the classifier columns of the object table.
+        Raises ValueError if a column used by the model is missing, and
+        warns if the table's columns have changed since training.
+        '''
+        if colnames is None:
+            colnames = db.GetColnamesForClassifier() or []
+        missing = [c for c in self.columns if c not in colnames]
+        if missing:
+            raise ValueError('Model uses columns that are not in the object table: %s'%(', '.join(missing)))
+        if self.schema != schema_hash(colnames):
+            logging.warn('The object table columns have changed since this model was trained.')
+
+    def Save(self, filename):
+        text = ['\n'.join(self.columns), 
+                '\n'.join([l.encode('utf-8') if isinstance(l, unicode) else l for l in self.labels])]
+        f = open(filename, 'wb')
+        try:
+            f.write(MAGIC)
+            f.write(struct.pack('<4I', VERSION, len(self.features), self.num_classes(), len(self.columns)))
+            f.write(self.schema)
+            for t in text:
+                f.write(struct.pack('<I', len(t)))
+                f.write(t)
+            for array, dtype in [(self.features, '<i4'), (self.thresholds, '<f8'), (self.a, '<f8'),
+                                 (self.b, '<f8'), (self.offset, '<f8'), (self.scale, '<f8')]:
+                f.write(array.astype(dtype).tostring())
+        finally:
+            f.close()
+
+    @classmethod
+    def Load(cls, filename, validate=True, colnames=None):
+        '''
+        Loads a model saved by Save.  If validate is set, the model is
+        checked against colnames (by default the classifier columns of the
+        object table), see Validate.
+        '''
+        f = open(filename, 'rb')
+        try:
+            data = f.read()
+        finally:
+            f.close()
+        if not data.startswith(MAGIC):
+            raise ValueError('%s is not a compiled model'%(filename))
+        pos = len(MAGIC)
+        version, nlearners, nclasses, ncolumns = struct.unpack_from('<4I', data, pos)
+        if version != VERSION:
+            raise ValueError('Unsupported model version %d in %s'%(version, filename))
+        pos += 16
+        schema = data[pos:pos + 40]
+        pos += 40
+        text = []
+        for i in range(2):
+            length, = struct.unpack_from('<I', data, pos)
+            text.append(data[pos + 4:pos + 4 + length])
+            pos += 4 + length
+        arrays = []
+        for dtype, shape in [('<i4', (nlearners,)), ('<f8', (nlearners,)), ('<f8', (nlearners, nclasses)),
+                             ('<f8', (nlearners, nclasses)), ('<f8', (ncolumns,)), ('<f8', (ncolumns,))]:
+            count = int(np.prod(shape))
+            arrays.append(np.frombuffer(data, dtype, count, pos).reshape(shape))
+            pos += count * np.dtype(dtype).itemsize
+        features, thresholds, a, b, offset, scale = arrays
+        columns = text[0].split('\n') if ncolumns else []
+        labels = text[1].split('\n')
+        if len(columns) != ncolumns or len(labels) != nclasses or (features >= ncolumns).any():
+            raise ValueError('%s is corrupt'%(filename))
+        model = cls(columns, features, thresholds, a, b, labels, offset, scale, schema)
+        if validate:
+            model.Validate(colnames)
+        return model
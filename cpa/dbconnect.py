@@ -1,8 +1,11 @@
 import decimal
+import hashlib
 import types
 import random
 from properties import Properties
 from singleton import Singleton
+from spatialindex import ObjectIndex
+from collections import OrderedDict
 from sys import stderr
 import exceptions
 import numpy as np
@@ -19,6 +22,11 @@ import copy
 
 verbose = True
 
+# number of images whose objects are fetched in one bulk query
+IMAGES_PER_QUERY = 200
+# number of images whose object indexes are kept, see GetObjectIndex
+MAX_CACHED_OBJECT_INDEXES = 50
+
 p = Properties.getInstance()
 
 class DBException(Exception):
@@ -154,6 +162,10 @@ def object_key_columns(table_name=''):
     else:
         return (table_name+p.image_id, table_name+object_id)
 
+def schema_hash(colnames):
+    '''Returns a hash identifying a list of column names and their order.'''
+    return hashlib.sha1('\n'.join(colnames)).hexdigest()
+
 def object_key_defs():
     return ', '.join(['%s INT'%(id) for id in object_key_columns()])
 
@@ -178,6 +190,33 @@ def GetWhereClauseForObjects(obkeys, table_name=None):
 
     return split(obkeys,table_name)
 
+def GetWhereClauseForImageObjects(obkeys):
+    '''
+    Return a SQL WHERE clause that matches any of the given object keys, 
+    with the objects of each image grouped together.
+    Example: GetWhereClauseForImageObjects([(1, 3), (1, 4), (2, 1)]) =>
+             "(ImageNumber=1 AND ObjectNumber IN (3,4)) OR (ImageNumber=2 AND ObjectNumber IN (1))"
+    '''
+    cols = object_key_columns()
+    by_image = {}
+    for obkey in obkeys:
+        by_image.setdefault(tuple(obkey[:-1]), []).append(obkey[-1])
+    return ' OR '.join(['(%s AND %s IN (%s))'%(' AND '.join(['%s=%s'%(col, value) for col, value in zip(cols, imkey)]),
+                                               cols[-1], ','.join([str(ob) for ob in sorted(obs)]))
+                        for imkey, obs in sorted(by_image.items())])
+
+def chunk_objects_by_image(obkeys, images_per_chunk):
+    '''
+    Splits object keys into lists holding the objects of at most 
+    images_per_chunk images each, for fetching with one query per chunk.
+    '''
+    by_image = {}
+    for obkey in obkeys:
+        by_image.setdefault(tuple(obkey[:-1]), []).append(obkey)
+    imkeys = sorted(by_image)
+    return [sum([by_image[imkey] for imkey in imkeys[start:start + images_per_chunk]], [])
+            for start in range(0, len(imkeys), images_per_chunk)]
+
 def GetWhereClauseForImages(imkeys):
     '''
     Return a SQL WHERE clause that matches any of the given image keys.
@@ -290,6 +329,8 @@ class DBConnect(Singleton):
         #self.link_cols = {}  # link_cols['table'] = columns that link 'table' to the per-image table
         self.sqlite_classifier = SqliteClassifier()
         self.gui_parent = None
+        self.object_indexes = OrderedDict()
+        self.object_indexes_lock = threading.Lock()
 
     def __str__(self):
         return string.join([ (key + " = " + str(val) + "\n")
@@ -534,6 +575,21 @@ class DBConnect(Singleton):
         except KeyError, e:
             raise DBException, 'No such connection: "%s".\n' %(connID)
 
+    def GetNextResults(self, n):
+        '''
+        Returns a list of up to n more rows of the last query, which was
+        run with execute(..., return_result=False), or [] when there are
+        none left.  With MySQL the rows are streamed from the server.
+        '''
+        connID = threading.currentThread().getName()
+        try:
+            return list(self.cursors[connID].fetchmany(n))
+        except DBError(), e:
+            raise DBException, \
+                'Error retrieving results from database: %s'%(e,)
+        except KeyError, e:
+            raise DBException, 'No such connection: "%s".\n' %(connID)
+
     def _get_results_as_list(self):
         '''
         Returns a list of results retrieved from the last execute query.
@@ -642,22 +698,66 @@ class DBConnect(Singleton):
         else:
             return res[0]
     
+    def GetObjectsCoords(self, obKeys, silent=False):
+        '''Returns a dict mapping each of the given object keys to its x, y 
+        coordinates, fetching the objects of many images per query.  Objects
+        that are missing or have no coordinates are left out.
+        '''
+        coords = {}
+        nkeycols = len(object_key_columns())
+        for chunk in chunk_objects_by_image(obKeys, IMAGES_PER_QUERY):
+            res = self.execute('SELECT %s, %s, %s FROM %s WHERE %s'%(
+                            UniqueObjectClause(), p.cell_x_loc, p.cell_y_loc, 
+                            p.object_table, GetWhereClauseForImageObjects(chunk)), silent=silent)
+            for row in res:
+                if row[nkeycols] is not None and row[nkeycols + 1] is not None:
+                    coords[tuple([int(k) for k in row[:nkeycols]])] = row[nkeycols:]
+        return coords
+    
     def GetAllObjectCoordsFromImage(self, imKey):
-        ''' Returns a list of lists x, y coordinates for all objects in the given image. '''
-        select = 'SELECT '+p.cell_x_loc+', '+p.cell_y_loc+' FROM '+p.object_table+' WHERE '+GetWhereClauseForImages([imKey])+' ORDER BY '+p.object_id
-        return self.execute(select)
+        ''' Returns a list of x, y coordinates for all objects in the given image
+        that have coordinates, in object order. '''
+        index = self.GetObjectIndex(imKey)
+        return [index.position(obKey) for obKey in index.obKeys]
+
+    def GetObjectIndex(self, imKey, silent=False):
+        ''' Returns an ObjectIndex of the objects of an image that have
+        coordinates, for finding objects by position.  The objects are
+        fetched with one query, and the indexes of the most recently used
+        MAX_CACHED_OBJECT_INDEXES images are kept. '''
+        key = (p.db_name, p.db_sqlite_file, p.object_table, p.cell_x_loc, 
+               p.cell_y_loc, tuple(imKey))
+        with self.object_indexes_lock:
+            index = self.object_indexes.pop(key, None)
+            if index is not None:
+                self.object_indexes[key] = index
+                return index
+        nkeycols = len(object_key_columns())
+        res = self.execute('SELECT %s, %s, %s FROM %s WHERE %s ORDER BY %s'%(
+                        UniqueObjectClause(), p.cell_x_loc, p.cell_y_loc, p.object_table, 
+                        GetWhereClauseForImages([imKey]), p.object_id), silent=silent)
+        rows = [row for row in res 
+                if row[nkeycols] is not None and row[nkeycols + 1] is not None]
+        index = ObjectIndex([[int(k) for k in row[:nkeycols]] for row in rows],
+                            [row[nkeycols:] for row in rows])
+        with self.object_indexes_lock:
+            self.object_indexes[key] = index
+            while len(self.object_indexes) > MAX_CACHED_OBJECT_INDEXES:
+                self.object_indexes.popitem(last=False)
+        return index
 
     def GetObjectNear(self, imkey, x, y, silent=False):
         ''' Returns obKey of the closest object to x, y in an image. '''
-        delta_x = '(%s - %d)'%(p.cell_x_loc, x)
-        delta_y = '(%s - %d)'%(p.cell_y_loc, y)
-        dist_clause = '%s*%s + %s*%s'%(delta_x, delta_x, delta_y, delta_y)
-        select = 'SELECT '+UniqueObjectClause()+' FROM '+p.object_table+' WHERE '+GetWhereClauseForImages([imkey])+' ORDER BY ' +dist_clause+' LIMIT 1'
-        res = self.execute(select, silent=silent)
-        if len(res) == 0:
-            return None
-        else:
-            return res[0]
+        return self.GetObjectIndex(imkey, silent=silent).nearest(x, y)
+
+    def GetObjectsNear(self, imkey, x, y, radius, silent=False):
+        ''' Returns the obKeys of the objects within radius of x, y in an image. '''
+        return self.GetObjectIndex(imkey, silent=silent).in_radius(x, y, radius)
+
+    def GetObjectsInPolygon(self, imkey, vertices, silent=False):
+        ''' Returns the obKeys of the objects of an image inside the polygon
+        with the given x, y vertices. '''
+        return self.GetObjectIndex(imkey, silent=silent).in_polygon(vertices)
     
     def GetFullChannelPathsForImage(self, imKey):
         ''' 
@@ -1452,6 +1552,31 @@ class DBConnect(Singleton):
         typed_table = np.array(typed_table, dtype=object).T
         return self.CreateTempTableFromData(typed_table, colnames, tablename)
     
+    def replace_table(self, new_table, tablename, index_cols=None):
+        '''Renames new_table to tablename, replacing any existing table.
+        On MySQL the swap is one atomic RENAME TABLE, so readers see either
+        the complete old table or the complete new one.
+        index_cols -- if given, a comma-separated list of columns to create
+                      the index idx_<tablename> on.  It is created before the 
+                      swap, except on SQLite where index names are shared by
+                      all tables.
+        '''
+        if p.db_type.lower() == 'mysql':
+            if index_cols:
+                self.execute('CREATE INDEX idx_%s ON %s (%s)'%(tablename, new_table, index_cols))
+            old_table = tablename + '_old'
+            self.execute('DROP TABLE IF EXISTS %s'%(old_table))
+            if self.table_exists(tablename):
+                self.execute('RENAME TABLE %s TO %s, %s TO %s'%(tablename, old_table, new_table, tablename))
+                self.execute('DROP TABLE %s'%(old_table))
+            else:
+                self.execute('RENAME TABLE %s TO %s'%(new_table, tablename))
+        else:
+            self.execute('DROP TABLE IF EXISTS %s'%(tablename))
+            self.execute('ALTER TABLE %s RENAME TO %s'%(new_table, tablename))
+            if index_cols:
+                self.execute('CREATE INDEX idx_%s ON %s (%s)'%(tablename, tablename, index_cols))
+
     def create_empty_table(self, tablename, colnames, coltypes, temporary=False):
         '''Creates an empty table with the given tablename and columns.
         Note: column names will automatically be cleaned up.
@@ -1473,20 +1598,55 @@ class DBConnect(Singleton):
             if key in self.GetColumnNames(tablename):
                 self.execute('CREATE INDEX %s ON %s (%s)'%('%s_%s'%(tablename,key), tablename, key))
 
-    def insert_rows_into_table(self, tablename, colnames, coltypes, rows):
-        '''Inserts the given rows into the table
+    def insert_rows_into_table(self, tablename, colnames, coltypes, rows, batch_size=1000):
+        '''Inserts the given rows into the table, batch_size rows per query
         '''
+        def value(i, val):
+            if (val is None or 
+                coltypes[i]=='FLOAT' and (np.isinf(val) or np.isnan(val))):
+                return None
+            if isinstance(val, np.generic):
+                return val.item()
+            return val
+        query = 'INSERT INTO %s (%s) VALUES (%s)'%(tablename, ', '.join(colnames), 
+                                                   ', '.join([self.placeholder()] * len(colnames)))
+        batch = []
         for row in rows:
-            vals = []
-            for i, val in enumerate(row):
-                if (coltypes[i]=='FLOAT' and (np.isinf(val) or np.isnan(val))
-                    or val is None):
-                    vals += ['NULL']
-                else:
-                    vals += ['"%s"'%val]
-            vals = ', '.join(vals)
-            self.execute('INSERT INTO %s (%s) VALUES (%s)'%(
-                          tablename, ', '.join(colnames), vals), silent=True)
+            batch.append([value(i, val) for i, val in enumerate(row)])
+            if len(batch) == batch_size:
+                self.executemany(query, batch)
+                batch = []
+        if batch:
+            self.executemany(query, batch)
+
+    def placeholder(self):
+        '''Returns the parameter placeholder used by the database module.'''
+        if p.db_type.lower() == 'sqlite':
+            return '?'
+        return '%s'
+
+    @DBDisconnectedException.with_mysql_retry
+    def executemany(self, query, rows):
+        '''
+        Executes the given parameterized query once for each row of
+        parameters, using the connection associated with the current thread.
+        Parameters are marked with self.placeholder().
+        '''
+        connID = threading.currentThread().getName()
+        if not connID in self.connections.keys():
+            self.connect()
+        try:
+            cursor = self.cursors[connID]
+        except KeyError, e:
+            raise DBException, 'No such connection: "%s".\n' %(connID)
+        try:
+            cursor.executemany(query, rows)
+        except Exception, e:
+            if isinstance(e, DBOperationalError()) and e.args[0] in [2006, 2013, 1053]:
+                raise DBDisconnectedException()
+            raise DBException, ('Database query failed for connection "%s"'
+                                '\nQuery was: "%s"'
+                                '\nException was: %s'%(connID, query, e))
     
     def CreateTempTableFromData(self, dtable, colnames, tablename, temporary=True):
         '''Creates and populates a temporary table in the database.
@@ -1506,9 +1666,10 @@ class DBConnect(Singleton):
         if coltypes is None:
             coltypes = self.InferColTypesFromData(dtable, len(colnames))
         self.create_empty_table(tablename, colnames, coltypes, temporary)
-        self.create_default_indexes_on_table(tablename)
         logging.info('Populating %stable %s...'%((temporary and 'temporary ' or ''), tablename))
         self.insert_rows_into_table(tablename, colnames, coltypes, dtable)
+        # indexing after loading is faster than maintaining indexes while inserting
+        self.create_default_indexes_on_table(tablename)
         self.Commit()
         return True
     
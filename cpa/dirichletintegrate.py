@@ -1,3 +1,4 @@
+from __future__ import with_statement
 from numpy import *
 from scipy.integrate import quadrature, romberg, fixed_quad
 from scipy.special import gammaln, betaln, digamma, polygamma, betainc, gamma
@@ -147,6 +148,57 @@ def score(prior, counts):
         return beta_enriched((prior_a, prior_b), (posterior_a, posterior_b))
     return [score_idx(i) for i in range(K)]
 
+def _score_task((prior, counts)):
+    return score(prior, counts)
+
+# scores of the most recently used prior, keyed by count vector
+_score_cache = {'prior' : None, 'scores' : {}}
+
+def score_batch(prior, counts, n_workers=1, min_parallel=1000):
+    '''
+    score each row of counts (an N x K array) based on the prior.
+    Rows with identical counts are only scored once, and scores are
+    remembered between calls with the same prior.  With two classes the
+    second score is 1 minus the first, so only one integral is computed.
+    If at least min_parallel rows need to be scored, they are spread over
+    n_workers processes (see util.process_pool, None for one per CPU).
+    Returns an N x K array of enrichment probabilities in [0,1].
+    '''
+    import util
+    prior = asarray(prior, float64)
+    K = len(prior)
+    counts = asarray(counts, float64).reshape((-1, K))
+    if _score_cache['prior'] is None or not array_equal(_score_cache['prior'], prior):
+        _score_cache['prior'] = prior.copy()
+        _score_cache['scores'] = {}
+    cache = _score_cache['scores']
+
+    todo = {}
+    for row in counts:
+        key = tuple(row)
+        if key not in cache:
+            todo[key] = row
+    todo = todo.values()
+    if K == 2:
+        # P(class 1 enriched) = 1 - P(class 0 enriched)
+        tasks = [((prior[0], prior[1]), (prior[0] + row[0], prior[1] + row[1])) for row in todo]
+        task_function = _beta_enriched_task
+    else:
+        tasks = [(prior, row) for row in todo]
+        task_function = _score_task
+    with util.process_pool(n_workers if len(tasks) >= min_parallel else 1) as pool:
+        for row, result in zip(todo, pool.imap(task_function, tasks)):
+            if K == 2:
+                result = [result, 1.0 - result]
+            cache[tuple(row)] = clip(array(result, float64), 0, 1)
+
+    if len(counts) == 0:
+        return zeros((0, K), float64)
+    return array([cache[tuple(row)] for row in counts])
+
+def _beta_enriched_task((prior, posterior)):
+    return beta_enriched(prior, posterior)
+
 def logit(p):
      return log2(p) - log2(1-p)
 
@@ -1,11 +1,15 @@
+from __future__ import with_statement
 try:
     import cellprofiler.gui.cpfigure as cpfig
 except: pass
 import re
+import compiledmodel
 import dbconnect
 import logging
 import multiclasssql
 import numpy as np
+import util
+from properties import Properties
 from sys import stdin, stdout, argv, exit
 from time import time
 
@@ -15,6 +19,7 @@ class FastGentleBoosting(object):
         self.model = None
         self.classBins = []
         self.classifier = classifier
+        self.ClearTrainingState()
 
     def CheckProgress(self):
         import wx
@@ -31,7 +36,17 @@ class FastGentleBoosting(object):
             return
         
         db = dbconnect.DBConnect.getInstance()
-        groups = [db.get_platewell_for_object(key) for key in self.classifier.trainingSet.get_object_keys()]
+        # objects in the same image share a plate and well, so look each
+        # image up only once
+        platewells = {}
+        groups = []
+        for key in self.classifier.trainingSet.get_object_keys():
+            if key[:-1] not in platewells:
+                platewells[key[:-1]] = db.get_platewell_for_object(key)
+            groups.append(platewells[key[:-1]])
+
+        # the classifier_workers property opts into training folds in parallel
+        n_workers = int(Properties.getInstance().classifier_workers) or None
 
         t1 = time()
         dlg = wx.ProgressDialog('Computing cross validation accuracy...', '0% Complete', 100, self.classifier, wx.PD_ELAPSED_TIME | wx.PD_ESTIMATED_TIME | wx.PD_REMAINING_TIME | wx.PD_CAN_ABORT)        
@@ -51,31 +66,26 @@ class FastGentleBoosting(object):
         # each round of xvalidation takes about (numfolds * (1 - (1 / num_folds))) time
         step_time_1 = (2.0 * (1.0 - 1.0 / 2.0))
         step_time_2 = (20.0 * (1.0 - 1.0 / 20.0))
-        scale = step_time_1 / (10 * step_time_1 + step_time_2)
-
-        xvalid_50 = []
+        scale = 10 * step_time_1 / (10 * step_time_1 + step_time_2)
 
         try:
-            for i in range(10):
-                # JK - Start Modification
-                xvalid_50 += self.XValidate(
-                    self.classifier.trainingSet.colnames, nRules, self.classifier.trainingSet.label_matrix,
-                    self.classifier.trainingSet.values, 2, groups, progress_callback
-                )
-                # JK - End Modification
-
-                # each round makes one "scale" size step in progress
-                base += scale
+            # ten rounds of 2-fold cross-validation, run as one batch so
+            # that all 20 folds can be trained in parallel
+            xvalid_50 = self.XValidate(
+                self.classifier.trainingSet.colnames, nRules, self.classifier.trainingSet.label_matrix,
+                self.classifier.trainingSet.values, 2, groups, progress_callback, repeats=10,
+                n_workers=n_workers
+            )
             xvalid_50 = sum(xvalid_50) / 10.0
+            base += scale
 
             # only one more step
             scale = 1.0 - base
-            # JK - Start Modification
             xvalid_95 = self.XValidate(
                 self.classifier.trainingSet.colnames, nRules, self.classifier.trainingSet.label_matrix,
-                self.classifier.trainingSet.values, 20, groups, progress_callback
+                self.classifier.trainingSet.values, 20, groups, progress_callback,
+                n_workers=n_workers
             )
-            # JK - End Modification
 
             dlg.Destroy()
             figure = cpfig.create_or_find(self.classifier, -1, 'Cross-validation accuracy', subplots=(1,1), name='Cross-validation accuracy')
@@ -99,6 +109,13 @@ class FastGentleBoosting(object):
     def ClearModel(self):
         self.classBins = []
         self.model = None
+        self.ClearTrainingState()
+
+    def ClearTrainingState(self):
+        ''' Forget the margins kept for warm starts. '''
+        self.margins = None
+        self.trained_keys = None
+        self.changed_learners = None
 
     def ComplexityTxt(self):
         return 'Max # of rules: '
@@ -113,6 +130,12 @@ class FastGentleBoosting(object):
         return self.model is not None
 
     def LoadModel(self, model_filename):
+        self.ClearTrainingState()
+        if compiledmodel.is_compiled_model(model_filename):
+            model = compiledmodel.CompiledModel.Load(model_filename)
+            self.model, self.bin_labels = model.learners(), model.labels
+            return
+        # models saved before the compiled format were pickled
         import cPickle
         fh = open(model_filename, 'r')
         try:
@@ -126,6 +149,7 @@ class FastGentleBoosting(object):
             fh.close()
 
     def ParseModel(self, string):
+        self.ClearTrainingState()
         self.model = []
         string = string.replace('\r\n', '\n')
         for line in string.split('\n'):
@@ -152,10 +176,7 @@ class FastGentleBoosting(object):
         return multiclasssql.PerImageCounts(self.model, filter_name=filter_name, cb=cb)
 
     def SaveModel(self, model_filename, bin_labels):
-        import cPickle
-        fh = open(model_filename, 'w')
-        cPickle.dump((self.model, bin_labels), fh)
-        fh.close()
+        compiledmodel.CompiledModel.FromLearners(self.model, bin_labels).Save(model_filename)
 
     def ShowModel(self):
         '''
@@ -170,11 +191,18 @@ class FastGentleBoosting(object):
         else:
             return ''
 
-    def Train(self, colnames, num_learners, label_matrix, values, fout=None, do_prof=False, test_values=None, callback=None):
+    def Train(self, colnames, num_learners, label_matrix, values, fout=None, do_prof=False, test_values=None, callback=None, keys=None, warm_start=False):
         '''
         label_matrix is an n by k numpy array containing values of either +1 or -1
         values is the n by j numpy array of cell measurements
         n = #example cells, k = #classes, j = #measurements
+        keys is an optional list of the n object keys of the examples; the
+        margins of the trained model are stored per key for warm starts.
+        If warm_start is set and the examples of the previous call are a
+        subset of these (with the same labels and columns), training
+        resumes from the previous model and margins instead of starting
+        over.  Afterwards, self.changed_learners holds the (removed, added)
+        learners relative to the previous model.
         Return a list of learners.  Each learner is a tuple (column, thresh, a,
         b, average_margin), where column is an integer index into colnames
         '''
@@ -199,6 +227,42 @@ class FastGentleBoosting(object):
             weights[np.tile(classmask, (1, num_classes))] /= num_examples_class
         balancing = weights.copy()
 
+        def LearnerAdjustment(learner, vals):
+            colname, thresh, a, b, e_m = learner
+            delta = np.reshape(vals[:, list(colnames).index(colname)] > thresh, (vals.shape[0], 1))
+            return np.where(delta, np.reshape(a, (1, num_classes)), np.reshape(b, (1, num_classes)))
+
+        def AddMargins(adjustment):
+            # accumulate the per-example margins of one weak learner and
+            # return the expected worst margin so far
+            step_correct_class = adjustment[label_matrix > 0].reshape((num_examples, 1))
+            step_relative = step_correct_class - (adjustment[label_matrix < 0].reshape((num_examples, num_classes - 1)))
+            mask = (step_relative > 0)
+            margin_correct[:] += step_relative * mask
+            margin_incorrect[:] += (- step_relative) * (~ mask)
+            return sum(balancing[:,0] * (margin_correct / (margin_correct + margin_incorrect)).min(axis=1)) / sum(balancing[:,0])
+
+        previous_model = self.model or []
+        num_kept = 0
+        if warm_start and not do_tests:
+            start = self._WarmStart(colnames, num_learners, label_matrix, keys)
+            if start is not None:
+                num_kept, old_rows = start
+                kept = previous_model[:num_kept]
+                computed_labels = np.zeros(label_matrix.shape, self.margins.dtype)
+                # reuse the stored margins of the old examples, compute
+                # them from the kept learners for the new ones
+                new_rows = (old_rows < 0)
+                computed_labels[~new_rows] = self.margins[old_rows[~new_rows]]
+                for learner in previous_model[num_kept:]:
+                    computed_labels[~new_rows] -= LearnerAdjustment(learner, values[~new_rows])
+                for learner in kept:
+                    computed_labels[new_rows] += LearnerAdjustment(learner, values[new_rows])
+                    AddMargins(LearnerAdjustment(learner, values))
+                weights = balancing * np.exp(- computed_labels * label_matrix)
+                weights = weights / sum(weights)
+                logging.info('Resuming training from %d of %d rules with %d new examples'%(num_kept, len(previous_model), new_rows.sum()))
+
         def GetOneWeakLearner(ctl=None, tlbi=None):
             best_error = float(np.Infinity)
             for feature_idx in range(values.shape[1]):
@@ -225,26 +289,22 @@ class FastGentleBoosting(object):
 
             return (err, colnames[int(column)], thresh, a, b, reweights, recomputed_labels, adjustment)
 
-        self.model = []
-        for weak_count in range(num_learners):
+        self.model = previous_model[:num_kept]
+        self.margins = None
+        for weak_count in range(num_kept, num_learners):
             if do_tests:
                 err, colname, thresh, a, b, reweight, recomputed_labels, adjustment = GetOneWeakLearner(ctl=computed_test_labels, tlbi=test_labels_by_iteration)
             else:
                 err, colname, thresh, a, b, reweight, recomputed_labels, adjustment = GetOneWeakLearner()
 
             # compute margins
-            step_correct_class = adjustment[label_matrix > 0].reshape((num_examples, 1))
-            step_relative = step_correct_class - (adjustment[label_matrix < 0].reshape((num_examples, num_classes - 1)))
-            mask = (step_relative > 0)
-            margin_correct += step_relative * mask
-            margin_incorrect += (- step_relative) * (~ mask)
-            expected_worst_margin = sum(balancing[:,0] * (margin_correct / (margin_correct + margin_incorrect)).min(axis=1)) / sum(balancing[:,0])
+            expected_worst_margin = AddMargins(adjustment)
 
             computed_labels = recomputed_labels
             self.model += [(colname, thresh, a, b, expected_worst_margin)]
 
             if callback is not None:
-                callback(weak_count / float(num_learners))
+                callback((weak_count - num_kept) / float(num_learners - num_kept))
 
             if fout:
                 colname, thresh, a, b, e_m = self.model[-1]
@@ -255,9 +315,48 @@ class FastGentleBoosting(object):
             if err == 0.0:
                 break
             weights = reweight
+
+        # remember the training state for the next warm start
+        self.changed_learners = (previous_model[num_kept:], self.model[num_kept:])
+        if keys is not None and not do_tests:
+            self.margins = computed_labels
+            self.trained_keys = list(keys)
+            self.trained_labels = label_matrix.argmax(axis=1)
+            self.trained_colnames = list(colnames)
+        else:
+            self.trained_keys = None
         if do_tests:
             return test_labels_by_iteration
 
+    def _WarmStart(self, colnames, num_learners, label_matrix, keys):
+        '''
+        Decides whether training can resume from the previous model.
+        Returns None to train from scratch, or (num_kept, old_rows) where
+        num_kept is the number of learners to keep and old_rows maps each
+        example to its row in self.margins (-1 for new examples).
+        Only adding examples or rules is supported.  When examples were
+        added, the last learners are retrained in proportion to the
+        fraction of new examples.
+        '''
+        if (not self.model or keys is None or self.trained_keys is None or
+            self.margins is None or list(colnames) != self.trained_colnames or
+            len(self.model[0][2]) != label_matrix.shape[1]):
+            return None
+        old_row_of_key = dict((key, row) for row, key in enumerate(self.trained_keys))
+        old_rows = np.array([old_row_of_key.get(key, -1) for key in keys], int)
+        if len(set(old_rows[old_rows >= 0])) != len(self.trained_keys):
+            # examples were removed
+            return None
+        labels = label_matrix.argmax(axis=1)
+        if (labels[old_rows >= 0] != self.trained_labels[old_rows[old_rows >= 0]]).any():
+            # examples were moved to another class
+            return None
+        num_new = (old_rows < 0).sum()
+        num_kept = len(self.model)
+        if num_new > 0:
+            num_kept -= max(1, int(round(len(self.model) * num_new / float(len(keys)))))
+        return min(num_kept, num_learners), old_rows
+
     def TrainWeakLearner(self, labels, weights, values):
         ''' For a multiclass training set, with C classes and N examples,
         finds the optimal weak learner in O(M * N logN) time.
@@ -280,7 +379,7 @@ class FastGentleBoosting(object):
         # slightly with the number of workers.  Add kind="mergesort" to
         # get a stable sort, which avoids this.
         order = np.argsort(values)
-        s_values = values[order, :]
+        s_values = values[order]
         s_labels = labels[order, :]
         s_weights = weights[order, :]
 
@@ -342,48 +441,81 @@ class FastGentleBoosting(object):
         print "Note that if one learner is sufficient, only one will be written."
         exit(1)
 
-    def XValidate(self, colnames, num_learners, label_matrix, values, folds, group_labels, progress_callback):
-        # if everything's in the same group, ignore the labels
-        if all([g == group_labels[0] for g in group_labels]):
-            group_labels = range(len(group_labels))
-
-        # randomize the order of labels
-        unique_labels = list(set(group_labels))
-        np.random.shuffle(unique_labels)
-
-
-        fold_min_size = len(group_labels) / float(folds)
-        num_misclassifications = np.zeros(num_learners, int)
-
-        # break into folds, randomly, but with all identical group_labels together
-        for f in range(folds):
-            current_holdout = [False] * len(group_labels)
-            while unique_labels and (sum(current_holdout) < fold_min_size):
-                to_add = unique_labels.pop()
-                current_holdout = [(a or b) for a, b in zip(current_holdout, [g == to_add for g in group_labels])]
-
-            if sum(current_holdout) == 0:
-                print "no holdout"
-                break
-
-            holdout_idx = np.nonzero(current_holdout)[0]
-            current_holdin = ~ np.array(current_holdout)
-            holdin_idx = np.nonzero(current_holdin)[0]
-            holdin_labels = label_matrix[holdin_idx, :]
-            holdin_values = values[holdin_idx, :]
-            holdout_values = values[holdout_idx, :]
-            holdout_results = self.Train(colnames, num_learners, holdin_labels, holdin_values, test_values=holdout_values)
-            if holdout_results is None:
-                return None
-            # pad the end of the holdout set with the last element
-            if len(holdout_results) < num_learners:
-                holdout_results += [holdout_results[-1]] * (num_learners - len(holdout_results))
-            holdout_labels = label_matrix[holdout_idx, :].argmax(axis=1)
-            num_misclassifications += [sum(hr != holdout_labels) for hr in holdout_results]
-            if progress_callback:
-                progress_callback(f / float(folds))
-
-        return [num_misclassifications]
+    def XValidate(self, colnames, num_learners, label_matrix, values, folds, group_labels, progress_callback, seed=None, repeats=1, n_workers=1):
+        '''
+        Cross-validate the classifier REPEATS times with FOLDS folds each.
+        Folds are trained in parallel on N_WORKERS processes (None for one
+        per CPU).  Given a SEED, the results are reproducible regardless of
+        the number of workers.
+        Returns a list with, for each repeat, an array holding the number
+        of misclassified holdout examples after each learner.
+        '''
+        random_state = np.random.RandomState(seed)
+        holdout_labels = label_matrix.argmax(axis=1)
+        tasks = []
+        for repeat in range(repeats):
+            fold_of_example = assign_folds(group_labels, folds, random_state)
+            for f in range(folds):
+                holdout = (fold_of_example == f)
+                if not holdout.any():
+                    logging.info('Cross-validation: no holdout for fold %d'%(f))
+                    break
+                tasks.append((repeat, colnames, num_learners,
+                              label_matrix[~holdout, :], values[~holdout, :],
+                              values[holdout, :], holdout_labels[holdout]))
+
+        num_misclassifications = [np.zeros(num_learners, int) for repeat in range(repeats)]
+        with util.process_pool(n_workers) as pool:
+            for done, (repeat, fold_misclassifications) in enumerate(pool.imap(_xvalidate_fold, tasks)):
+                if fold_misclassifications is None:
+                    return None
+                num_misclassifications[repeat] += fold_misclassifications
+                if progress_callback:
+                    progress_callback((done + 1) / float(len(tasks)))
+
+        return num_misclassifications
+
+
+def assign_folds(group_labels, folds, random_state=np.random):
+    '''
+    Randomly splits examples into cross-validation folds, keeping all
+    examples with identical group_labels together.  Returns an array
+    holding the fold of each example (-1 if none could be assigned).
+    '''
+    group_index = {}
+    groups = np.array([group_index.setdefault(g, len(group_index)) for g in group_labels], int)
+    # if everything's in the same group, ignore the labels
+    if len(group_index) == 1:
+        groups = np.arange(len(groups))
+    group_sizes = np.bincount(groups)
+
+    # randomize the order of groups, then fill each fold with whole
+    # groups until it reaches its minimum size
+    order = random_state.permutation(len(group_sizes))
+    fold_min_size = len(groups) / float(folds)
+    fold_of_group = -np.ones(len(group_sizes), int)
+    pos = 0
+    for f in range(folds):
+        fold_size = 0
+        while pos < len(order) and fold_size < fold_min_size:
+            fold_of_group[order[pos]] = f
+            fold_size += group_sizes[order[pos]]
+            pos += 1
+    return fold_of_group[groups]
+
+def _xvalidate_fold((repeat, colnames, num_learners, holdin_labels, holdin_values, holdout_values, holdout_labels)):
+    '''
+    Trains on one cross-validation fold, returns the repeat it belongs to
+    and the number of misclassified holdout examples after each learner.
+    Defined at module level so it can be run in a multiprocessing Pool.
+    '''
+    holdout_results = FastGentleBoosting().Train(colnames, num_learners, holdin_labels, holdin_values, test_values=holdout_values)
+    if holdout_results is None:
+        return repeat, None
+    # pad the end of the holdout set with the last element
+    if len(holdout_results) < num_learners:
+        holdout_results += [holdout_results[-1]] * (num_learners - len(holdout_results))
+    return repeat, (np.array(holdout_results) != holdout_labels).sum(axis=1)
 
 if __name__ == '__main__':
     fgb = FastGentleBoosting()
@@ -0,0 +1,428 @@
+'''
+Fetching of image files over HTTP, for image_url_prepend urls.
+
+HTTPFetcher keeps persistent (keep-alive) connections to the image server,
+fetches several files at once on as many connections, and can fetch byte
+ranges of files, eg: the strips of a TIFF that hold some tiles (see
+RangeFile).  Fetched files are kept in a DiskCache, if one is given, so
+that they are never downloaded again.
+
+DiskCache stores files by the sha1 of their contents, with a small file per
+url naming the contents, and evicts the least recently used files once
+they add up to more than its size limit.
+'''
+from __future__ import with_statement
+from collections import OrderedDict
+import hashlib
+import httplib
+import logging
+import os
+import socket
+import tempfile
+import threading
+import urllib
+import urlparse
+
+# size of the blocks RangeFile fetches
+RANGE_BLOCK_SIZE = 1 << 16
+
+class DiskCache(object):
+    '''
+    directory: where to keep the files
+    max_bytes: the most space to use for files
+    '''
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.RLock()
+        self.blobs = OrderedDict()   # blob filename -> size, least recently used first
+        self.nbytes = 0
+        for subdir in ['blobs', 'urls']:
+            if not os.path.isdir(os.path.join(directory, subdir)):
+                os.makedirs(os.path.join(directory, subdir))
+        entries = []
+        for name in os.listdir(os.path.join(directory, 'blobs')):
+            if name.startswith('.'):
+                continue
+            st = os.stat(os.path.join(directory, 'blobs', name))
+            entries.append((st.st_mtime, name, st.st_size))
+        for mtime, name, size in sorted(entries):
+            self.blobs[name] = size
+            self.nbytes += size
+        self._evict()
+
+    def _url_file(self, url):
+        return os.path.join(self.directory, 'urls', hashlib.sha1(url).hexdigest())
+
+    def _blob_file(self, name):
+        return os.path.join(self.directory, 'blobs', name)
+
+    def path(self, url):
+        ''' Returns the filename of a cached url's contents, or None. '''
+        try:
+            f = open(self._url_file(url), 'rb')
+            try:
+                name = f.read().strip()
+            finally:
+                f.close()
+        except IOError:
+            return None
+        with self.lock:
+            if name not in self.blobs:
+                return None
+            self.blobs[name] = self.blobs.pop(name)
+            filename = self._blob_file(name)
+            try:
+                os.utime(filename, None)
+            except OSError:
+                # evicted by another process
+                self.nbytes -= self.blobs.pop(name)
+                return None
+        return filename
+
+    def get(self, url):
+        ''' Returns the contents of a cached url, or None. '''
+        filename = self.path(url)
+        if filename is None:
+            return None
+        try:
+            f = open(filename, 'rb')
+            try:
+                return f.read()
+            finally:
+                f.close()
+        except IOError:
+            return None
+
+    def put(self, url, data):
+        ''' Caches the contents of a url and returns their filename. '''
+        # keep the extension, which some readers go by
+        ext = os.path.splitext(urlparse.urlparse(url).path)[1][:10]
+        name = hashlib.sha1(data).hexdigest() + ext
+        filename = self._blob_file(name)
+        with self.lock:
+            if name not in self.blobs:
+                self._write(filename, data)
+                self.blobs[name] = len(data)
+                self.nbytes += len(data)
+            self._write(self._url_file(url), name)
+            self.blobs[name] = self.blobs.pop(name)
+            self._evict(keep=name)
+        return filename
+
+    def _write(self, filename, data):
+        # write to a temporary file first so readers never see part of a file
+        fd, temp = tempfile.mkstemp(dir=os.path.dirname(filename), prefix='.')
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+        if os.name == 'nt' and os.path.exists(filename):
+            os.remove(filename)
+        os.rename(temp, filename)
+
+    def _evict(self, keep=None):
+        while self.nbytes > self.max_bytes and self.blobs:
+            name, size = self.blobs.popitem(last=False)
+            if name == keep:
+                self.blobs[name] = size
+                if len(self.blobs) == 1:
+                    break
+                continue
+            self.nbytes -= size
+            try:
+                os.remove(self._blob_file(name))
+            except OSError:
+                pass
+
+    def clear(self):
+        with self.lock:
+            for name in self.blobs.keys():
+                try:
+                    os.remove(self._blob_file(name))
+                except OSError:
+                    pass
+            self.blobs.clear()
+            self.nbytes = 0
+
+
+class HTTPFetcher(object):
+    '''
+    cache: a DiskCache, or None
+    max_connections: the most connections to open to each server, which is
+        also how many files GetMany fetches at once
+    timeout: seconds to wait on the server
+    '''
+    def __init__(self, cache=None, max_connections=4, timeout=60):
+        self.cache = cache
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.idle = {}        # (scheme, netloc) -> idle connections
+        self.slots = {}       # (scheme, netloc) -> semaphore of max_connections
+        self.requests = 0
+        self.connections = 0
+
+    def _server(self, url):
+        parts = urlparse.urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        # image_url_prepend is quoted whole, including the server's port
+        return (parts.scheme.lower(), urllib.unquote(parts.netloc)), path
+
+    def _request(self, url, headers={}):
+        '''
+        Requests url on a pooled connection and returns the response's
+        (status, headers, body).  A kept-alive connection that the server
+        has since closed is replaced once.
+        '''
+        server, path = self._server(url)
+        with self.lock:
+            slots = self.slots.get(server, None)
+            if slots is None:
+                slots = self.slots[server] = threading.Semaphore(self.max_connections)
+        slots.acquire()
+        try:
+            for attempt in range(2):
+                with self.lock:
+                    idle = self.idle.setdefault(server, [])
+                    conn = idle.pop() if idle else None
+                reused = conn is not None
+                if conn is None:
+                    if server[0] == 'https':
+                        conn = httplib.HTTPSConnection(server[1], timeout=self.timeout)
+                    else:
+                        conn = httplib.HTTPConnection(server[1], timeout=self.timeout)
+                    with self.lock:
+                        self.connections += 1
+                try:
+                    conn.request('GET', path, headers=headers)
+                    response = conn.getresponse()
+                    body = response.read()
+                except (httplib.HTTPException, socket.error), e:
+                    conn.close()
+                    if reused and attempt == 0:
+                        continue
+                    raise IOError('Could not fetch "%s": %s'%(url, e))
+                with self.lock:
+                    self.requests += 1
+                    if response.will_close:
+                        conn.close()
+                    else:
+                        self.idle[server].append(conn)
+                return response.status, dict(response.getheaders()), body
+        finally:
+            slots.release()
+
+    def Get(self, url):
+        ''' Returns the contents of url, from the disk cache if it is there. '''
+        if self.cache is not None:
+            data = self.cache.get(url)
+            if data is not None:
+                return data
+        logging.info('Fetching image: %s'%(url))
+        status, headers, body = self._request(url)
+        if status != 200:
+            raise IOError('Image not found: "%s" (HTTP %d)'%(url, status))
+        if self.cache is not None:
+            self.cache.put(url, body)
+        return body
+
+    def GetFile(self, url):
+        '''
+        Returns (filename, temporary) of a local file with the contents of
+        url: the cached file, or if there is no disk cache, a temporary file
+        that the caller should remove.
+        '''
+        if self.cache is not None:
+            filename = self.cache.path(url)
+            if filename is None:
+                self.Get(url)
+                filename = self.cache.path(url)
+            if filename is not None:
+                return filename, False
+        data = self.Get(url)
+        fd, filename = tempfile.mkstemp(suffix=os.path.splitext(urlparse.urlparse(url).path)[1])
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+        return filename, True
+
+    def GetMany(self, urls, get=None):
+        '''
+        Returns the contents of each of the urls (see Get), fetched on up to
+        max_connections connections at once.  get is the method to fetch
+        each url with, Get by default.
+        '''
+        get = get or self.Get
+        results = [None] * len(urls)
+        errors = []
+        todo = list(enumerate(urls))
+        todo_lock = threading.Lock()
+        def work():
+            while True:
+                with todo_lock:
+                    if not todo or errors:
+                        return
+                    i, url = todo.pop(0)
+                try:
+                    results[i] = get(url)
+                except Exception, e:
+                    errors.append(e)
+        threads = [threading.Thread(target=work)
+                   for i in range(min(self.max_connections, len(urls)) - 1)]
+        for thread in threads:
+            thread.start()
+        work()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        return results
+
+    def GetRange(self, url, start, stop):
+        '''
+        Returns bytes start to stop of url, with a range request unless the
+        whole file is cached.  Returns fewer bytes past the end of the file.
+        '''
+        if stop <= start:
+            return ''
+        if self.cache is not None:
+            data = self.cache.get(url)
+            if data is not None:
+                return data[start:stop]
+        status, headers, body = self._request(url, {'Range': 'bytes=%d-%d'%(start, stop - 1)})
+        if status == 206:
+            return body
+        if status == 200:
+            # the server sent the whole file
+            if self.cache is not None:
+                self.cache.put(url, body)
+            return body[start:stop]
+        if status == 416:
+            return ''
+        raise IOError('Image not found: "%s" (HTTP %d)'%(url, status))
+
+    def GetSize(self, url):
+        ''' Returns the size of the file at url. '''
+        if self.cache is not None:
+            filename = self.cache.path(url)
+            if filename is not None:
+                return os.path.getsize(filename)
+        status, headers, body = self._request(url, {'Range': 'bytes=0-0'})
+        if status == 206 and '/' in headers.get('content-range', ''):
+            return int(headers['content-range'].split('/')[-1])
+        if status == 200:
+            if self.cache is not None:
+                self.cache.put(url, body)
+            return len(body)
+        raise IOError('Image not found: "%s" (HTTP %d)'%(url, status))
+
+    def Open(self, url):
+        ''' Returns a RangeFile of url. '''
+        return RangeFile(self, url)
+
+    def close(self):
+        ''' Closes the idle connections. '''
+        with self.lock:
+            for conns in self.idle.values():
+                for conn in conns:
+                    conn.close()
+            self.idle = {}
+
+
+class RangeFile(object):
+    '''
+    A read-only file-like object of a file on a web server, which fetches
+    the blocks of the file that are read with range requests.
+    '''
+    def __init__(self, fetcher, url, block_size=RANGE_BLOCK_SIZE):
+        self.fetcher = fetcher
+        self.url = url
+        self.block_size = block_size
+        self.size = fetcher.GetSize(url)
+        self.pos = 0
+        self.blocks = {}
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            offset += self.size
+        self.pos = max(offset, 0)
+
+    def tell(self):
+        return self.pos
+
+    def read(self, n=-1):
+        if n < 0 or self.pos + n > self.size:
+            n = max(self.size - self.pos, 0)
+        data = self.read_range(self.pos, self.pos + n)
+        self.pos += len(data)
+        return data
+
+    def prefetch(self, ranges):
+        '''
+        Fetches the blocks not yet read of the (start, stop) byte ranges,
+        each run of consecutive blocks with one request, on as many
+        connections as the fetcher has.
+        '''
+        bs = self.block_size
+        missing = set()
+        for start, stop in ranges:
+            if stop > start:
+                missing.update([b for b in range(start // bs, (stop - 1) // bs + 1)
+                                if b not in self.blocks])
+        runs = []
+        for b in sorted(missing):
+            if runs and runs[-1][1] == b:
+                runs[-1][1] = b + 1
+            else:
+                runs.append([b, b + 1])
+        if runs:
+            fetched = self.fetcher.GetMany(runs, lambda (b0, b1):
+                self.fetcher.GetRange(self.url, b0 * bs, b1 * bs))
+            for (b0, b1), data in zip(runs, fetched):
+                for b in range(b0, b1):
+                    self.blocks[b] = data[(b - b0) * bs:(b - b0 + 1) * bs]
+
+    def read_range(self, start, stop):
+        ''' Returns bytes start to stop, fetching the blocks not yet read. '''
+        if stop <= start:
+            return ''
+        bs = self.block_size
+        first, last = start // bs, (stop - 1) // bs
+        self.prefetch([(start, stop)])
+        data = ''.join([self.blocks[b] for b in range(first, last + 1)])
+        return data[start - first * bs:stop - first * bs]
+
+    def close(self):
+        # there is no connection to close, and the blocks read stay
+        # available to read_range
+        pass
+
+
+_fetcher = None
+
+def http_fetcher():
+    '''
+    Returns the HTTPFetcher for image files, with a disk cache in the
+    image_http_cache_dir property if it is set.  The fetcher is replaced if
+    the cache properties have changed.
+    '''
+    from properties import Properties
+    p = Properties.getInstance()
+    global _fetcher
+    directory = p.image_http_cache_dir or None
+    max_bytes = int(float(p.image_http_cache_mb) * 2**20)
+    connections = int(p.image_http_connections)
+    if (_fetcher is None or _fetcher.max_connections != connections or
+        (_fetcher.cache and _fetcher.cache.directory) != directory or
+        (_fetcher.cache and _fetcher.cache.max_bytes) != (directory and max_bytes)):
+        if _fetcher is not None:
+            _fetcher.close()
+        cache = DiskCache(directory, max_bytes) if directory else None
+        _fetcher = HTTPFetcher(cache, connections)
+    return _fetcher
@@ -0,0 +1,194 @@
+'''
+A thread-safe least recently used cache of image channels bounded by bytes.
+
+Each channel of an image is a separate entry keyed by (imKey, channel), so
+a viewer that only needs some channels doesn't evict the others' budget.
+Images can be pinned (eg: while shown in an ImageViewer) so they are never
+evicted.  Entries evicted from memory can optionally be spilled as float32
+.npy files into a directory on a fast local disk, which is itself an LRU
+bounded by bytes; a spilled entry is moved back into memory when it is
+next requested.
+'''
+from collections import OrderedDict
+import hashlib
+import logging
+import os
+import threading
+import numpy as np
+
+
+class ImageCache(object):
+    '''
+    max_bytes: the most bytes of channel data to hold in memory
+    min_images: the number of images to keep in memory regardless of their
+        size, eg: so all the images of a plate montage stay loaded
+    spill_dir: directory to spill evicted channels to, or None
+    spill_bytes: the most bytes to keep in spill_dir
+    '''
+    def __init__(self, max_bytes, min_images=1, spill_dir=None, spill_bytes=0):
+        self.lock = threading.RLock()
+        self.max_bytes = max_bytes
+        self.min_images = min_images
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.pinned = {}
+        self.channels = {}
+        self.spill_dir = spill_dir
+        self.spill_bytes = spill_bytes
+        self.spilled = OrderedDict()
+        self.spilled_nbytes = 0
+        if spill_dir and spill_bytes > 0 and not os.path.isdir(spill_dir):
+            os.makedirs(spill_dir)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.spill_hits = 0
+
+    def get(self, imKey, channel):
+        ''' Returns the cached channel array or None. '''
+        key = (tuple(imKey), channel)
+        with self.lock:
+            if key in self.entries:
+                data = self.entries.pop(key)
+                self.entries[key] = data
+                self.hits += 1
+                return data
+            data = self._unspill(key)
+            if data is not None:
+                self.spill_hits += 1
+                self._insert(key, data)
+                return data
+            self.misses += 1
+            return None
+
+    def get_image(self, imKey):
+        '''
+        Returns the list of channel arrays of an image stored with put_image,
+        or None if any of them isn't cached.
+        '''
+        with self.lock:
+            nchannels = self.channels.get(tuple(imKey), None)
+            if nchannels is None:
+                self.misses += 1
+                return None
+            imgs = []
+            for channel in range(nchannels):
+                data = self.get(imKey, channel)
+                if data is None:
+                    return None
+                imgs.append(data)
+            return imgs
+
+    def has_image(self, imKey):
+        ''' Returns whether all channels of an image are in memory. '''
+        imKey = tuple(imKey)
+        with self.lock:
+            nchannels = self.channels.get(imKey, None)
+            return (nchannels is not None and 
+                    all([(imKey, c) in self.entries for c in range(nchannels)]))
+
+    def put(self, imKey, channel, data):
+        key = (tuple(imKey), channel)
+        with self.lock:
+            if key in self.entries:
+                self.nbytes -= self.entries.pop(key).nbytes
+            self._insert(key, data)
+
+    def put_image(self, imKey, imgs):
+        ''' Caches each channel array in the list imgs. '''
+        with self.lock:
+            self.channels[tuple(imKey)] = len(imgs)
+            for channel, data in enumerate(imgs):
+                self.put(imKey, channel, data)
+
+    def pin(self, imKey):
+        ''' Keeps an image from being evicted until unpin is called. '''
+        imKey = tuple(imKey)
+        with self.lock:
+            self.pinned[imKey] = self.pinned.get(imKey, 0) + 1
+
+    def unpin(self, imKey):
+        imKey = tuple(imKey)
+        with self.lock:
+            count = self.pinned.get(imKey, 0) - 1
+            if count > 0:
+                self.pinned[imKey] = count
+            else:
+                self.pinned.pop(imKey, None)
+            self._evict()
+
+    def clear(self):
+        ''' Empties the memory and spill tiers. Pins are kept. '''
+        with self.lock:
+            self.entries.clear()
+            self.channels.clear()
+            self.nbytes = 0
+            for key in self.spilled.keys():
+                self._remove_spilled(key)
+
+    def stats(self):
+        ''' Returns a dict of the cache counters and sizes. '''
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'spill_hits': self.spill_hits,
+                    'entries': len(self.entries), 'bytes': self.nbytes,
+                    'spilled_entries': len(self.spilled),
+                    'spilled_bytes': self.spilled_nbytes}
+
+    def _insert(self, key, data):
+        self.entries[key] = data
+        self.nbytes += data.nbytes
+        self._evict()
+
+    def _evict(self):
+        if self.nbytes <= self.max_bytes:
+            return
+        images = set([key[0] for key in self.entries])
+        for key in self.entries.keys():
+            if self.nbytes <= self.max_bytes or len(images) <= self.min_images:
+                break
+            if key[0] in self.pinned:
+                continue
+            data = self.entries.pop(key)
+            self.nbytes -= data.nbytes
+            self.evictions += 1
+            if not [k for k in self.entries if k[0] == key[0]]:
+                images.discard(key[0])
+            self._spill(key, data)
+
+    def _spill_path(self, key):
+        return os.path.join(self.spill_dir, hashlib.sha1(repr(key)).hexdigest() + '.npy')
+
+    def _spill(self, key, data):
+        if not self.spill_dir or data.nbytes > self.spill_bytes:
+            return
+        if key in self.spilled:
+            self._remove_spilled(key)
+        try:
+            np.save(self._spill_path(key), np.asarray(data, np.float32))
+        except (IOError, OSError), e:
+            logging.error('Could not spill image %s channel %s to %s: %s'%(key[0], key[1], self.spill_dir, e))
+            return
+        self.spilled[key] = data.nbytes
+        self.spilled_nbytes += data.nbytes
+        while self.spilled_nbytes > self.spill_bytes:
+            self._remove_spilled(iter(self.spilled).next())
+
+    def _unspill(self, key):
+        if key not in self.spilled:
+            return None
+        path = self._spill_path(key)
+        try:
+            data = np.load(path)
+        except (IOError, OSError, ValueError), e:
+            logging.error('Could not read spilled image %s channel %s: %s'%(key[0], key[1], e))
+            data = None
+        self._remove_spilled(key)
+        return data
+
+    def _remove_spilled(self, key):
+        self.spilled_nbytes -= self.spilled.pop(key)
+        try:
+            os.remove(self._spill_path(key))
+        except OSError:
+            pass
@@ -1,16 +1,22 @@
 import wx
 import imagetools
+from collections import OrderedDict
 from properties import Properties
 
 p = Properties.getInstance()
 
+# width of the squares that tiled ImagePanels render, in display pixels
+RENDER_TILE_SIZE = 256
+# how many rendered squares each tiled ImagePanel keeps
+MAX_RENDER_TILES = 64
+
 class ImagePanel(wx.Panel):
     '''
     ImagePanels are wxPanels that display a wxBitmap and store multiple
     image channels which can be recombined to mix different bitmaps.
     '''
     def __init__(self, images, channel_map, parent, 
-                 scale=1.0, brightness=1.0, contrast=None):
+                 scale=1.0, brightness=1.0, contrast=None, tiled=False):
         """
         images -- list of numpy arrays
         channel_map -- list of strings naming the color to map each channel 
@@ -18,47 +24,99 @@ class ImagePanel(wx.Panel):
         parent -- parent window to the wx.Panel
         scale -- factor to scale image by
         brightness -- factor to scale image pixel intensities by
+        tiled -- whether to render only the parts of the image that are
+                 painted, in squares (see imagetools.RenderRegion), rather
+                 than the whole bitmap.  For large images in scrolled
+                 windows.
         
         """
         self.chMap       = channel_map
         self.toggleChMap = channel_map[:]
         self.images      = images
-        # Displayed bitmap
-        self.bitmap      = imagetools.MergeToBitmap(images,
-                               chMap = channel_map,
-                               scale = scale,
-                               brightness = brightness,
-                               contrast = contrast)
-        
-        wx.Panel.__init__(self, parent, wx.NewId(), size=self.bitmap.Size)
-        
+        self.tiled       = tiled
         self.scale         = scale
         self.brightness    = brightness
         self.contrast      = contrast
+        # Displayed bitmap, or the recently rendered squares if tiled
+        self.bitmap      = None
+        self.render_tiles = OrderedDict()
+        if not tiled:
+            self.bitmap = imagetools.MergeToBitmap(images,
+                                                   chMap = channel_map,
+                                                   scale = scale,
+                                                   brightness = brightness,
+                                                   contrast = contrast)
+
+        wx.Panel.__init__(self, parent, wx.NewId(), size=self.DisplaySize())
+
         self.selected      = False
         
         self.Bind(wx.EVT_PAINT, self.OnPaint)
         
+    def DisplaySize(self):
+        ''' Returns the (width, height) of the displayed image. '''
+        if self.bitmap is not None:
+            return (self.bitmap.Width, self.bitmap.Height)
+        h, w = self.images[0].shape
+        return (max(int(w * self.scale), 1), max(int(h * self.scale), 1))
+
+    def GetBitmap(self):
+        ''' Returns a bitmap of the whole displayed image. '''
+        if self.bitmap is not None:
+            return self.bitmap
+        return imagetools.MergeToBitmap(self.images,
+                                        chMap = self.chMap,
+                                        brightness = self.brightness,
+                                        scale = self.scale,
+                                        contrast = self.contrast)
+
     def OnPaint(self, evt):
-        self.SetClientSize((self.bitmap.Width, self.bitmap.Height))
+        width, height = self.DisplaySize()
+        self.SetClientSize((width, height))
         dc = wx.PaintDC(self)
-        dc.Clear()
-        dc.DrawBitmap(self.bitmap, 0, 0)
+        if self.tiled:
+            self.PaintTiles(dc)
+        else:
+            dc.Clear()
+            dc.DrawBitmap(self.bitmap, 0, 0)
         # Outline the whole image
         if self.selected:
             dc.BeginDrawing()
             dc.SetPen(wx.Pen("WHITE",1))
             dc.SetBrush(wx.Brush("WHITE", style=wx.TRANSPARENT))
-            dc.DrawRectangle(0,0,self.bitmap.Width,self.bitmap.Height)
+            dc.DrawRectangle(0,0,width,height)
             dc.EndDrawing()
         return dc
 
+    def PaintTiles(self, dc):
+        ''' Draws the squares of the image that intersect the update region. '''
+        width, height = self.DisplaySize()
+        box = self.GetUpdateRegion().GetBox()
+        size = RENDER_TILE_SIZE
+        for ty in range(max(box.y, 0) // size, min(box.y + box.height, height - 1) // size + 1):
+            for tx in range(max(box.x, 0) // size, min(box.x + box.width, width - 1) // size + 1):
+                bitmap = self.render_tiles.pop((tx, ty), None)
+                if bitmap is None:
+                    bbox = (tx * size, ty * size,
+                            min((tx + 1) * size, width), min((ty + 1) * size, height))
+                    bitmap = imagetools.RenderRegion(self.images, self.chMap, bbox,
+                                                     brightness = self.brightness,
+                                                     scale = self.scale,
+                                                     contrast = self.contrast)
+                self.render_tiles[(tx, ty)] = bitmap
+                dc.DrawBitmap(bitmap, tx * size, ty * size)
+        while len(self.render_tiles) > MAX_RENDER_TILES:
+            self.render_tiles.popitem(last=False)
+
     def UpdateBitmap(self):
-        self.bitmap = imagetools.MergeToBitmap(self.images,
-                                               chMap = self.chMap,
-                                               brightness = self.brightness,
-                                               scale = self.scale,
-                                               contrast = self.contrast)
+        if self.tiled:
+            self.render_tiles.clear()
+        else:
+            self.bitmap = imagetools.MergeToBitmap(self.images,
+                                                   chMap = self.chMap,
+                                                   brightness = self.brightness,
+                                                   scale = self.scale,
+                                                   contrast = self.contrast)
         self.Refresh()
             
     
@@ -66,12 +124,12 @@ class ImagePanel(wx.Panel):
         ''' Recalculates the displayed bitmap for a new channel-color map. '''
         self.chMap = chMap
         self.UpdateBitmap()
-        
+
     def SetScale(self, scale):
         if scale != self.scale:
             self.scale = scale
             self.UpdateBitmap()
-            self.SetClientSize((self.bitmap.Width, self.bitmap.Height))
+            self.SetClientSize(self.DisplaySize())
 
     def SetBrightness(self, brightness):
         if brightness != self.brightness:
@@ -0,0 +1,205 @@
+'''
+Background prefetching of full images for the image viewer.
+
+ImagePrefetcher reads predicted images into the image cache (see
+imagetools.FetchImage) on a few background threads, so that they are
+ready when the user opens them.  The queue of images to read is bounded,
+and newer predictions go ahead of older ones, which are dropped first.
+
+PrefetchAround(imKey) queues the images likely to be opened after imKey:
+the next and previous images and the other images of its well.
+PrefetchObjectImages(obKeys) queues the images of objects, eg: of the tiles
+in Classifier's bins, behind any other predictions.
+The image_prefetch property sets how many images are predicted, and how many
+may be queued when object images are added.
+'''
+from __future__ import with_statement
+from collections import deque
+import bisect
+import logging
+import threading
+from datamodel import DataModel
+from dbconnect import DBConnect, UniqueImageClause, well_key_columns
+from properties import Properties
+
+db = DBConnect.getInstance()
+p = Properties.getInstance()
+
+# number of threads reading images
+PREFETCH_THREADS = 2
+# number of images that may be queued
+MAX_PENDING = 32
+
+class ImagePrefetcher(object):
+    '''
+    fetch: function(imKey) reading an image into the cache, called from the
+        prefetch threads
+    nthreads: number of prefetch threads
+    max_pending: number of images that may be queued
+    '''
+    def __init__(self, fetch, nthreads=PREFETCH_THREADS, max_pending=MAX_PENDING):
+        self.fetch = fetch
+        self.max_pending = max_pending
+        self.cv = threading.Condition()
+        self.pending = deque()
+        self.active = set()
+        self._want_abort = False
+        self.threads = []
+        for i in range(nthreads):
+            thread = threading.Thread(target=self.run, name='ImagePrefetcher-%d'%(i))
+            thread.setDaemon(True)
+            thread.start()
+            self.threads.append(thread)
+
+    def Prefetch(self, imKeys, first=True, max_pending=None):
+        '''
+        Queues images to be read, ahead of those already queued if first,
+        otherwise behind them.  Images being read are skipped.  Images
+        beyond max_pending (default: self.max_pending) are dropped from the
+        back of the queue.
+        '''
+        if max_pending is None:
+            max_pending = self.max_pending
+        imKeys = [tuple(imKey) for imKey in imKeys]
+        with self.cv:
+            queued = set()
+            pending = []
+            if first:
+                order = imKeys + list(self.pending)
+            else:
+                order = list(self.pending) + imKeys
+            for imKey in order:
+                if imKey not in queued and imKey not in self.active:
+                    queued.add(imKey)
+                    pending.append(imKey)
+            self.pending = deque(pending[:max_pending])
+            self.cv.notifyAll()
+
+    def Pending(self):
+        ''' Returns the list of queued images. '''
+        with self.cv:
+            return list(self.pending)
+
+    def Clear(self):
+        ''' Drops the queued images. '''
+        with self.cv:
+            self.pending.clear()
+
+    def run(self):
+        while True:
+            with self.cv:
+                while not self._want_abort and not self.pending:
+                    self.cv.wait()
+                if self._want_abort:
+                    break
+                imKey = self.pending.popleft()
+                self.active.add(imKey)
+            try:
+                self.fetch(imKey)
+            except Exception, e:
+                logging.error('Error prefetching image %s: %s'%(imKey, e))
+            with self.cv:
+                self.active.discard(imKey)
+        db.CloseConnection()
+        logging.info('%s aborted'%threading.currentThread().getName())
+
+    def abort(self):
+        with self.cv:
+            self._want_abort = True
+            self.pending.clear()
+            self.cv.notifyAll()
+
+
+def _fetch_image(imKey):
+    import imagetools
+    import tilecollection
+    if imagetools.image_cache().has_image(imKey):
+        return
+    # like the TileLoader, wait while the classifier is training
+    with tilecollection.load_lock().shared():
+        imagetools.FetchImage(imKey)
+
+_prefetcher = None
+
+def image_prefetcher():
+    ''' Returns the shared ImagePrefetcher, which reads with FetchImage. '''
+    global _prefetcher
+    if _prefetcher is None:
+        _prefetcher = ImagePrefetcher(_fetch_image)
+    return _prefetcher
+
+
+# sorted image keys and the images of each well, see PredictImages
+_image_keys = None
+_wells = None
+
+def PredictImages(imKey, n):
+    '''
+    Returns up to n images likely to be opened after imKey, most likely
+    first: the next image, the other images of its well, and then the
+    images around it.
+    '''
+    global _image_keys, _wells
+    imKey = tuple(imKey)
+    if _image_keys is None:
+        _image_keys = sorted(DataModel.getInstance().GetAllImageKeys())
+    if _wells is None:
+        _wells = ({}, {})
+        if well_key_columns():
+            res = db.execute('SELECT %s, %s FROM %s'%(UniqueImageClause(),
+                             ','.join(well_key_columns()), p.image_table))
+            nkeycols = len(imKey)
+            for row in res:
+                key = tuple([int(k) for k in row[:nkeycols]])
+                well = tuple(row[nkeycols:])
+                _wells[0][key] = well
+                _wells[1].setdefault(well, []).append(key)
+    i = bisect.bisect_left(_image_keys, imKey)
+    after = _image_keys[i + 1:i + 1 + n] if i < len(_image_keys) and _image_keys[i] == imKey \
+            else _image_keys[i:i + n]
+    before = _image_keys[max(i - n, 0):i][::-1]
+    well = _wells[0].get(imKey, None)
+    same_well = sorted(_wells[1].get(well, [])) if well is not None else []
+    # the rest of the well from imKey on, then the start of the well
+    j = bisect.bisect_right(same_well, imKey)
+    same_well = same_well[j:] + same_well[:j]
+
+    candidates = after[:1] + same_well
+    for a, b in map(None, after[1:], before):
+        candidates += [k for k in (b, a) if k is not None]
+    predicted = []
+    for key in candidates:
+        if key != imKey and key not in predicted:
+            predicted.append(key)
+            if len(predicted) == n:
+                break
+    return predicted
+
+def PrefetchAround(imKey):
+    ''' Queues the images predicted after imKey, see PredictImages. '''
+    n = int(p.image_prefetch)
+    if n <= 0 or imKey is None:
+        return
+    try:
+        predicted = PredictImages(imKey, n)
+    except Exception, e:
+        logging.error('Could not predict the images after %s: %s'%(imKey, e))
+        return
+    image_prefetcher().Prefetch(predicted)
+
+def PrefetchObjectImages(obKeys):
+    '''
+    Queues the images of the given objects behind other predictions, as
+    long as no more than image_prefetch images are queued, so that they
+    don't push the viewer's images out of the image cache.
+    '''
+    n = int(p.image_prefetch)
+    if n <= 0:
+        return
+    imKeys = []
+    for obKey in obKeys:
+        if tuple(obKey[:-1]) not in imKeys:
+            imKeys.append(tuple(obKey[:-1]))
+            if len(imKeys) == n:
+                break
+    image_prefetcher().Prefetch(imKeys, first=False, max_pending=n)
@@ -0,0 +1,113 @@
+'''
+Multi-resolution pyramids of image channels, so that a large image shown
+zoomed out is sampled from a level close to the display resolution rather
+than from the full image.
+'''
+import threading
+import weakref
+from collections import OrderedDict
+import numpy as np
+from imagestats import ChannelStats
+
+class ImagePyramid(object):
+    '''
+    The levels of an image channel, each half the width and height of the
+    one before.  Level 0 is the channel itself, the others are built by
+    averaging 2x2 pixel blocks the first time they are needed.
+    stats is the ChannelStats of the channel, which the display contrast of
+    every level is taken from.
+    '''
+    def __init__(self, channel, stats=None):
+        self.levels = [channel]
+        self.stats = stats or ChannelStats.FromChannel(channel)
+        lo, hi = self.stats.interval()
+        # like auto_contrast, binary images aren't contrast stretched
+        self.binary = not np.any((channel > lo) & (channel < hi))
+        self.lock = threading.Lock()
+
+    @property
+    def shape(self):
+        return self.levels[0].shape
+
+    @property
+    def nbytes(self):
+        ''' The size of the levels built from the channel. '''
+        return sum([level.nbytes for level in self.levels[1:]])
+
+    def level(self, n):
+        ''' Returns level n, building it and the levels before if needed. '''
+        with self.lock:
+            while len(self.levels) <= n:
+                im = self.levels[-1]
+                h, w = im.shape
+                # repeat the last row and column of odd sized levels
+                if h % 2 or w % 2:
+                    im = np.pad(im, ((0, h % 2), (0, w % 2)), 'edge')
+                im = im.astype(np.float32)
+                self.levels.append((im[0::2, 0::2] + im[1::2, 0::2] +
+                                    im[0::2, 1::2] + im[1::2, 1::2]) / 4)
+            return self.levels[n]
+
+    def level_for_scale(self, scale):
+        '''
+        Returns the smallest level with at least the resolution of the
+        channel displayed at the given scale.
+        '''
+        n = 0
+        h, w = self.shape
+        while scale * 2 ** (n + 1) <= 1 and min(h, w) > 2 ** (n + 1):
+            n += 1
+        return n
+
+    def region(self, scale, (x0, y0, x1, y1)):
+        '''
+        Returns the region (x0, y0, x1, y1) of the channel displayed at the
+        given scale, in display pixels, as sampled from the nearest level.
+        Display pixels are mapped to the nearest pixel, as wx.Image.Rescale
+        does, and pixels past the edge of the channel repeat the edge.
+        '''
+        n = self.level_for_scale(scale)
+        im = self.level(n)
+        factor = float(scale * 2 ** n)
+        ys = ((np.arange(y0, y1) + 0.5) / factor).astype(int).clip(0, im.shape[0] - 1)
+        xs = ((np.arange(x0, x1) + 0.5) / factor).astype(int).clip(0, im.shape[1] - 1)
+        return im[ys[:, np.newaxis], xs[np.newaxis, :]]
+
+
+# pyramids of image channels, see GetPyramid
+_pyramids = OrderedDict()
+_pyramids_nbytes = 0
+_pyramids_lock = threading.Lock()
+MAX_PYRAMID_BYTES = 256 * 2**20
+
+def GetPyramid(channel):
+    '''
+    Returns the ImagePyramid of a channel array, which is shared for as
+    long as the array is alive.  The least recently used pyramids are
+    dropped once their levels add up to more than MAX_PYRAMID_BYTES.
+    The channel's stats attribute is used if it has one (see
+    imagetools.ImageChannel).
+    '''
+    global _pyramids_nbytes
+    key = id(channel)
+    with _pyramids_lock:
+        entry = _pyramids.pop(key, None)
+        if entry is not None and entry[0]() is channel:
+            pyramid, nbytes = entry[1], entry[2]
+            # account for levels built since the pyramid was last used
+            _pyramids_nbytes += pyramid.nbytes - nbytes
+            _pyramids[key] = (entry[0], pyramid, pyramid.nbytes)
+            _evict()
+            return pyramid
+        if entry is not None:
+            _pyramids_nbytes -= entry[2]
+    pyramid = ImagePyramid(channel, getattr(channel, 'stats', None))
+    with _pyramids_lock:
+        _pyramids[key] = (weakref.ref(channel), pyramid, 0)
+        _evict()
+    return pyramid
+
+def _evict():
+    global _pyramids_nbytes
+    while _pyramids_nbytes > MAX_PYRAMID_BYTES and len(_pyramids) > 1:
+        _pyramids_nbytes -= _pyramids.popitem(last=False)[1][2]
@@ -1,120 +1,30 @@
-import wx
+from __future__ import with_statement
 import numpy as np
 import urllib2
-import urllib
 import os.path
 import logging
+import tempfile
+import threading
+from httpfetcher import http_fetcher
 from properties import Properties
 
 p = Properties.getInstance()
 
 class ImageReader(object):
-    def __init__(self):
-        self.load_using_bioformats = None
-        try:
-            from bioformats import load_using_bioformats
-            logging.debug('ImageReader will use load_using_bioformats from CellProfiler.')
-            self.load_using_bioformats = load_using_bioformats
-        except ImportError:
-            import traceback
-            logging.error(traceback.format_exc())
-            logging.error('ImageReader failed to import load_using_bioformats from '
-                          'CellProfiler, will fall back on PIL and TiffFile.')
+    '''Reads images with the decoders chosen for each file by
+    choose_decoders.  The decoders are shared by the ImageReaders of each
+    thread, and bioformats (and its Java VM) is only loaded the first time a
+    file needs it, so ImageReaders are cheap to construct.'''
 
     def ReadImages(self, fds):
         '''fds -- list of file descriptors (filenames or urls)
         returns a list of channels as numpy float32 arrays
         '''
-        if self.load_using_bioformats is not None:
-            return self.read_images_via_cp(fds)
-        else:
-            return self.read_images_old_way(fds)
-        
-    def read_images_via_cp(self, fds):
-        '''Uses CellProfiler's LoadImagesImageProvider to load images.
-        fds -- list of file descriptors (filenames or urls)
-        returns a list of channels as numpy float32 arrays
-        '''
-        assert self.load_using_bioformats is not None
         channels = []
+        self.prefetch_remote_data(fds)
         for i, fd in enumerate(fds):
-            if p.image_url_prepend and p.image_url_prepend.lower().startswith('http://'):
-                url, ignored_headers = urllib.urlretrieve('http://' + urllib2.quote(p.image_url_prepend[7:]) + urllib2.quote(fd))
-            else:
-                url = fd
-            logging.info('Loading image from "%s"'%(url))
-            image = self.load_using_bioformats(url)
+            planes = self.ReadFile(fd)
 
-            # Got 1 channel, expected more
-            if image.ndim == 2 and p.channels_per_image[i] != '1':
-                raise Exception('CPA found %d channels in the "%s" image at '
-                                '%s, but it was expecting %s as specified '
-                                'by properties field channels_per_image. '
-                                'Please update the channels_per_image field '
-                                'in your properties file, or make sure your '
-                                'images are in the right format.'
-                                %(1, 
-                                  p.image_names[i],
-                                  fd,
-                                  p.channels_per_image[i]))
-            
-            # Got fewer channels than expected
-            elif image.ndim > 2 and image.shape[2] < int(p.channels_per_image[i]):
-                raise Exception('CPA found %d channels in the "%s" image at '
-                                '%s, but it was expecting %s as specified '
-                                'by properties field channels_per_image. '
-                                'Please update the channels_per_image field '
-                                'in your properties file, or make sure your '
-                                'images are in the right format.'
-                                %(image.shape[2], 
-                                  p.image_names[i],
-                                  fd,
-                                  p.channels_per_image[i]))
-            
-            # Got more channels than expected (load the first ones & warn)
-            elif image.ndim > 2 and image.shape[2] > int(p.channels_per_image[i]):
-                logging.warn('WARNING: CPA found %d channels in the "%s" image '
-                             'at %s, but it will only load the first %s as '
-                             'specified by properties field channels_per_image.'
-                             %(image.shape[2], 
-                               p.image_names[i],
-                               fd,
-                               p.channels_per_image[i]))
-                channels += [image[:,:,i] for i in range(int(p.channels_per_image[i]))]
-
-            # Got as many channels as expected
-            else:
-                if image.ndim == 2:
-                    channels += [image]
-                else:
-                    channels += [image[:,:,i] for i in range(image.shape[2])]
-                
-        # Check if any images need to be rescaled, and if they are the same
-        # aspect ratio. If so, do the scaling.
-        from imagetools import check_image_shape_compatibility
-        check_image_shape_compatibility(channels)
-        if p.image_rescale:
-            from imagetools import rescale
-            for i in range(len(channels)):
-                if channels[i].shape != p.image_rescale:
-                    channels[i] = rescale(channels[i], (p.image_rescale[1], p.image_rescale[0]))
-
-        return channels
-    
-    def read_images_old_way(self, fds):
-        '''fds -- list of file descriptors (filenames or urls)
-        returns a list of channels as numpy float32 arrays
-        '''
-        channels = []
-        for i, fd in enumerate(fds):
-            format = fd.split('.')[-1]
-            if format.upper() in ['TIF', 'TIFF', 'BMP', 'JPG', 'JPEG', 'PNG', 'GIF', 'C01']:
-                planes = self.ReadBitmap(fd)
-            elif format.upper() in ['DIB']:
-                planes = [self.ReadDIB(fd)]
-            else:
-                logging.error('Image format (%s) not supported. Skipping image "%s".'%(format, fds))
-            
             # Got fewer channels than expected
             if len(planes) < int(p.channels_per_image[i]):
                 raise Exception('CPA found %d channels in the "%s" image at '
@@ -156,73 +66,177 @@ class ImageReader(object):
 
         return channels
 
+    def ReadFile(self, fd):
+        '''Reads an image file with the first of its decoders (see
+        choose_decoders) that can.
+        returns a list of its channels as numpy float32 arrays
+        '''
+        image = ImageFile(self, fd)
+        errors = []
+        try:
+            for name in choose_decoders(fd, image.header()):
+                decoder = get_decoder(name)
+                if decoder is None:
+                    continue
+                try:
+                    return decoder.read(image)
+                except Exception, e:
+                    logging.debug('The %s decoder could not read "%s": %s'%(name, fd, e))
+                    errors.append('%s: %s'%(name, e))
+        finally:
+            image.close()
+        raise Exception('Could not read image "%s" (%s)'%
+                        (fd, '; '.join(errors) or 'format not supported'))
+
+    def ReadRegions(self, fds, bboxes, stats=None):
+        '''fds -- list of file descriptors (filenames or urls) of the channels
+                  of an image
+        bboxes -- list of (x0, y0, x1, y1) pixel regions of the image
+        stats -- the ChannelStats of the image's channels, if known (see
+                 read_regions)
+        returns a list with, for each bbox, a list of channels as numpy
+        float32 arrays of the bbox's size, with 0 outside the image.  Only the
+        parts of the files holding the regions are read.  Returns None if
+        that isn't possible for all of the files (see read_regions), in which
+        case the whole images must be read.
+        '''
+        if p.image_rescale:
+            return None
+        regions = [[] for bbox in bboxes]
+        for i, fd in enumerate(fds):
+            # read_regions only reads single channel files
+            if int(p.channels_per_image[i]) != 1:
+                return None
+            planes = self.read_regions(fd, bboxes, stats and stats[i])
+            if planes is None:
+                return None
+            for region, plane in zip(regions, planes):
+                region.append(plane)
+        return regions
+
+    def read_region(self, fd, bbox):
+        '''Reads the region bbox = (x0, y0, x1, y1) of an image file.
+        returns a list of channels as numpy float32 arrays of the bbox's
+        size, with 0 outside the image.
+        Uncompressed TIFFs are read with read_regions, other files are read
+        whole and cropped.
+        '''
+        planes = self.read_regions(fd, [bbox])
+        if planes is not None:
+            return planes
+        channels = self.ReadFile(fd)
+        return [crop_region(lambda ys, xs: im[ys, xs], im.shape, bbox)
+                for im in channels]
+
+    def read_regions(self, fd, bboxes, stats=None):
+        '''Reads the regions (x0, y0, x1, y1) in bboxes of a single channel,
+        uncompressed TIFF by memory-mapping only the strips or tiles that they
+        cover.  Remote TIFFs are read from the http disk cache, or if the
+        image_http_ranges property is set, by fetching only those strips or
+        tiles with range requests.
+        The regions are scaled as ReadBitmap scales the whole image, which
+        for 16 bit images depends on the image's maximum: stats, the
+        ChannelStats of the whole image, tell it unless the file has a
+        MaxSampleValue tag (see bitmap_scale).
+        returns a list of numpy float32 arrays of the bbox sizes, or None if
+        the file isn't such a TIFF or the scale can't be told.
+        '''
+        if fd.split('.')[-1].upper() not in ['TIF', 'TIFF']:
+            return None
+        fullurl, remote = self.GetFullPath(fd)
+        source = fullurl
+        if remote:
+            fetcher = http_fetcher()
+            cached = fetcher.cache and fetcher.cache.path(fullurl)
+            if cached:
+                source = cached
+            elif p.image_http_ranges.lower() in ['yes', 'true']:
+                try:
+                    source = fetcher.Open(fullurl)
+                except IOError:
+                    return None
+            else:
+                return None
+        import tifffile
+        try:
+            tif = tifffile.TIFFfile(source)
+        except Exception:
+            return None
+        try:
+            if len(tif.pages) != 1:
+                return None
+            page = tif.pages[0]
+            dtype = np.dtype(tif.byte_order + page.dtype)
+            if (page.compression or page.predictor or page.samples_per_pixel != 1 or
+                page.is_palette or dtype.kind not in 'uf' or
+                page.bits_per_sample != dtype.itemsize * 8):
+                return None
+            # MaxSampleValue, which tifffile doesn't name
+            max_sample = page.tags['281'].value if '281' in page.tags else None
+            if dtype.kind != 'f' and dtype.itemsize > 2:
+                # ReadBitmap doesn't scale these the same way
+                return None
+            if dtype.kind != 'f' and dtype.itemsize == 2 and not max_sample and stats is None:
+                return None
+            blocks = TIFFBlocks(source, page, dtype)
+        finally:
+            tif.close()
+        regions = [crop_region(blocks.read, blocks.shape, bbox) for bbox in bboxes]
+        # normalize as ReadBitmap does
+        if dtype.kind == 'f':
+            return [region.astype(np.float32) for region in regions]
+        scale = bitmap_scale(dtype, max_sample, regions, stats)
+        if scale is None:
+            return None
+        return [region.astype(np.float32) / scale for region in regions]
+
     def ReadDIB(self, fd):
         ''' Reads a Cellomics DIB and returns the data as a float32 array
         NOTE: this function does not support multiple channels
         '''
-        buf = self.GetRawData(fd)
-        assert np.fromstring(buf[0:4], dtype='<u4')[0] == 40, 'Unexpected DIB header size.'
-        assert np.fromstring(buf[14:16], dtype='<u2')[0] == 16, 'DIB Bit depth is not 16!'
-        size = np.fromstring(buf[4:12], dtype='<u4')
-
-        # read data skipping header
-        imdata = np.fromstring(buf[52:], dtype='<u2')
-        imdata.shape = size[1], size[0]
-        imdata = imdata.astype('float32')
-
-        sixteenBit = (imdata > 4095).any()
-        if sixteenBit:
-            imdata /= 65535.0
-        else: # twelve bit
-            imdata /= 4095.0
-
-        return imdata
+        return ReadDIBData(self.GetRawData(fd))
 
     def ReadBitmap(self, fd):
         '''Reads a bitmap using PIL with a fallback to tifffile.
         Returns a list of images as numpy float32 arrays.
         '''
-        data = self.GetRawData(fd)
-        try:
-            imdata = ReadBitmapViaPIL(data)
-        except:
-            imdata = ReadBitmapViaTIFFfile(data)
+        return ReadBitmapData(self.GetRawData(fd))
 
-        channels = []
-        if type(imdata) == list:
-            # multiple channels returned
-            channels = imdata
-        else:
-            # single channel returned
-            channels = [imdata]
-        return channels
+    def GetFullPath(self, url):
+        '''Returns the full path or url of an image file and whether it is
+        loaded via http.'''
+        if p.image_url_prepend and p.image_url_prepend.lower().startswith('http://'):
+            return ('http://' + urllib2.quote(p.image_url_prepend[7:]) + urllib2.quote(url), True)
+        if p.image_url_prepend:
+            return os.path.join(p.image_url_prepend, url), False
+        # if no prepend is provided, compute the path relative to the properties file.
+        if os.path.isabs(url):
+            return url, False
+        return os.path.join(os.path.dirname(p._filename), url), False
+
+    def prefetch_remote_data(self, fds):
+        '''If images are loaded via http, fetches the files at once for
+        GetRawData.'''
+        self.fetched = {}
+        if fds and self.GetFullPath(fds[0])[1]:
+            fullurls = [self.GetFullPath(fd)[0] for fd in fds]
+            self.fetched = dict(zip(fullurls, http_fetcher().GetMany(fullurls)))
 
     def GetRawData(self, url):
         '''Opens url as a file-like object and returns the raw data.'''
-        if p.image_url_prepend and p.image_url_prepend.lower().startswith('http://'):
-            # load file via http
-            fullurl = 'http://' + urllib2.quote(p.image_url_prepend[7:]) + urllib2.quote(url)
+        fullurl, remote = self.GetFullPath(url)
+        if remote:
+            # load file via http, or take it from prefetch_remote_data
+            data = getattr(self, 'fetched', {}).pop(fullurl, None)
+            if data is not None:
+                return data
             logging.info('Opening image: %s'%fullurl)
             try:
-                stream = urllib2.urlopen(fullurl)
-            except:
+                return http_fetcher().Get(fullurl)
+            except IOError:
                 raise Exception('Image not found: "'+fullurl+'"')
-            data = ''
-            while True:
-                chunk = stream.read()
-                if len(chunk)==0:
-                    break
-                data += chunk
         else:
             # load local file
-            if p.image_url_prepend:
-                fullurl = os.path.join(p.image_url_prepend, url)
-            else:
-                # if no prepend is provided, compute the path relative to the properties file.
-                if os.path.isabs(url):
-                    fullurl = url
-                else:
-                    fullurl = os.path.join(os.path.dirname(p._filename), url)
             logging.info('Opening image: %s'%fullurl)
             try:
                 stream = open(fullurl, "rb")
@@ -234,6 +248,291 @@ class ImageReader(object):
         return data
 
     
+class TIFFBlocks(object):
+    '''The strips or tiles of an uncompressed, single channel TIFF page, which
+    are memory-mapped as they are read.  source is the filename, or the
+    httpfetcher.RangeFile of a remote file, whose blocks are fetched with
+    range requests instead.'''
+    def __init__(self, source, page, dtype):
+        self.source = source
+        self.dtype = dtype
+        self.shape = (page.image_length, page.image_width)
+        self.tiled = 'tile_offsets' in page.tags
+        if self.tiled:
+            self.block_shape = (page.tile_length, page.tile_width)
+            offsets = page.tile_offsets
+        else:
+            self.block_shape = (min(page.rows_per_strip, page.image_length), page.image_width)
+            offsets = page.strip_offsets
+        try:
+            self.offsets = list(offsets)
+        except TypeError:
+            self.offsets = [offsets]
+        self.blocks_across = (self.shape[1] + self.block_shape[1] - 1) // self.block_shape[1]
+
+    def read(self, ys, xs):
+        '''Returns the pixels in the (non-empty) row and column slices ys and
+        xs, which must lie in the image.'''
+        bh, bw = self.block_shape
+        out = np.empty((ys.stop - ys.start, xs.stop - xs.start), self.dtype)
+        blocks = [(by, bx) for by in range(ys.start // bh, (ys.stop - 1) // bh + 1)
+                  for bx in range(xs.start // bw, (xs.stop - 1) // bw + 1)]
+        remote = not isinstance(self.source, basestring)
+        if remote:
+            self.source.prefetch([self.block_range(by, bx) for by, bx in blocks])
+        for by, bx in blocks:
+            # tiles are padded, but the last strip only holds the remaining rows
+            rows = bh if self.tiled else min(bh, self.shape[0] - by * bh)
+            if remote:
+                block = np.frombuffer(self.source.read_range(*self.block_range(by, bx)),
+                                      self.dtype).reshape((rows, bw))
+            else:
+                block = np.memmap(self.source, self.dtype, 'r',
+                                  self.offsets[by * self.blocks_across + bx], (rows, bw))
+            y0, y1 = max(ys.start, by * bh), min(ys.stop, by * bh + rows)
+            x0, x1 = max(xs.start, bx * bw), min(xs.stop, bx * bw + bw)
+            out[y0 - ys.start:y1 - ys.start, x0 - xs.start:x1 - xs.start] = \
+                block[y0 - by * bh:y1 - by * bh, x0 - bx * bw:x1 - bx * bw]
+            del block
+        return out
+
+    def block_range(self, by, bx):
+        '''Returns the (start, stop) bytes of a block in the file.'''
+        bh, bw = self.block_shape
+        rows = bh if self.tiled else min(bh, self.shape[0] - by * bh)
+        start = self.offsets[by * self.blocks_across + bx]
+        return start, start + rows * bw * self.dtype.itemsize
+
+
+def bitmap_scale(dtype, max_sample, regions, stats):
+    '''Returns the number ReadBitmap divides the pixels of an integer image
+    by, or None if it can't be told without reading the whole image.
+    dtype -- the image's pixel type
+    max_sample -- the image's MaxSampleValue tag, or None
+    regions -- arrays of the unscaled pixels of regions of the image
+    stats -- the ChannelStats of the whole (scaled) image, or None
+    '''
+    if dtype.itemsize == 1:
+        return 255.
+    if dtype.itemsize != 2:
+        return None
+    if max_sample:
+        return float(max_sample)
+    if stats is None:
+        return None
+    # ReadBitmap divides by 4095 if the image's maximum is below 4096 and by
+    # 65535 otherwise.  The scale is the one that turns the scaled values in
+    # stats back into whole pixel values with a maximum that fits it, if only
+    # one does.
+    top = max([r.max() for r in regions] or [0])
+    scales = []
+    for scale, lo, hi in [(4095., 0, 4095), (65535., 4096, 65535)]:
+        values = np.array([stats.min, stats.min_positive, stats.max]) * scale
+        maximum = round(values[-1])
+        if (lo <= maximum <= hi and top <= maximum and
+            (abs(values - np.round(values)) < 1e-3 + 1e-6 * values).all()):
+            scales.append(scale)
+    if len(scales) != 1:
+        return None
+    return scales[0]
+
+def crop_region(read, shape, (x0, y0, x1, y1)):
+    '''Returns the region (x0, y0, x1, y1) of an image of the given shape as
+    a float32 array, with 0 outside the image.  read(ys, xs) must return
+    the pixels in the row and column slices ys and xs.'''
+    out = np.zeros((y1 - y0, x1 - x0), np.float32)
+    ly, hy = max(y0, 0), min(y1, shape[0])
+    lx, hx = max(x0, 0), min(x1, shape[1])
+    if ly < hy and lx < hx:
+        out[ly - y0:hy - y0, lx - x0:hx - x0] = read(slice(ly, hy), slice(lx, hx))
+    return out
+
+
+class ImageFile(object):
+    '''An image file being read, whose data or local filename are only
+    fetched when a decoder asks for them.'''
+    def __init__(self, reader, fd):
+        self.reader = reader
+        self.fd = fd
+        self.fullpath, self.remote = reader.GetFullPath(fd)
+        self._data = None
+        self._filename = None
+        self._temporary = False
+
+    def header(self, n=16):
+        '''Returns the first n bytes of the file, or '' if it can't be read.'''
+        if self.remote or self._data is not None:
+            try:
+                return self.data()[:n]
+            except Exception:
+                return ''
+        try:
+            f = open(self.fullpath, 'rb')
+            try:
+                return f.read(n)
+            finally:
+                f.close()
+        except IOError:
+            return ''
+
+    def data(self):
+        '''Returns the contents of the file.'''
+        if self._data is None:
+            self._data = self.reader.GetRawData(self.fd)
+        return self._data
+
+    def filename(self):
+        '''Returns the name of a local file with the contents of the file,
+        the cached copy of a remote file if there is one.'''
+        if not self.remote:
+            return self.fullpath
+        if self._filename is None:
+            fetcher = http_fetcher()
+            if fetcher.cache is None and self._data is not None:
+                fd, self._filename = tempfile.mkstemp(suffix=os.path.splitext(self.fd)[1])
+                try:
+                    os.write(fd, self._data)
+                finally:
+                    os.close(fd)
+                self._temporary = True
+            else:
+                self._filename, self._temporary = fetcher.GetFile(self.fullpath)
+        return self._filename
+
+    def close(self):
+        if self._temporary:
+            os.remove(self._filename)
+            self._filename = None
+            self._temporary = False
+
+
+class BitmapDecoder(object):
+    '''TIFF, PNG, JPEG, BMP and GIF files, read with PIL or tifffile.'''
+    def read(self, image):
+        return ReadBitmapData(image.data())
+
+
+class DIBDecoder(object):
+    '''Cellomics DIB files.'''
+    def read(self, image):
+        return [ReadDIBData(image.data())]
+
+
+class BioformatsDecoder(object):
+    '''Any file that bioformats reads.  Constructing one imports bioformats,
+    starts the Java VM if it isn't running and attaches the thread to it.'''
+    def __init__(self):
+        from bioformats import load_using_bioformats
+        start_java()
+        self.load_using_bioformats = load_using_bioformats
+
+    def read(self, image):
+        filename = image.filename()
+        logging.info('Loading image from "%s"'%(filename))
+        im = self.load_using_bioformats(filename)
+        if im.ndim == 2:
+            return [im]
+        return [im[:,:,i] for i in range(im.shape[2])]
+
+
+# The decoders, in the order they are tried: (name, class, file extensions,
+# file signatures).  A file is read with the decoders whose signatures its
+# header starts with, those that also match its extension first, and then
+# with the decoders of any file (no extensions or signatures).
+DECODERS = [
+    ('bitmap', BitmapDecoder, ['TIF', 'TIFF', 'PNG', 'JPG', 'JPEG', 'BMP', 'GIF', 'C01'],
+     ['II*\0', 'MM\0*', '\x89PNG', '\xff\xd8', 'BM', 'GIF8']),
+    ('dib', DIBDecoder, ['DIB'], ['(\0\0\0']),
+    ('bioformats', BioformatsDecoder, None, None),
+]
+
+def choose_decoders(fd, header):
+    '''Returns the names of the decoders to read a file with, in order.
+    fd -- the file's name or url
+    header -- the first bytes of the file
+    '''
+    ext = fd.split('.')[-1].upper()
+    matches = [(name, ext in extensions) for name, cls, extensions, signatures in DECODERS
+               if signatures and any([header.startswith(sig) for sig in signatures])]
+    return ([name for name, ext_matches in matches if ext_matches] +
+            [name for name, ext_matches in matches if not ext_matches] +
+            [name for name, cls, extensions, signatures in DECODERS if signatures is None])
+
+_decoders = threading.local()
+_unavailable_decoders = set()
+
+def get_decoder(name):
+    '''Returns this thread's instance of a decoder, or None if the decoder
+    can't be used, eg: bioformats isn't installed.'''
+    decoders = _decoders.__dict__.setdefault('decoders', {})
+    if name not in decoders:
+        if name in _unavailable_decoders:
+            return None
+        cls = [c for n, c, extensions, signatures in DECODERS if n == name][0]
+        try:
+            decoders[name] = cls()
+        except Exception:
+            if name not in _unavailable_decoders:
+                import traceback
+                logging.error(traceback.format_exc())
+                logging.error('ImageReader could not load the %s decoder.'%(name))
+            _unavailable_decoders.add(name)
+            return None
+    return decoders[name]
+
+_java_lock = threading.Lock()
+_java_started = False
+
+def start_java():
+    ''' Starts the Java VM for bioformats once, and attaches this thread to it. '''
+    global _java_started
+    from bioformats import jutil
+    with _java_lock:
+        if not _java_started:
+            jutil.start_vm([])
+            _java_started = True
+    jutil.attach()
+
+
+def ReadDIBData(buf):
+    ''' Reads the data of a Cellomics DIB and returns it as a float32 array
+    NOTE: this function does not support multiple channels
+    '''
+    assert np.fromstring(buf[0:4], dtype='<u4')[0] == 40, 'Unexpected DIB header size.'
+    assert np.fromstring(buf[14:16], dtype='<u2')[0] == 16, 'DIB Bit depth is not 16!'
+    size = np.fromstring(buf[4:12], dtype='<u4')
+
+    # read data skipping header
+    imdata = np.fromstring(buf[52:], dtype='<u2')
+    imdata.shape = size[1], size[0]
+    imdata = imdata.astype('float32')
+
+    sixteenBit = (imdata > 4095).any()
+    if sixteenBit:
+        imdata /= 65535.0
+    else: # twelve bit
+        imdata /= 4095.0
+
+    return imdata
+
+def ReadBitmapData(data):
+    '''Reads the data of a bitmap using PIL with a fallback to tifffile.
+    Returns a list of images as numpy float32 arrays.
+    '''
+    try:
+        imdata = ReadBitmapViaPIL(data)
+    except:
+        imdata = ReadBitmapViaTIFFfile(data)
+
+    channels = []
+    if type(imdata) == list:
+        # multiple channels returned
+        channels = imdata
+    else:
+        # single channel returned
+        channels = [imdata]
+    return channels
+
 def ReadBitmapViaPIL(data):
     import PIL.Image as Image
     from cStringIO import StringIO
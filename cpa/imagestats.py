@@ -0,0 +1,59 @@
+'''
+Intensity statistics of image channels, computed once when an image is
+read so that contrast stretching an image or its tiles doesn't rescan the
+pixels.
+'''
+import numpy as np
+
+NBINS = 256
+
+class ChannelStats(object):
+    '''
+    min, max: the range of the channel
+    min_positive: the smallest value above 0, or max if there is none
+    hist: NBINS pixel counts of equal bins from min to max
+    '''
+    def __init__(self, min, max, min_positive, hist):
+        self.min = float(min)
+        self.max = float(max)
+        self.min_positive = float(min_positive)
+        self.hist = np.asarray(hist, np.uint32)
+
+    @classmethod
+    def FromChannel(cls, im):
+        im = np.asarray(im)
+        lo, hi = float(im.min()), float(im.max())
+        positive = im[im > 0]
+        min_positive = float(positive.min()) if positive.size else hi
+        if hi > lo:
+            hist = np.histogram(im, NBINS, (lo, hi))[0]
+        else:
+            hist = np.zeros(NBINS, np.uint32)
+            hist[0] = im.size
+        return cls(lo, hi, min_positive, hist)
+
+    def interval(self):
+        return (self.min, self.max)
+
+    def percentile(self, q):
+        '''
+        Returns an estimate of the q-th percentile (0 to 100) of the channel
+        from its histogram.
+        '''
+        cumulative = np.cumsum(self.hist, dtype=np.float64)
+        if not cumulative[-1] or self.max <= self.min:
+            return self.min
+        target = cumulative[-1] * min(max(q, 0), 100) / 100.
+        i = min(np.searchsorted(cumulative, target), NBINS - 1)
+        below = cumulative[i - 1] if i else 0.
+        fraction = (target - below) / self.hist[i] if self.hist[i] else 0.
+        width = (self.max - self.min) / NBINS
+        return self.min + (i + fraction) * width
+
+    def __eq__(self, other):
+        return (isinstance(other, ChannelStats) and
+                (self.min, self.max, self.min_positive) == (other.min, other.max, other.min_positive) and
+                (self.hist == other.hist).all())
+
+    def __ne__(self, other):
+        return not self == other
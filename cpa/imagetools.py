@@ -7,54 +7,312 @@ import pilfix
 from properties import Properties
 import dbconnect
 from imagereader import ImageReader
+from imagecache import ImageCache
+from imagestats import ChannelStats
+from imagepyramid import GetPyramid
+from tilestore import TileStore, tile_signature
 import logging
 import matplotlib.image
 import numpy as np
+import threading
+import weakref
+from collections import OrderedDict
 import wx
 
 p = Properties.getInstance()
 db = dbconnect.DBConnect.getInstance()
 
-cache = {}
-cachedkeys = []
+_image_cache = None
+
+def image_cache():
+    '''returns the ImageCache shared by FetchImage, created from the
+    image_cache_mb, image_spill_dir and image_spill_mb properties
+    '''
+    global _image_cache
+    if _image_cache is None:
+        _image_cache = ImageCache(int(float(p.image_cache_mb) * 2**20),
+                                  min_images=int(p.image_buffer_size),
+                                  spill_dir=p.image_spill_dir or None,
+                                  spill_bytes=int(float(p.image_spill_mb) * 2**20))
+    return _image_cache
+
+_tile_store = None
+_image_plates = None
+
+def tile_store():
+    '''returns the TileStore in the tile_store_dir property, or None if it 
+    isn't set.  The store is replaced if tile_store_dir or image_tile_size
+    have changed.
+    '''
+    global _tile_store
+    if not p.tile_store_dir:
+        return None
+    if (_tile_store is None or _tile_store.directory != p.tile_store_dir or 
+        _tile_store.tile_size != int(p.image_tile_size)):
+        signature = tile_signature([p.db_type, p.db_host, p.db_name, p.db_sqlite_file, 
+                                    p.image_table, p.image_path_cols, p.image_file_cols,
+                                    p.image_url_prepend, p.channels_per_image, 
+                                    p.image_rescale, p.rescale_object_coords,
+                                    p.image_rescale_from])
+        _tile_store = TileStore(p.tile_store_dir, int(p.image_tile_size), 
+                                sum(map(int, p.channels_per_image)), signature)
+    return _tile_store
+
+def ImagePlate(imKey):
+    '''returns the plate of an image, which the tile store keeps tiles by '''
+    global _image_plates
+    if not p.plate_id:
+        return 'all'
+    if _image_plates is None:
+        res = db.execute('SELECT %s, %s FROM %s'%(dbconnect.UniqueImageClause(), 
+                                                  p.plate_id, p.image_table))
+        _image_plates = dict((tuple(row[:-1]), row[-1]) for row in res)
+    return _image_plates.get(tuple(imKey), 'all')
+
+class ImageChannel(np.ndarray):
+    '''
+    A channel of an image as returned by FetchImage.  stats is the
+    ChannelStats of the channel, or None if it isn't known.
+    '''
+    stats = None
+
+class Tile(ImageChannel):
+    '''
+    A channel of an object tile.  interval is the (min, max) intensity of
+    the channel over the whole image, so that the tiles of an image are
+    contrast-stretched alike, or None if it isn't known.  stats is the
+    ChannelStats of the channel of the whole image, or None.
+    '''
+    interval = None
+
+def MakeTiles(crops, intervals, stats=None):
+    '''returns the channel crops of an object as Tiles with the given
+    intervals, or with the intervals of the given image stats if known
+    '''
+    tiles = []
+    for c, (crop, interval) in enumerate(zip(crops, intervals)):
+        tile = crop.view(Tile)
+        if stats is not None:
+            tile.stats = stats[c]
+            interval = stats[c].interval()
+        tile.interval = interval
+        tiles.append(tile)
+    return tiles
+
+# image statistics, see ImageStats
+_image_stats = {}
+_image_stats_lock = threading.Lock()
+MAX_CACHED_STATS = 10000
+
+def ImageStats(imKey, imgs=None):
+    '''returns the list of ChannelStats of the channels of an image, from
+    memory or the tile store.  If they aren't known, they are computed from
+    the image's channel arrays imgs and stored, or None is returned if imgs
+    isn't given.
+    '''
+    imKey = tuple(imKey)
+    with _image_stats_lock:
+        stats = _image_stats.get(imKey, None)
+    if stats is not None:
+        return stats
+    store = tile_store()
+    if store is not None:
+        stats = store.get_stats(imKey)
+    if stats is None:
+        if imgs is None:
+            return None
+        stats = [ChannelStats.FromChannel(im) for im in imgs]
+        if store is not None:
+            store.put_stats(imKey, stats)
+    with _image_stats_lock:
+        if len(_image_stats) >= MAX_CACHED_STATS:
+            _image_stats.clear()
+        _image_stats[imKey] = stats
+    return stats
+
+# object coordinates, see FetchCoords
+_coords = {}
+_coords_lock = threading.Lock()
+MAX_CACHED_COORDS = 200000
+
+def FetchCoords(obKeys, prefetch=()):
+    '''returns a dict mapping those of the given objects that have
+    coordinates to them.  Coordinates are cached: those that aren't are
+    fetched in bulk, along with the coordinates of the prefetch objects, eg:
+    other objects whose tiles are about to be loaded.
+    '''
+    with _coords_lock:
+        missing = [obKey for obKey in obKeys if obKey not in _coords]
+        if missing:
+            missing += [obKey for obKey in prefetch if obKey not in _coords]
+            if len(_coords) + len(missing) > MAX_CACHED_COORDS:
+                _coords.clear()
+            fetched = db.GetObjectsCoords(missing)
+            for obKey in missing:
+                # remember objects without coordinates too
+                _coords[obKey] = fetched.get(obKey, None)
+        return dict((obKey, _coords[obKey]) for obKey in obKeys
+                    if _coords[obKey] is not None)
 
 def FetchTile(obKey):
     '''returns a list of image channel arrays cropped around the object
     coordinates
     '''
-    imKey = obKey[:-1]
-    pos = list(db.GetObjectCoords(obKey))
-    if None in pos:
+    tiles = FetchTiles([obKey])[0]
+    if tiles is None:
         message = ('Failed to load coordinates for object key %s. This may '
                    'indicate a problem with your per-object table.\n'
                    'You can check your per-object table "%s" in TableViewer'
-                   %(', '.join(['%s:%s'%(col, val) for col, val in 
-                                zip(dbconnect.object_key_columns(), obKey)]), 
+                   %(', '.join(['%s:%s'%(col, val) for col, val in
+                                zip(dbconnect.object_key_columns(), obKey)]),
                    p.object_table))
         wx.MessageBox(message, 'Error')
-        logging.error(message)
-        return None
+    return tiles
+
+def FetchTilesFromImage(imKey, obKeys):
+    '''returns a dict mapping each of the given objects of one image to a
+    list of image channel arrays cropped around it, see FetchTiles.
+    Objects without coordinates are left out.
+    '''
+    return dict((obKey, tiles) for obKey, tiles in zip(obKeys, FetchTiles(obKeys))
+                if tiles is not None)
+
+def FetchTiles(obKeys, prefetch=()):
+    '''returns a list with, for each of the given objects, the list of its
+    image channel arrays cropped around it, or None if it has no
+    coordinates.  The arrays are views into one (objects, channels, height,
+    width) array.
+    Tiles in the tile store are returned from there.  The coordinates of
+    the rest are fetched in bulk (see FetchCoords) and their tiles are
+    cropped from each image, which is read once, or if it isn't cached and
+    its files allow, only the tile regions are read from the files.
+    '''
+    obKeys = [tuple(obKey) for obKey in obKeys]
     size = (int(p.image_tile_size), int(p.image_tile_size))
-    # Could transform object coords here
+    nchannels = sum(map(int, p.channels_per_image))
+    data = np.zeros((len(obKeys), nchannels, size[1], size[0]), np.float32)
+    intervals = [None] * len(obKeys)
+
+    store = tile_store()
+    todo = []
+    for i, obKey in enumerate(obKeys):
+        stored = store.get(ImagePlate(obKey[:-1]), obKey) if store is not None else None
+        if stored is None:
+            todo.append(i)
+        else:
+            data[i] = stored[0]
+            intervals[i] = stored[1]
+
+    coords = FetchCoords([obKeys[i] for i in todo], prefetch)
+    by_image = {}
+    for i in todo:
+        obKey = obKeys[i]
+        if obKey in coords:
+            by_image.setdefault(obKey[:-1], []).append(i)
+        else:
+            logging.error('Failed to load coordinates for object key %s. This may '
+                          'indicate a problem with your per-object table "%s".'
+                          %(', '.join(['%s:%s'%(col, val) for col, val in
+                                       zip(dbconnect.object_key_columns(), obKey)]),
+                            p.object_table))
+    for imKey, rows in by_image.items():
+        positions = [ImagePosition(list(coords[obKeys[i]])) for i in rows]
+        data[rows], image_intervals = CropTilesFromImage(imKey, positions, size)
+        for i in rows:
+            intervals[i] = image_intervals
+        if store is not None:
+            store.put_many(ImagePlate(imKey), [(obKeys[i], data[i], image_intervals)
+                                               for i in rows])
+
+    return [MakeTiles(data[i], intervals[i], ImageStats(obKeys[i][:-1]))
+            if intervals[i] is not None else None
+            for i in range(len(obKeys))]
+
+def CropTilesFromImage(imKey, positions, (w,h)):
+    '''returns a (positions, channels, h, w) array of the channels of an
+    image cropped around each position, and the intervals of the channels
+    (see Tile).  Only the tile regions are read from the image files if the
+    image isn't cached, its stats are known (see ImageStats) and its files
+    allow (see ImageReader.ReadRegions).  Otherwise the whole image is read,
+    which computes its stats, so that tiles always get the scaling and
+    intervals of the whole image.
+    '''
+    stats = ImageStats(imKey)
+    if stats is not None and not image_cache().has_image(imKey):
+        bboxes = []
+        for x, y in positions:
+            # same region as Crop
+            x = int(x + 0.5) - w/2
+            y = int(y + 0.5) - h/2
+            bboxes.append((x, y, x + w, y + h))
+        filenames = db.GetFullChannelPathsForImage(imKey)
+        regions = ImageReader().ReadRegions(filenames, bboxes, stats)
+        if regions is not None:
+            return np.array(regions, np.float32), [s.interval() for s in stats]
     imgs = FetchImage(imKey)
+    crops = np.empty((len(positions), len(imgs), h, w), np.float32)
+    for c, im in enumerate(imgs):
+        crops[:, c] = CropTiles(im, (w,h), positions)
+    return crops, [im.stats.interval() for im in imgs]
+
+def ImagePosition(pos):
+    '''converts object coordinates from the database to image coordinates'''
     if p.rescale_object_coords:
         pos[0] *= p.image_rescale[0] / p.image_rescale_from[0]
         pos[1] *= p.image_rescale[1] / p.image_rescale_from[1]
-    return [Crop(im, size, pos) for im in imgs]
+    return pos
+
+# events of the images being read, see FetchImage
+_image_loads = {}
+_image_loads_lock = threading.Lock()
 
 def FetchImage(imKey):
-    global cachedkeys
-    if imKey in cache.keys():
-        return cache[imKey]
-    else:
-        ir = ImageReader()
-        filenames = db.GetFullChannelPathsForImage(imKey)
-        imgs = ir.ReadImages(filenames)                    
-        cache[imKey] = imgs
-        cachedkeys += [imKey]
-        while len(cachedkeys) > int(p.image_buffer_size):
-            del cache[cachedkeys.pop(0)]
-        return cache[imKey]
+    '''returns the list of channels of an image as ImageChannel arrays with
+    their stats (see ImageStats), which are computed when the image is read.
+    If another thread, eg: the image prefetcher, is reading the image, this
+    waits for it rather than reading the image again.
+    '''
+    imKey = tuple(imKey)
+    cache = image_cache()
+    # image_buffer_size may be raised at runtime, eg: by the plate viewer
+    cache.min_images = int(p.image_buffer_size)
+    while True:
+        imgs = cache.get_image(imKey)
+        if imgs is not None:
+            break
+        with _image_loads_lock:
+            loading = _image_loads.get(imKey, None)
+            reading = loading is None
+            if reading:
+                loading = _image_loads[imKey] = threading.Event()
+        if not reading:
+            # look in the cache again once the other read is done
+            loading.wait()
+            continue
+        try:
+            ir = ImageReader()
+            filenames = db.GetFullChannelPathsForImage(imKey)
+            return CacheImage(imKey, ir.ReadImages(filenames))
+        finally:
+            with _image_loads_lock:
+                del _image_loads[imKey]
+            loading.set()
+    # channels reloaded from the spill directory are plain arrays
+    if not all([isinstance(im, ImageChannel) for im in imgs]):
+        imgs = CacheImage(imKey, imgs)
+    return imgs
+
+def CacheImage(imKey, imgs):
+    '''wraps the channels of an image as ImageChannels with their stats and
+    puts them in the image cache'''
+    stats = ImageStats(imKey, imgs)
+    channels = []
+    for im, channel_stats in zip(imgs, stats):
+        im = np.asarray(im).view(ImageChannel)
+        im.stats = channel_stats
+        channels.append(im)
+    image_cache().put_image(imKey, channels)
+    return channels
 
 def ShowImage(imKey, chMap, parent=None, brightness=1.0, scale=1.0, contrast=None):
     from imageviewer import ImageViewer
@@ -66,6 +324,24 @@ def ShowImage(imKey, chMap, parent=None, brightness=1.0, scale=1.0, contrast=Non
     frame.Show(True)
     return frame
 
+def CropTiles(imgdata, (w,h), positions):
+    '''
+    Crops an image to the width (w,h) around each of the points (x,y) in
+    positions, returning a (positions, h, w) float32 array.
+    Area outside of the image is filled with 0.
+    '''
+    im_height, im_width = imgdata.shape
+    positions = np.asarray(positions, np.float64).reshape((-1, 2))
+    lox = (positions[:, 0] + 0.5).astype(int) - w/2
+    loy = (positions[:, 1] + 0.5).astype(int) - h/2
+    ys = loy[:, np.newaxis] + np.arange(h)
+    xs = lox[:, np.newaxis] + np.arange(w)
+    crops = imgdata[ys.clip(0, im_height - 1)[:, :, np.newaxis],
+                    xs.clip(0, im_width - 1)[:, np.newaxis, :]].astype(np.float32)
+    crops[~((ys >= 0) & (ys < im_height))[:, :, np.newaxis] |
+          ~((xs >= 0) & (xs < im_width))[:, np.newaxis, :]] = 0
+    return crops
+
 def Crop(imgdata, (w,h), (x,y)):
     '''
     Crops an image to the width (w,h) around the point (x,y).
@@ -91,17 +367,12 @@ def Crop(imgdata, (w,h), (x,y)):
 
     crop = np.zeros((h,w), dtype='float32')
     crop[dest_loy:dest_hiy, dest_lox:dest_hix] = imgdata[loy:hiy, lox:hix]
-
-    # XXX - hack to make scaling work per-image instead of per-tile
-    crop[0, 0] = imgdata.min()
-    crop[-1, -1] = imgdata.max()
-
     return crop
 
 def MergeToBitmap(imgs, chMap, brightness=1.0, scale=1.0, masks=[], contrast=None):
     '''
     imgs  - list of np arrays containing pixel data for each channel of an image
-    chMap - list of colors to map each corresponding channel onto.  
+    chMap - list of colors to map each corresponding channel onto.
             eg: ['red', 'green', 'blue']
     brightness - value around 1.0 to multiply color values by
     contrast - value around 1.0 to scale contrast by
@@ -111,87 +382,183 @@ def MergeToBitmap(imgs, chMap, brightness=1.0, scale=1.0, masks=[], contrast=Non
     blending - list, how to blend this channel with others 'add' or 'subtract'
                eg: ['add','add','add','subtract']
     '''
-    if contrast=='Log':
-        logims = [log_transform(im) for im in imgs]
-        imData = MergeChannels(logims, chMap, masks=masks)
-    elif contrast=='Linear':
-        newims = [auto_contrast(im) for im in imgs]
-        imData = MergeChannels(newims, chMap, masks=masks)
-    else:
-        imData = MergeChannels(imgs, chMap, masks=masks)
-        
     h,w = imgs[0].shape
-    
-    # Convert from float [0-1] to 8bit
-    imData *= 255.0
-    imData[imData>255] = 255
+    planes = [ChannelPlane(im, contrast) for im in imgs]
+    if masks:
+        imData = MergePlanes(planes, chMap).astype(float) / 255.0
+        for mask, func in masks:
+            imData = func(imData, mask)
+        imData *= 255.0
+        imData[imData>255] = 255
+        imData = imData.astype('uint8')
+    else:
+        imData = MergePlanes(planes, chMap, brightness)
 
-    # Write wx.Image
-    img = wx.EmptyImage(w,h)
-    img.SetData(imData.astype('uint8').flatten())
-    
-    # Apply brightness & scale
-    if brightness != 1.0:
+    # Write wx.Image without copying the merged data
+    img = wx.ImageFromBuffer(w, h, imData)
+
+    # Apply brightness (done in MergePlanes without masks) & scale
+    if masks and brightness != 1.0:
         img = img.AdjustChannels(brightness, brightness, brightness)
     if scale != 1.0:
         if w*scale>10 and h*scale>10:
             img.Rescale(w*scale, h*scale)
         else:
             img.Rescale(10,10)
-    
+
     return img.ConvertToBitmap()
 
-def MergeChannels(imgs, chMap, masks=[]):
+# display planes of channels, see ChannelPlane
+_planes = OrderedDict()
+_planes_nbytes = 0
+_planes_lock = threading.Lock()
+MAX_PLANE_BYTES = 256 * 2**20
+
+def ChannelPlane(im, contrast=None):
     '''
-    Merges the given image data into the channels listed in chMap.
-    Masks are passed in pairs (mask, blendingfunc).
+    Returns a channel as a uint8 plane for display, after applying the
+    contrast mode ('Linear', 'Log' or None).  Values are clipped to [0, 1]
+    and scaled to [0, 255].
+    Planes are cached for as long as the channel array is alive, so
+    redrawing an image, eg: with a new brightness or channel map, doesn't
+    recompute them.  Channel arrays must not be changed in place.
+    '''
+    global _planes_nbytes
+    stats = getattr(im, 'stats', None)
+    if isinstance(im, Tile):
+        interval = im.interval
+    else:
+        interval = stats.interval() if stats is not None else None
+    key = (id(im), contrast, interval)
+    with _planes_lock:
+        entry = _planes.pop(key, None)
+        if entry is not None and entry[0]() is im:
+            _planes[key] = entry
+            return entry[1]
+        if entry is not None:
+            _planes_nbytes -= entry[1].nbytes
+
+    if contrast=='Log':
+        data = log_transform(im, interval, stats)
+    elif contrast=='Linear':
+        data = auto_contrast(im, interval)
+    else:
+        data = im
+    plane = np.clip(data, 0.0, 1.0)
+    plane *= 255.0
+    plane = plane.astype(np.uint8)
+
+    with _planes_lock:
+        _planes[key] = (weakref.ref(im), plane)
+        _planes_nbytes += plane.nbytes
+        while _planes_nbytes > MAX_PLANE_BYTES and len(_planes) > 1:
+            _planes_nbytes -= _planes.popitem(last=False)[1][1].nbytes
+    return plane
+
+def RenderRegion(imgs, chMap, (x0, y0, x1, y1), brightness=1.0, scale=1.0, contrast=None):
+    '''
+    Returns a wx.Bitmap of the region (x0, y0, x1, y1), in display pixels,
+    of the image with channels imgs displayed at the given scale, like the
+    part of MergeToBitmap's bitmap.  Only the region is processed, and it
+    is sampled from the nearest level of the channels' pyramids (see
+    imagepyramid), so rendering is as quick for large images as for small.
+    '''
+    planes = [RegionPlane(GetPyramid(im), (x0, y0, x1, y1), scale, contrast)
+              for im in imgs]
+    imData = MergePlanes(planes, chMap, brightness)
+    return wx.ImageFromBuffer(x1 - x0, y1 - y0, imData).ConvertToBitmap()
+
+def RegionPlane(pyramid, bbox, scale=1.0, contrast=None):
+    '''
+    Returns the region bbox of a channel displayed at the given scale as a
+    uint8 display plane (see ChannelPlane), contrast stretched by the range
+    of the whole channel so that the regions of an image match.
+    '''
+    data = pyramid.region(scale, bbox)
+    stats = pyramid.stats
+    lo, hi = stats.interval()
+    if contrast in ('Linear', 'Log') and not pyramid.binary and hi > lo:
+        if contrast == 'Log':
+            # as log_transform
+            lo = lo if lo > 0 else stats.min_positive
+            data = np.log(data.clip(lo, hi))
+            lo, hi = np.log(lo), np.log(hi)
+        data = data - lo
+        if hi > lo:
+            data /= hi - lo
+    plane = np.clip(data, 0.0, 1.0)
+    plane *= 255.0
+    return plane.astype(np.uint8)
+
+COLORMAP = {'red'      : [1,0,0],
+            'green'    : [0,1,0],
+            'blue'     : [0,0,1],
+            'cyan'     : [0,1,1],
+            'yellow'   : [1,1,0],
+            'magenta'  : [1,0,1],
+            'gray'     : [1,1,1],
+            'none'     : [0,0,0] }
+
+# reusable merge buffers of the current thread, see MergePlanes
+_merge_buffers = threading.local()
+
+def MergePlanes(planes, chMap, brightness=1.0):
+    '''
+    Merges uint8 display planes (see ChannelPlane) into the colors listed
+    in chMap, blending them as given by the image_channel_blend_modes
+    property, and multiplies the result by brightness.
+    Returns an h x w x 3 uint8 array, which is reused by the next call from
+    the same thread.
     '''
     n_channels = sum(map(int, p.channels_per_image))
     blending = p.image_channel_blend_modes or ['add']*n_channels
-    h,w = imgs[0].shape
-    
-    colormap = {'red'      : [1,0,0], 
-                'green'    : [0,1,0], 
-                'blue'     : [0,0,1], 
-                'cyan'     : [0,1,1], 
-                'yellow'   : [1,1,0], 
-                'magenta'  : [1,0,1], 
-                'gray'     : [1,1,1], 
-                'none'     : [0,0,0] }
-    
-    imData = np.zeros((h,w,3), dtype='float')
-    
-    for i, im in enumerate(imgs):
+    h,w = planes[0].shape
+
+    buffers = getattr(_merge_buffers, 'buffers', None)
+    if buffers is None or buffers[0].shape[:2] != (h,w):
+        buffers = (np.empty((h,w,3), np.int16), np.empty((h,w,3), np.uint8))
+        _merge_buffers.buffers = buffers
+    acc, out = buffers
+    acc.fill(0)
+
+    for i, plane in enumerate(planes):
         if blending[i].lower() == 'add':
-            c = colormap[chMap[i].lower()]
+            c = COLORMAP[chMap[i].lower()]
             for chan in range(3):
-                imData[:,:,chan] += im * c[chan]
-    
-    imData[imData>1.0] = 1.0
-    imData[imData<0.0] = 0.0
-    
-    for i, im in enumerate(imgs):
+                if c[chan]:
+                    acc[:,:,chan] += plane
+    np.clip(acc, 0, 255, out=acc)
+
+    for i, plane in enumerate(planes):
         if blending[i].lower() == 'subtract':
-            c = colormap[chMap[i].lower()]
+            c = COLORMAP[chMap[i].lower()]
             for chan in range(3):
-                imData[:,:,chan] -= im * c[chan]
+                if c[chan]:
+                    acc[:,:,chan] -= plane
+    np.clip(acc, 0, 255, out=acc)
 
-    imData[imData>1.0] = 1.0
-    imData[imData<0.0] = 0.0
-    
-    for i, im in enumerate(imgs):
+    for i, plane in enumerate(planes):
         if blending[i].lower() == 'solid':
             if chMap[i].lower() != 'none':
-                c = colormap[chMap[i].lower()]
+                c = COLORMAP[chMap[i].lower()]
+                solid = plane == 255
                 for chan in range(3):
-                    imData[:,:,chan][im == 1] = c[chan]
-            
-    imData[imData>1.0] = 1.0
-    imData[imData<0.0] = 0.0
-    
+                    acc[:,:,chan][solid] = 255 * c[chan]
+
+    # like wx.Image.AdjustChannels, values are scaled and clipped to 255
+    lut = np.minimum(np.arange(256) * brightness, 255).astype(np.uint8)
+    np.take(lut, acc, out=out)
+    return out
+
+def MergeChannels(imgs, chMap, masks=[]):
+    '''
+    Merges the given image data into the channels listed in chMap.
+    Masks are passed in pairs (mask, blendingfunc).
+    Returns an h x w x 3 float array with values in [0, 1].
+    '''
+    imData = MergePlanes([ChannelPlane(im) for im in imgs], chMap) / 255.0
     for mask, func in masks:
         imData = func(imData, mask)
-
     return imData
 
 def check_image_shape_compatibility(imgs):
@@ -248,19 +615,26 @@ def rescale(im, scale):
     from scipy.misc import imresize
     return imresize(im, (scale[1], scale[0])) / 255.
 
-def log_transform(im, interval=None):
+def log_transform(im, interval=None, stats=None):
     '''Takes a single image in the form of a np array and returns it
-    log-transformed and scaled to the interval [0,1] '''
+    log-transformed and scaled to the interval [0,1].  interval is the
+    (min, max) to scale from, by default that of im.  stats is the
+    ChannelStats of the image that im is from, if known, whose smallest
+    positive value is used in place of a min <= 0. '''
     # Check that the image isn't binary 
     # (used to check if it was not all 0's, but this covers both cases)
     # if (im!=0).any()
     (min, max) = interval or (im.min(), im.max())
     if np.any((im>min)&(im<max)):
-        im = im.clip(im[im>0].min(), im.max())
+        if min <= 0 and stats is not None:
+            min = stats.min_positive
+        elif min <= 0:
+            min = im[im>0].min() if (im>0).any() else max
+        im = im.clip(min, max)
         im = np.log(im)
-        im -= im.min()
-        if im.max() > 0:
-            im /= im.max()
+        im -= np.log(min)
+        if max > min:
+            im /= np.log(max) - np.log(min)
     return im
 
 def auto_contrast(im, interval=None):
@@ -270,9 +644,9 @@ def auto_contrast(im, interval=None):
     (min, max) = interval or (im.min(), im.max())
     # Check that the image isn't binary 
     if np.any((im>min)&(im<max)):
-        im -= im.min()
-        if im.max() > 0:
-            im /= im.max()
+        im -= min
+        if max > min:
+            im /= max - min
     return im
 
 def tile_images(images):
@@ -14,6 +14,8 @@ from datamodel import DataModel
 from imagecontrolpanel import *
 from imagepanel import ImagePanel
 from properties import Properties
+from spatialindex import PointIndex
+import imageprefetcher
 import imagetools
 import cPickle
 import logging
@@ -27,6 +29,9 @@ REQUIRED_PROPERTIES = ['channels_per_image','image_channel_colors', 'object_name
 
 CL_NUMBERED = 'numbered'
 CL_COLORED = 'colored'
+# how far, in display pixels, object markers and labels may extend from
+# their points
+MARKER_MARGIN = 24
 ID_SELECT_ALL = wx.NewId()
 ID_DESELECT_ALL = wx.NewId()
 
@@ -63,16 +68,28 @@ class ImageViewerPanel(ImagePanel):
     ImagePanel with selection and object class labels. 
     '''
     def __init__(self, imgs, chMap, img_key, parent, scale=1.0, brightness=1.0, contrast=None):
-        super(ImageViewerPanel, self).__init__(imgs, chMap, parent, scale, brightness, contrast=contrast)
+        super(ImageViewerPanel, self).__init__(imgs, chMap, parent, scale, brightness, 
+                                               contrast=contrast, tiled=True)
         self.selectedPoints = []
         self.classes        = {}  # {'Positive':[(x,y),..], 'Negative': [(x2,y2),..],..}
+        self.class_index    = {}  # {'Positive':PointIndex, ...}
         self.classVisible   = {}
         self.class_rep      = CL_COLORED
         self.img_key        = img_key
         self.show_object_numbers = False
 
+    def VisibleRect(self):
+        '''Returns the (x0, y0, x1, y1) image coordinates of the update
+        region, widened by MARKER_MARGIN, to draw the markers in.'''
+        box = self.GetUpdateRegion().GetBox()
+        return ((box.x - MARKER_MARGIN) / self.scale, 
+                (box.y - MARKER_MARGIN) / self.scale,
+                (box.x + box.width + MARKER_MARGIN) / self.scale, 
+                (box.y + box.height + MARKER_MARGIN) / self.scale)
+
     def OnPaint(self, evt):
         dc = super(ImageViewerPanel, self).OnPaint(evt)
+        visible = self.VisibleRect()
         font = self.GetFont()
         font.SetPixelSize((6,12))
         dc.SetFont(font)
@@ -82,10 +99,14 @@ class ImageViewerPanel(ImagePanel):
         if self.show_object_numbers and p.object_table:
             dc.SetLogicalFunction(wx.XOR)
             dc.BeginDrawing()
-            for i, (x,y) in enumerate(self.ob_coords):
-                x = x * self.scale - 6*(len('%s'%i)-1)
+            for obKey in self.ob_index.in_rect(*visible):
+                # objects without coordinates aren't indexed, so label
+                # each object with its own number
+                label = '%s'%(obKey[-1])
+                x, y = self.ob_index.position(obKey)
+                x = x * self.scale - 6*(len(label)-1)
                 y = y * self.scale - 6
-                dc.DrawText('%s'%(i + 1), x, y)
+                dc.DrawText(label, x, y)
             dc.EndDrawing()
 
         # Draw class numbers over each object
@@ -93,7 +114,8 @@ class ImageViewerPanel(ImagePanel):
             for (name, cl), clnum, color in zip(self.classes.items(), self.class_nums, self.colors):
                 if self.classVisible[name]:
                     dc.BeginDrawing()
-                    for (x,y) in cl:
+                    for i in self.class_index[name].in_rect(*visible):
+                        x, y = cl[i]
                         if self.class_rep==CL_NUMBERED:
                             dc.SetLogicalFunction(wx.XOR)
                             x = x * self.scale - 3
@@ -113,7 +135,10 @@ class ImageViewerPanel(ImagePanel):
         dc.SetLogicalFunction(wx.XOR)
         dc.SetPen(wx.Pen("WHITE",1))
         dc.SetBrush(wx.Brush("WHITE", style=wx.TRANSPARENT))
+        x0, y0, x1, y1 = visible
         for (x,y) in self.selectedPoints:
+            if not (x0 <= x <= x1 and y0 <= y <= y1):
+                continue
             x = x * self.scale - 3
             y = y * self.scale - 3
             w = h = 6
@@ -150,6 +175,7 @@ class ImageViewerPanel(ImagePanel):
             return
         from matplotlib.pyplot import cm
         self.classes = classes
+        self.class_index = dict((name, PointIndex(cl)) for name, cl in classes.items())
         vals = np.arange(0, 1, 1. / len(classes))
         vals += (1.0 - vals[-1]) / 2
         self.colors = [np.array(cm.jet(val)) * 255 for val in vals]
@@ -163,7 +189,7 @@ class ImageViewerPanel(ImagePanel):
     def ToggleObjectNumbers(self):
         self.show_object_numbers = not self.show_object_numbers
         if self.show_object_numbers:
-            self.ob_coords = db.GetAllObjectCoordsFromImage(self.img_key)
+            self.ob_index = db.GetObjectIndex(self.img_key)
         self.Refresh()
 
     def ToggleClassRepresentation(self):
@@ -202,6 +228,7 @@ class ImageViewer(wx.Frame):
         self.SetName('ImageViewer')
         self.SetBackgroundColour(wx.NullColor)
         self.img_key     = img_key
+        self.pinned_key  = None
         self.classifier  = parent
         self.sw          = wx.ScrolledWindow(self)
         self.selection   = []
@@ -221,6 +248,7 @@ class ImageViewer(wx.Frame):
         self.SetSizer(wx.BoxSizer(wx.VERTICAL))
         self.CreateMenus()
         self.CreatePopupMenu()
+        self.Bind(wx.EVT_CLOSE, self.OnClose)
         if imgs and chMap:
             self.SetImage(imgs, chMap, brightness, scale, contrast)
         else:
@@ -251,6 +279,9 @@ class ImageViewer(wx.Frame):
 
     def SetImage(self, imgs, chMap=None, brightness=1, scale=1, contrast=None):
         self.AutoTitle()
+        self.PinImage(self.img_key)
+        # read the images likely to be viewed next while this one is viewed
+        imageprefetcher.PrefetchAround(self.img_key)
         self.chMap = chMap or p.image_channel_colors
         self.toggleChMap = self.chMap[:]
         if self.imagePanel:
@@ -262,6 +293,20 @@ class ImageViewer(wx.Frame):
         self.imagePanel.Bind(wx.EVT_SIZE, self.OnResizeImagePanel)
         self.imagePanel.Bind(wx.EVT_RIGHT_DOWN, self.OnRightDown)
 
+    def PinImage(self, imKey):
+        ''' Keeps the shown image in the image cache while it is shown. '''
+        cache = imagetools.image_cache()
+        if self.pinned_key is not None:
+            cache.unpin(self.pinned_key)
+            self.pinned_key = None
+        if imKey is not None:
+            cache.pin(imKey)
+            self.pinned_key = imKey
+
+    def OnClose(self, evt):
+        self.PinImage(None)
+        evt.Skip()
+
     def CreateMenus(self):
         self.SetMenuBar(wx.MenuBar())
         # File Menu
@@ -590,7 +635,8 @@ class ImageViewer(wx.Frame):
             y = evt.GetPosition().y / self.imagePanel.scale
             if p.rescale_object_coords:
                 x, y = rescale_display_coord_to_image(x, y)
-            obKey = db.GetObjectNear(self.img_key, x, y)
+            index = db.GetObjectIndex(self.img_key)
+            obKey = index.nearest(x, y)
 
             if not obKey: return
 
@@ -605,7 +651,7 @@ class ImageViewer(wx.Frame):
                     self.selection.remove(obKey)
 
             # select the object
-            (x,y) = db.GetObjectCoords(obKey)            
+            (x,y) = index.position(obKey)
             if p.rescale_object_coords:
                 x, y = rescale_image_coord_to_display(x, y)
             self.imagePanel.TogglePointSelection((x,y))
@@ -693,7 +739,7 @@ class ImageViewer(wx.Frame):
                     return self.OnSaveImage(evt)
             if format.upper()=='.JPG':
                 format = '.JPEG'
-            imagetools.SaveBitmap(self.imagePanel.bitmap, filename, format.upper()[1:])
+            imagetools.SaveBitmap(self.imagePanel.GetBitmap(), filename, format.upper()[1:])
 
 
     def OnChangeClassRepresentation(self, evt):
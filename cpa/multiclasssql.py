@@ -3,6 +3,7 @@ import sys
 from dbconnect import *
 from properties import Properties
 from datamodel import DataModel
+from compiledmodel import CompiledModel
 
 db = DBConnect.getInstance()
 p = Properties.getInstance()
@@ -15,19 +16,16 @@ filter_table_prefix = '_filter_'
 
 def translate(weaklearners):
     '''
-    Translate weak leaners into a classifier() expression
+    Translate weak leaners (or a CompiledModel) into a classifier() expression
     (or something more complicated in the future).
     '''
-    num_features = len(weaklearners)
-    nClasses = len(weaklearners[0][2])
+    if isinstance(weaklearners, CompiledModel):
+        model = weaklearners
+    else:
+        model = CompiledModel.FromLearners(weaklearners, colnames=[])
 
-    has_classifier_function = False
     if p.db_type.lower() == 'sqlite':
-        thresholds = numpy.array([wl[1] for wl in weaklearners])
-        a = numpy.array([wl[2] for wl in weaklearners])
-        b = numpy.array([wl[3] for wl in weaklearners])
-        db.setup_sqlite_classifier(thresholds, a, b)
-        return "classifier(%s)"%(",".join([wl[0] for wl in weaklearners]))
+        return model.setup_sqlite()
     
     if p.db_type.lower() == 'mysql':
         # MySQL
@@ -37,14 +35,12 @@ def translate(weaklearners):
         except:
             has_classifier_function = False
         if has_classifier_function:
-            num_stumps = len(weaklearners)
-            featurenames = "1," + ",".join([wl[0] for wl in weaklearners])
-            thresholds = "0,"+",".join([str(wl[1]) for wl in weaklearners])
-            base = [sum([wl[3][k] for wl in weaklearners]) for k in range(nClasses)]
-            weights = ",".join([",".join([str(base[k])] + [str(wl[2][k]-wl[3][k]) for wl in weaklearners]) for k in range(nClasses)])
-            return "(classifier(%d, %s, %s, %s)+1)"%(num_stumps + 1, featurenames, thresholds, weights)
+            return model.mysql_expression()
         else:
-            class_scores = ['+'.join(['IF(`%s` > %f, %f, %f)'%(feature, threshold, a[i], b[i]) for (feature, threshold, a, b, ignore) in weaklearners]) for i in range(nClasses)]
+            thresholds = model._scaled_thresholds()
+            class_scores = ['+'.join(['IF(`%s` > %f, %f, %f)'%(feature, threshold, a[i], b[i]) 
+                                      for feature, threshold, a, b in zip(model.feature_names(), thresholds, model.a, model.b)])
+                            for i in range(model.num_classes())]
             return "CASE GREATEST(%s) %s END"%(",".join(class_scores), "\n".join(["WHEN %s THEN %d"%(score, idx+1) for idx, score in enumerate(class_scores)]))
     
 
@@ -98,26 +94,34 @@ def object_scores(weaklearners):
     return numpy.array(map(tuple, res), dtype)
 
 
-def create_perobject_class_table(classnames, rules):
-    ''' Saves object keys and classes to a text file '''
+def create_perobject_class_table(classnames, rules, swap=True):
+    '''
+    Saves object keys and classes to the class table.
+    Each object is classified once, by a single INSERT ... SELECT of its
+    class number and the class name of that number, and the table is
+    indexed after it is loaded.
+    If swap is set, the table is written under a new name and only replaces
+    the class table once complete (see DBConnect.replace_table).
+    '''
     nClasses = len(classnames)
 
     if p.class_table is None:
         raise ValueError('"class_table" in properties file is not set.')
 
+    table = p.class_table + '_new' if swap else p.class_table
     index_cols = UniqueObjectClause()
-    class_cols = UniqueObjectClause() + ', class, class_number'
     class_col_defs = object_key_defs() + ', class VARCHAR (%d)'%(max([len(c) for c in classnames])+1) + ', class_number INT'
     
-    
-    # Drop must be explicitly asked for Classifier.ScoreAll
-    db.execute('DROP TABLE IF EXISTS %s'%(p.class_table))
-    db.execute('CREATE TABLE %s (%s)'%(p.class_table, class_col_defs))
-    db.execute('CREATE INDEX idx_%s ON %s (%s)'%(p.class_table, p.class_table, index_cols))
-        
-    case_expr = 'CASE %s'%(translate(rules)) + ''.join([" WHEN %d THEN '%s'"%(n+1, classnames[n]) for n in range(nClasses)]) + " END"
-    case_expr2 = 'CASE %s'%(translate(rules)) + ''.join([" WHEN %d THEN '%s'"%(n+1, n+1) for n in range(nClasses)]) + " END"
-    db.execute('INSERT INTO %s (%s) SELECT %s, %s, %s FROM %s'%(p.class_table, class_cols, index_cols, case_expr, case_expr2, p.object_table))
+    db.execute('DROP TABLE IF EXISTS %s'%(table))
+    db.execute('CREATE TABLE %s (%s)'%(table, class_col_defs))
+    name_expr = 'CASE class_number' + ''.join([" WHEN %d THEN '%s'"%(n+1, classnames[n]) for n in range(nClasses)]) + " END"
+    db.execute('INSERT INTO %s (%s, class, class_number) SELECT %s, %s, class_number FROM '
+               '(SELECT %s, %s AS class_number FROM %s) AS classified'%
+               (table, index_cols, index_cols, name_expr, index_cols, translate(rules), p.object_table))
+    if swap:
+        db.replace_table(table, p.class_table, index_cols)
+    else:
+        db.execute('CREATE INDEX idx_%s ON %s (%s)'%(table, table, index_cols))
     db.Commit()
     
 def PerImageCounts(weaklearners, filter_name=None, cb=None):
@@ -132,95 +136,115 @@ def PerImageCounts(weaklearners, filter_name=None, cb=None):
         If p.area_scoring_column is set, then area scores will be appended to
         the object scores.
     '''
-
-    def objectify(field):
-        return "%s.%s"%(p.object_table, field)
-
-    def where_clauses():
-        imkeys = dm.GetAllImageKeys(filter_name)
-        imkeys.sort()
-        stepsize = max(len(imkeys) / 100, 50)
-        key_thresholds = imkeys[-1:1:-stepsize]
-        key_thresholds.reverse()
-        if p.table_id:
-            # split each table independently
-            def splitter():
-                yield "(%s = %d) AND (%s <= %d)"%(objectify(p.table_id), key_thresholds[0][0], 
-                                                  objectify(p.image_id), key_thresholds[0][1])
-                for lo, hi in zip(key_thresholds[:-1], key_thresholds[1:]):
-                    if lo[0] == hi[0]:
-                        # block within one table
-                        yield "(%s = %d) AND (%s > %d) AND (%s <= %d)"%(objectify(p.table_id), lo[0], 
-                                                                        objectify(p.image_id), lo[1], 
-                                                                        objectify(p.image_id), hi[1])
-                    else:
-                        # query spans a table boundary
-                        yield "(%s >= %d) AND (%s > %d)"%(objectify(p.table_id), lo[0], 
-                                                         objectify(p.image_id), lo[1])
-                        yield "(%s <= %d) AND (%s <= %d)"%(objectify(p.table_id), hi[0], 
-                                                          objectify(p.image_id), hi[1])
-            return list(splitter())
-        else:
-            return (["(%s <= %d)"%(objectify(p.image_id), key_thresholds[0][0])] + 
-                    ["(%s > %d) AND (%s <= %d)"
-                     %(objectify(p.image_id), lo[0], objectify(p.image_id), hi[0])
-                     for lo, hi in zip(key_thresholds[:-1], key_thresholds[1:])])
-                                                            
     # I'm pretty sure this would be even faster if we were to run two
     # or more parallel threads and split the work between them.
-    def do_by_steps(class_query, tables, filter_name, result_clauses):
-        if filter_name is not None:
-            filter_clause = str(p._filters[filter_name])
-            filter_clause += ' AND ' + ' AND '.join(
-                ['%s=%s'%(im_col, ob_col) 
-                 for im_col, ob_col in zip(image_key_columns(p.image_table), 
-                                           image_key_columns(p.object_table))])
-            tables += ', ' + ', '.join(p._filters[filter_name].get_tables())
-        if cb:
-            result =  []
-            wheres = where_clauses()
-            num_clauses = len(wheres)
-            
-            for idx, wc in enumerate(wheres):
-                if filter_name is None:
-                    where_clause = wc
-                else:
-                    where_clause = '%s AND %s'%(wc, filter_clause)
-                    
-                result += [db.execute('SELECT %s, %s as class, %s FROM %s '
-                                      'WHERE %s GROUP BY %s, class'
-                                      %(UniqueImageClause(p.object_table), 
-                                        class_query, result_clauses, tables, 
-                                        where_clause, 
-                                        UniqueImageClause(p.object_table)),
-                                      silent=(idx > 10))]
-                cb(min(1, idx/float(num_clauses)))
-            return sum(result, [])
+    if cb:
+        results = []
+        queries = PerImageCountQueries(weaklearners, filter_name)
+        num_queries = len(queries)
+        for idx, query in enumerate(queries):
+            results += db.execute(query, silent=(idx > 10))
+            cb(min(1, idx/float(num_queries)))
+    else:
+        class_query, tables, result_clauses, filter_clause = _count_query_parts(weaklearners, filter_name)
+        imkeys = UniqueImageClause(p.object_table)
+        if filter_name is None:
+            results = db.execute('SELECT %s, %s as class, %s FROM %s GROUP BY %s, class'%
+                                 (imkeys, class_query, result_clauses, tables, imkeys))
         else:
-            if filter_name is None:
-                return db.execute('SELECT %s, %s as class, %s FROM %s GROUP BY %s, class'%
-                                  (imkeys, class_query, result_clauses, tables, imkeys))
-            else:
-                tables += ', ' + ', '.join(filter.get_tables())
-                return db.execute('SELECT %s, %s as class, %s FROM %s WHERE %s GROUP BY %s, class'%
-                                  (imkeys, class_query, result_clauses, tables, filter_clause, imkeys))
-    
+            results = db.execute('SELECT %s, %s as class, %s FROM %s WHERE %s GROUP BY %s, class'%
+                                 (imkeys, class_query, result_clauses, tables, filter_clause, imkeys))
+    return PerImageCountsFromResults(results, len(weaklearners[0][2]), filter_name)
+
+def _objectify(field):
+    return "%s.%s"%(p.object_table, field)
+
+def _count_query_parts(weaklearners, filter_name):
+    '''
+    Returns the class expression, tables, aggregate columns and filter
+    clause (or None) of the per-image count queries.
+    '''
     if p.area_scoring_column is None:
         result_clauses = 'COUNT(*)'
     else:
-        result_clauses = 'COUNT(*), SUM(%s)'%(objectify(p.area_scoring_column))
-
+        result_clauses = 'COUNT(*), SUM(%s)'%(_objectify(p.area_scoring_column))
     class_query = translate(weaklearners)
-    results = do_by_steps(class_query, p.object_table, filter_name, result_clauses)
+    tables = p.object_table
+    filter_clause = None
+    if filter_name is not None:
+        filter_clause = str(p._filters[filter_name])
+        filter_clause += ' AND ' + ' AND '.join(
+            ['%s=%s'%(im_col, ob_col) 
+             for im_col, ob_col in zip(image_key_columns(p.image_table), 
+                                       image_key_columns(p.object_table))])
+        tables += ', ' + ', '.join(p._filters[filter_name].get_tables())
+    return class_query, tables, result_clauses, filter_clause
+
+def _count_where_clauses(filter_name):
+    '''Splits the images into about 100 blocks of consecutive image keys.'''
+    imkeys = dm.GetAllImageKeys(filter_name)
+    imkeys.sort()
+    stepsize = max(len(imkeys) / 100, 50)
+    key_thresholds = imkeys[-1:1:-stepsize]
+    key_thresholds.reverse()
+    if p.table_id:
+        # split each table independently
+        def splitter():
+            yield "(%s = %d) AND (%s <= %d)"%(_objectify(p.table_id), key_thresholds[0][0], 
+                                              _objectify(p.image_id), key_thresholds[0][1])
+            for lo, hi in zip(key_thresholds[:-1], key_thresholds[1:]):
+                if lo[0] == hi[0]:
+                    # block within one table
+                    yield "(%s = %d) AND (%s > %d) AND (%s <= %d)"%(_objectify(p.table_id), lo[0], 
+                                                                    _objectify(p.image_id), lo[1], 
+                                                                    _objectify(p.image_id), hi[1])
+                else:
+                    # query spans a table boundary
+                    yield "(%s >= %d) AND (%s > %d)"%(_objectify(p.table_id), lo[0], 
+                                                     _objectify(p.image_id), lo[1])
+                    yield "(%s <= %d) AND (%s <= %d)"%(_objectify(p.table_id), hi[0], 
+                                                      _objectify(p.image_id), hi[1])
+        return list(splitter())
+    else:
+        return (["(%s <= %d)"%(_objectify(p.image_id), key_thresholds[0][0])] + 
+                ["(%s > %d) AND (%s <= %d)"
+                 %(_objectify(p.image_id), lo[0], _objectify(p.image_id), hi[0])
+                 for lo, hi in zip(key_thresholds[:-1], key_thresholds[1:])])
 
+def PerImageCountQueries(weaklearners, filter_name=None):
+    '''
+    Returns the queries that PerImageCounts runs, one for each block of
+    images.  Each query returns rows of the form
+    [image key..., class, object count(, area sum)].  The queries are
+    independent, so they can be run in any order or in parallel.
+    '''
+    class_query, tables, result_clauses, filter_clause = _count_query_parts(weaklearners, filter_name)
+    queries = []
+    for wc in _count_where_clauses(filter_name):
+        if filter_clause is None:
+            where_clause = wc
+        else:
+            where_clause = '%s AND %s'%(wc, filter_clause)
+        queries += ['SELECT %s, %s as class, %s FROM %s '
+                    'WHERE %s GROUP BY %s, class'
+                    %(UniqueImageClause(p.object_table), 
+                      class_query, result_clauses, tables, 
+                      where_clause, 
+                      UniqueImageClause(p.object_table))]
+    return queries
+
+def PerImageCountsFromResults(results, num_classes, filter_name=None):
+    '''
+    Combines the rows returned by the PerImageCountQueries into the
+    per-image counts returned by PerImageCounts.
+    '''
     # convert to dictionary
     counts = {}
     keylen = 1 + len(image_key_columns()) # includes class
 
     for r in results:
-        counts[r[:keylen]] = r[keylen:]
+        counts[tuple(r[:keylen])] = r[keylen:]
 
-    num_classes = len(weaklearners[0][2])
     # this is clearer than the one-line version
     def get_count(im_key, classnum):
         return counts.get(tuple(list(im_key) + [classnum]), [0])[0]
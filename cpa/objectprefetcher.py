@@ -0,0 +1,130 @@
+'''
+Background prefetching of objects for Classifier's Fetch button.
+
+ObjectPrefetcher keeps a bounded queue of sampled objects, with their tiles
+already loaded, for each class of the current fetch source (the filter or
+group the user is fetching from).  Queues are refilled in a background
+thread as Classifier consumes them, and dropped whenever the source or the
+classifier model changes.
+'''
+from __future__ import with_statement
+from collections import deque
+import logging
+import threading
+import imagetools
+import tilecollection
+from dbconnect import DBConnect
+
+db = DBConnect.getInstance()
+
+# number of objects sampled and tiled before the queues are checked again
+BATCH_SIZE = 10
+
+class ObjectPrefetcher(threading.Thread):
+    '''
+    Usage:
+    prefetcher.SetSource(key, sample, classes, size)
+        key: anything identifying the fetch source, eg: ('image', imKey)
+        sample: function(obClass, n) returning up to n object keys of
+            obClass from the source, called from the prefetch thread
+        classes: the obClasses to keep queues for (0 for unclassified)
+        size: the number of objects to keep ready per class
+    prefetcher.Take(key, obClass, n) then returns a list of (obKey, tile data)
+    if n objects are ready, or None.
+    '''
+    def __init__(self):
+        threading.Thread.__init__(self, name='ObjectPrefetcher')
+        self.setDaemon(True)
+        self.cv = threading.Condition()
+        self.key = None
+        self.sample = None
+        self.size = 0
+        self.queues = {}
+        self.exhausted = set()
+        self.generation = 0
+        self._want_abort = False
+        self.start()
+
+    def SetSource(self, key, sample, classes, size):
+        ''' Starts prefetching from a new source if it has changed. '''
+        with self.cv:
+            if (key == self.key and size == self.size and
+                sorted(classes) == sorted(self.queues.keys())):
+                return
+            self._Reset()
+            self.key = key
+            self.sample = sample
+            self.size = size
+            self.queues = dict((obClass, deque()) for obClass in classes)
+            self.cv.notify()
+
+    def Clear(self):
+        ''' Drops all prefetched objects, eg: when the model changes. '''
+        with self.cv:
+            self._Reset()
+
+    def _Reset(self):
+        self.generation += 1
+        self.key = None
+        self.sample = None
+        self.queues = {}
+        self.exhausted = set()
+
+    def Take(self, key, obClass, n):
+        with self.cv:
+            if key != self.key or obClass not in self.queues:
+                return None
+            queue = self.queues[obClass]
+            if len(queue) < n:
+                return None
+            taken = [queue.popleft() for i in xrange(n)]
+            self.cv.notify()
+        return taken
+
+    def _NextClass(self):
+        ''' Returns the class whose queue is the emptiest, or None if all are full. '''
+        wanting = [(len(queue), obClass) for obClass, queue in self.queues.items()
+                   if len(queue) < self.size and obClass not in self.exhausted]
+        if not wanting:
+            return None
+        return min(wanting)[1]
+
+    def run(self):
+        while True:
+            with self.cv:
+                while not self._want_abort and self._NextClass() is None:
+                    self.cv.wait()
+                if self._want_abort:
+                    break
+                obClass = self._NextClass()
+                generation = self.generation
+                sample = self.sample
+                n = min(BATCH_SIZE, self.size - len(self.queues[obClass]))
+            try:
+                # sampling only queries the database, so it doesn't hold up
+                # training; samples drawn with an old model are dropped below
+                obKeys = sample(obClass, n)
+                fetched = []
+                if generation == self.generation and not self._want_abort:
+                    # like the TileLoader, wait while the classifier is training
+                    with tilecollection.load_lock().shared():
+                        tiles = imagetools.FetchTiles(obKeys)
+                    fetched = [(obKey, tilecollection.List(tile))
+                               for obKey, tile in zip(obKeys, tiles) if tile is not None]
+            except Exception, e:
+                logging.error('Error prefetching %s: %s'%(obClass, e))
+                obKeys, fetched = [], []
+            with self.cv:
+                if generation == self.generation:
+                    self.queues[obClass].extend(fetched)
+                    if not obKeys:
+                        # don't spin on classes with no objects in this source
+                        self.exhausted.add(obClass)
+        db.CloseConnection()
+        logging.info('%s aborted'%self.getName())
+
+    def abort(self):
+        with self.cv:
+            self._want_abort = True
+            self._Reset()
+            self.cv.notify()
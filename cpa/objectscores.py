@@ -0,0 +1,233 @@
+'''
+Materialized per-object scores for a trained fast gentle boosting classifier.
+
+Every object in the experiment is scored once per model by fetching only the
+columns used by the rules, so fetching objects of a given class becomes a
+random sample from that class's index instead of rejection sampling against
+the database.
+'''
+import logging
+import random
+import threading
+import numpy as np
+from dbconnect import DBConnect, UniqueObjectClause, GetWhereClauseForImages, image_key_columns
+from datamodel import DataModel
+from properties import Properties
+
+p = Properties.getInstance()
+db = DBConnect.getInstance()
+dm = DataModel.getInstance()
+
+# number of images whose objects are fetched in one query
+IMAGES_PER_QUERY = 500
+
+class StopScoring(Exception):
+    pass
+
+def learner_columns(learners):
+    ''' Returns the distinct feature columns used by the learners, in order. '''
+    columns = []
+    for learner in learners:
+        if learner[0] not in columns:
+            columns.append(learner[0])
+    return columns
+
+def same_learners(learners1, learners2):
+    ''' Returns whether two lists of weak learners are identical. '''
+    if len(learners1) != len(learners2):
+        return False
+    for (col1, thresh1, a1, b1, e1), (col2, thresh2, a2, b2, e2) in zip(learners1, learners2):
+        if (col1 != col2 or thresh1 != thresh2 or 
+            not np.array_equal(a1, a2) or not np.array_equal(b1, b2)):
+            return False
+    return True
+
+def score_values(learners, columns, values, num_classes):
+    '''
+    Sums the weak learner outputs for each row of values.
+    learners: weak learners from FastGentleBoosting.Train
+    columns: names of the columns of values
+    values: n by len(columns) array, NaN for NULL values
+    Returns an n by num_classes array of margins.
+    '''
+    margins = np.zeros((values.shape[0], num_classes), np.float32)
+    for colname, thresh, a, b, e_m in learners:
+        # like SQL, a comparison with NULL selects b
+        above = (values[:, columns.index(colname)] > thresh).reshape((-1, 1))
+        margins += np.where(above, np.reshape(a, (1, num_classes)), np.reshape(b, (1, num_classes)))
+    return margins
+
+def fetch_object_values(columns, callback=None):
+    '''
+    Fetches the object keys and the given columns for every object, one
+    block of images at a time.  Rows are sorted by object key.
+    Returns (keys, values) where keys is an int array with one row per
+    object and values is a float array with NaN for NULL values.
+    '''
+    imkeys = sorted(dm.GetAllImageKeys())
+    select = ', '.join([UniqueObjectClause()] + list(columns))
+    nkeycols = len(image_key_columns()) + 1
+    keys, values = [], []
+    for start in range(0, len(imkeys), IMAGES_PER_QUERY):
+        block = list(imkeys[start:start + IMAGES_PER_QUERY])
+        res = db.execute('SELECT %s FROM %s WHERE %s'%(select, p.object_table, GetWhereClauseForImages(block)),
+                         silent=(start > 0))
+        if res:
+            res = np.array(res, dtype=np.float64)
+            res = res[np.lexsort(res[:, nkeycols-1::-1].T)]
+            keys.append(res[:, :nkeycols].astype(np.int64))
+            values.append(res[:, nkeycols:])
+        if callback:
+            callback(min(1.0, (start + IMAGES_PER_QUERY) / float(len(imkeys))))
+    if not keys:
+        return np.zeros((0, nkeycols), np.int64), np.zeros((0, len(columns)))
+    return np.vstack(keys), np.vstack(values)
+
+
+class ObjectScores(object):
+    '''
+    Class and margin of every object under one model.
+    Objects are kept sorted by key; order lists the object rows grouped by
+    class so that class_bounds[k-1]:class_bounds[k] are the rows of class k.
+    '''
+    def __init__(self, learners, keys, margins):
+        self.learners = learners
+        self.keys = keys
+        self.margins = margins
+        self.classes = margins.argmax(axis=1) + 1
+        self.order = np.argsort(self.classes, kind='mergesort')
+        self.class_bounds = np.searchsorted(self.classes[self.order],
+                                            np.arange(1, margins.shape[1] + 2))
+        # per-object image index, for restricting fetches to some images
+        nimcols = keys.shape[1] - 1
+        self.image_keys, self.image_index = unique_rows(keys[:, :nimcols])
+        self.image_codes = _row_codes(self.image_keys)
+
+    @classmethod
+    def Compute(cls, learners, callback=None):
+        ''' Scores every object in the experiment with the given learners. '''
+        columns = learner_columns(learners)
+        keys, values = fetch_object_values(columns, callback)
+        return cls(learners, keys, score_values(learners, columns, values, len(learners[0][2])))
+
+    def Updated(self, learners, removed, added, callback=None):
+        '''
+        Returns the scores for learners, a model that differs from this one
+        by the removed and added weak learners, fetching only the columns
+        used by the changed learners.
+        '''
+        changed = list(removed) + list(added)
+        if not changed:
+            return ObjectScores(learners, self.keys, self.margins)
+        columns = learner_columns(changed)
+        keys, values = fetch_object_values(columns, callback)
+        if keys.shape != self.keys.shape or (keys != self.keys).any():
+            # objects were added or removed since these scores were computed
+            logging.info('Object table changed, rescoring all objects.')
+            return ObjectScores.Compute(learners, callback)
+        num_classes = self.margins.shape[1]
+        margins = (self.margins - score_values(removed, columns, values, num_classes)
+                   + score_values(added, columns, values, num_classes))
+        return ObjectScores(learners, keys, margins)
+
+    def GetObjectCount(self, classNum):
+        return self.class_bounds[classNum] - self.class_bounds[classNum - 1]
+
+    def GetRandomObjects(self, N, classNum, imKeys=None):
+        '''
+        Returns up to N random object keys of class classNum (1-based).
+        If a list of imKeys is specified, only objects in these images
+        are returned.
+        '''
+        rows = self.order[self.class_bounds[classNum - 1]:self.class_bounds[classNum]]
+        if imKeys is not None:
+            image_rows = self._ImageRows(imKeys)
+            rows = rows[np.in1d(self.image_index[rows], image_rows)]
+        picks = random.sample(xrange(len(rows)), min(N, len(rows)))
+        return [tuple([int(k) for k in self.keys[rows[i]]]) for i in picks]
+
+    def PerImageCounts(self, imKeys):
+        '''
+        Returns the number of objects of each class in the given images, in
+        the form of multiclasssql.PerImageCounts without area scores:
+        [TableNumber, ImageNumber, Class1_ObjectCount, Class2_ObjectCount,...]
+        '''
+        num_classes = self.margins.shape[1]
+        counts = np.bincount(self.image_index * num_classes + self.classes - 1,
+                             minlength=len(self.image_keys) * num_classes)
+        counts = counts.reshape((len(self.image_keys), num_classes))
+        idx, found = self._LookupImages(imKeys)
+        image_counts = np.zeros((len(idx), num_classes), counts.dtype)
+        image_counts[found] = counts[idx[found]]
+        return [list(imKey) + row for imKey, row in zip(imKeys, image_counts.tolist())]
+
+    def _ImageRows(self, imKeys):
+        idx, found = self._LookupImages(imKeys)
+        return idx[found]
+
+    def _LookupImages(self, imKeys):
+        '''
+        Returns the index of each of imKeys in self.image_keys, and whether
+        it was found there (the index is meaningless otherwise).
+        '''
+        imKeys = np.array(imKeys, dtype=np.int64).reshape((-1, self.image_keys.shape[1]))
+        if len(self.image_keys) == 0:
+            return np.zeros(len(imKeys), int), np.zeros(len(imKeys), bool)
+        idx = np.searchsorted(self.image_codes, _row_codes(imKeys))
+        idx = np.minimum(idx, len(self.image_keys) - 1)
+        found = (self.image_keys[idx] == imKeys).all(axis=1)
+        return idx, found
+
+
+def _row_codes(a):
+    ''' Combines the (non-negative) columns of an int key array into one sortable code per row. '''
+    codes = np.zeros(a.shape[0], np.int64)
+    for col in range(a.shape[1]):
+        codes = codes * (1 << 31) + a[:, col]
+    return codes
+
+def unique_rows(a):
+    ''' Returns the sorted unique rows of a 2-d key array and the index of each row in them. '''
+    codes = _row_codes(a)
+    unique_codes, first, inverse = np.unique(codes, return_index=True, return_inverse=True)
+    return a[first], inverse
+
+
+class ObjectScoresThread(threading.Thread):
+    '''
+    Computes ObjectScores in the background, either from scratch or by
+    updating previous scores with the changed learners of a warm start.
+    When finished, done_callback is called with the scores (or None if
+    scoring failed or was aborted) from this thread.
+    '''
+    def __init__(self, learners, done_callback, previous=None, changed_learners=None):
+        threading.Thread.__init__(self, name='ObjectScores')
+        self.setDaemon(True)
+        self.learners = list(learners)
+        self.done_callback = done_callback
+        self.previous = previous
+        self.changed_learners = changed_learners
+        self._aborted = False
+
+    def abort(self):
+        self._aborted = True
+
+    def run(self):
+        def cb(frac):
+            if self._aborted:
+                raise StopScoring
+        scores = None
+        try:
+            if self.previous is not None and self.changed_learners is not None:
+                removed, added = self.changed_learners
+                scores = self.previous.Updated(self.learners, removed, added, callback=cb)
+            else:
+                scores = ObjectScores.Compute(self.learners, callback=cb)
+        except StopScoring:
+            pass
+        except Exception, e:
+            logging.error('Failed to score objects: %s'%(e))
+        finally:
+            db.CloseConnection()
+        if not self._aborted:
+            self.done_callback(scores)
@@ -11,11 +11,31 @@ def lnchoose(n, m):
     return nf - (mf + nmmnf)
 
 
-def logP(alpha, counts):
+def count_histogram(counts):
+    '''Returns the distinct rows of the NxK counts with at least one
+    trial, and the number of times each of them occurs.'''
+    counts = asarray(counts).astype(float)
+    counts = counts[counts.sum(axis=1) > 0, :]
+    if counts.shape[0] == 0:
+        return counts, zeros(0)
+    # sort the rows so that duplicates are adjacent
+    order = lexsort(counts.T[::-1])
+    counts = counts[order]
+    first = ones(counts.shape[0], bool)
+    first[1:] = (counts[1:] != counts[:-1]).any(axis=1)
+    starts = flatnonzero(first)
+    weights = diff(append(starts, counts.shape[0])).astype(float)
+    return counts[starts], weights
+
+def logP(alpha, counts, weights=None):
+    '''log likelihood of the NxK counts (each row weighted by weights).'''
+    counts = asarray(counts, float)
+    if weights is None:
+        weights = ones(counts.shape[0])
     alphasum = sum(alpha)
-    def logPsingle(c):
-        return gammaln(alphasum) - gammaln(alphasum + sum(c)) + sum([gammaln(alpha[k] + c[k]) - gammaln(alpha[k]) for k in range(len(alpha))])
-    return sum([logPsingle(counts[i, :]) for i in range(counts.shape[0])])
+    rows = (gammaln(alphasum) - gammaln(alphasum + counts.sum(axis=1)) + 
+            (gammaln(alpha + counts) - gammaln(alpha)).sum(axis=1))
+    return sum(weights * rows)
 
 def dirichlet_moment_match(proportions, weights):
     a = array(average(proportions, axis=0, weights=weights.flat))
@@ -28,8 +48,12 @@ def dirichlet_moment_match(proportions, weights):
     
 
 
-def polya_moment_match(counts):
-    return dirichlet_moment_match(array(counts) / sum(counts, axis=1).repeat(counts.shape[1], axis=1), sum(counts, axis=1))
+def polya_moment_match(counts, weights=None):
+    counts = asarray(counts, float)
+    scounts = counts.sum(axis=1)
+    if weights is None:
+        weights = ones(counts.shape[0])
+    return dirichlet_moment_match(counts / scounts[:, newaxis], scounts * weights)
 
 def fit_betabinom_minka(counts, maxiter=1000, tol=1e-6, initial_guess=None):
     ''' See Estimating a Dirichlet Distribution, Thomas P. Minka, 2003,
@@ -67,37 +91,38 @@ def fit_betabinom_minka(counts, maxiter=1000, tol=1e-6, initial_guess=None):
     return array(alpha[:,0]).T, iter < maxiter
 
 def di_pochhammer(x, n):
-    'digamma(x+n) - digamma(x), but 0 for n = 0'
+    'digamma(x+n) - digamma(x), but 0 for n = 0.  x broadcasts against n.'
+    x, n = broadcast_arrays(asarray(x, float), n)
     y = zeros(n.shape)
     nz = (n > 0)
-    y[nz] = digamma(x + n[nz]) - digamma(x)
+    y[nz] = digamma(x[nz] + n[nz]) - digamma(x[nz])
     return y
 
 def trigamma(x):
     return polygamma(1, x)
 
 def tri_pochhammer(x, n):
-    'trigamma(x+n) - trigamma(x), but 0 for n = 0'
+    'trigamma(x+n) - trigamma(x), but 0 for n = 0.  x broadcasts against n.'
+    x, n = broadcast_arrays(asarray(x, float), n)
     y = zeros(n.shape)
     nz = (n > 0)
-    y[nz] = trigamma(x + n[nz]) - trigamma(x)
+    y[nz] = trigamma(x[nz] + n[nz]) - trigamma(x[nz])
     return y
     
     
 
-def polya_fit_m(counts, alpha, tol):
+def polya_fit_m(counts, alpha, tol, weights=None):
     '''see polya_fit_m.m in fastfit toolbox,
-    and equation (118) fot Minka, 2003.'''
+    and equation (118) fot Minka, 2003.
+    weights gives the number of occurrences of each row of counts.'''
     s = sum(alpha)
     m = alpha / s
-    N, K = counts.shape
+    if weights is None:
+        weights = ones(counts.shape[0])
     for iter in range(20):
         old_m = m.copy()
         a = s * m
-        for k in range(K):
-            dk = counts[:, k]
-            vdk = a[k] * di_pochhammer(a[k], dk)
-            m[k] = sum(vdk)
+        m = a * dot(weights, di_pochhammer(a, counts))
         m =  m / sum(m)
         if abs(m - old_m).max() < tol:
             break
@@ -108,10 +133,129 @@ def quad_root(a, b, c):
     top = sqrt(b**2 - 4*a*c)
     return max(((-b + top) / (2 * a), (-b - top) / (2 * a)))
 
-def polya_fit_s(counts, alpha, tol):
+def polya_fit_s(counts, alpha, tol, weights=None):
     '''see polya_fit_s.m in fastfit toolbox.  This implements section
     4.2 from Minka, 2003.  I've tried to translate it into the symbols
-    of the paper.'''
+    of the paper.
+    weights gives the number of occurrences of each row of counts.'''
+    s = sum(alpha)
+    m = alpha / s
+    if weights is None:
+        weights = ones(counts.shape[0])
+    scounts = sum(counts, axis=1)
+
+    def s_derivatives(alpha_temp):
+        s = sum(alpha_temp)
+        m = alpha_temp / s
+        g = -dot(weights, di_pochhammer(s, scounts)) # eq 81, first part
+        h = -dot(weights, tri_pochhammer(s, scounts)) # eq 82, first part
+        g += dot(m, dot(weights, di_pochhammer(alpha_temp, counts))) # eq 81, second part
+        h += dot(m**2, dot(weights, tri_pochhammer(alpha_temp, counts))) # eq 82, second part
+        return g, h
+
+    def stable_a2(alpha_temp):
+        m = alpha_temp / sum(alpha_temp)
+        a = dot(weights, scounts * (scounts - 1) * (2 * scounts - 1)) / 6.0
+        ak = dot(weights, counts * (counts - 1) * (2 * counts - 1)) / 6.0
+        a -= sum(ak[ak > 0] / m[ak > 0]**2)
+        return a
+
+    eps = finfo(float64).eps
+    # minka has 10 iters for s, compared to 20 for m.  perhaps because s takes longer.
+    for iter in range(10): 
+        g, h = s_derivatives(alpha)
+        if g > eps:
+            c = g + s * h # eq 86
+            if c >= 0:
+                s = inf # comment after eq 87
+            else:
+                s = s / (1 + g / (h * s)) # eq 87
+        elif g < -eps:
+            c = dot(weights, (counts > 0).sum(axis=1)) - dot(weights, scounts > 0) # eq 94
+            if c > 0:
+                a0 = s**2 * h + c # eq 99
+                a1 = 2 * s**2 * (s * h + g) # eq 98
+                if abs(2 * g + h * s) > eps:
+                    a2 = s**3 * (2 * g + h * s) # eq 97
+                else:
+                    a2 = stable_a2(alpha) # eq 92
+                b = quad_root(a2, a1, a0) # eq 96 (disagreement with polya_fit_s.m in fastfit)
+                s = 1 / ((1 / s) - (g / c) * ((s + b) / b)**2) # eq 100
+        else:
+            pass # no update
+        old_alpha = alpha
+        alpha = s * m
+        if abs(alpha - old_alpha).max() < tol:
+            break
+
+    return alpha
+
+                
+
+
+
+def fit_betabinom_minka_alternating(counts, maxiter=1000, tol=1e-6, 
+                                    initial_guess=None, diagnostics=None):
+    ''' See Estimating a Dirichlet Distribution, Thomas P. Minka, 2003.
+    See also the code for polya_fit_ms.m in his fastfit
+    matlab toolbox, which this code is a translation of.
+
+    counts should be NxK with N samples over K classes.  The fit works
+    on the distinct rows of counts, so its cost depends on the number of
+    distinct count vectors rather than on N.
+    initial_guess: alpha to start from, eg: from a previous fit to
+        similar data, instead of the moment match.
+    diagnostics: if a list is passed, (iteration, change in alpha, log
+        likelihood) is appended to it after each iteration.'''
+
+    counts, weights = count_histogram(counts)
+    return _fit_alternating(counts, weights, maxiter, tol, initial_guess, diagnostics)
+
+def _fit_alternating(counts, weights, maxiter, tol, initial_guess=None, diagnostics=None):
+    if initial_guess is None or not all(isfinite(initial_guess)) or any(asarray(initial_guess) <= 0):
+        alpha = array(polya_moment_match(counts, weights)).flatten()
+    else:
+        alpha = array(initial_guess, float).flatten()
+
+    change = 2 * tol
+    iter = 0
+    while (change > tol) and (iter < maxiter):
+        old_alpha = alpha
+        alpha = polya_fit_m(counts, alpha, tol, weights)
+        alpha = polya_fit_s(counts, alpha, tol, weights)
+        change = abs(old_alpha - alpha).max()
+        iter += 1
+        if diagnostics is not None:
+            diagnostics.append((iter, change, logP(alpha, counts, weights)))
+    return alpha, iter < maxiter
+
+
+# The row-wise fit that the histogram fit replaced, kept to check and
+# benchmark the histogram fit against.
+
+def _rowwise_logP(alpha, counts):
+    alphasum = sum(alpha)
+    def logPsingle(c):
+        return gammaln(alphasum) - gammaln(alphasum + sum(c)) + sum([gammaln(alpha[k] + c[k]) - gammaln(alpha[k]) for k in range(len(alpha))])
+    return sum([logPsingle(counts[i, :]) for i in range(counts.shape[0])])
+
+def _rowwise_polya_fit_m(counts, alpha, tol):
+    s = sum(alpha)
+    m = alpha / s
+    N, K = counts.shape
+    for iter in range(20):
+        old_m = m.copy()
+        a = s * m
+        for k in range(K):
+            dk = counts[:, k]
+            vdk = a[k] * di_pochhammer(a[k], dk)
+            m[k] = sum(vdk)
+        m =  m / sum(m)
+        if abs(m - old_m).max() < tol:
+            break
+    return s * m
+
+def _rowwise_polya_fit_s(counts, alpha, tol):
     s = sum(alpha)
     m = alpha / s
     N, K = counts.shape
@@ -139,7 +283,6 @@ def polya_fit_s(counts, alpha, tol):
         return a
 
     eps = finfo(float64).eps
-    # minka has 10 iters for s, compared to 20 for m.  perhaps because s takes longer.
     for iter in range(10): 
         g, h = s_derivatives(alpha)
         if g > eps:
@@ -168,29 +311,18 @@ def polya_fit_s(counts, alpha, tol):
 
     return alpha
 
-                
-
-
-
-def fit_betabinom_minka_alternating(counts, maxiter=1000, tol=1e-6):
-    ''' See Estimating a Dirichlet Distribution, Thomas P. Minka, 2003.
-    See also the code for polya_fit_ms.m in his fastfit
-    matlab toolbox, which this code is a translation of.
-
-    counts should be NxK with N samples over K classes.'''
-
-    counts = matrix(counts).astype(float)
+def _rowwise_fit_alternating(counts, maxiter=1000, tol=1e-6):
+    counts = asarray(counts).astype(float)
     # remove observations with no trials
-    counts = counts[sum(counts.A, axis=1) > 0, :]
+    counts = counts[counts.sum(axis=1) > 0, :]
     alpha = array(polya_moment_match(counts)).flatten()
-    counts = counts.A
 
     change = 2 * tol
     iter = 0
     while (change > tol) and (iter < maxiter):
         old_alpha = alpha
-        alpha = polya_fit_m(counts, alpha, tol)
-        alpha = polya_fit_s(counts, alpha, tol)
+        alpha = _rowwise_polya_fit_m(counts, alpha, tol)
+        alpha = _rowwise_polya_fit_s(counts, alpha, tol)
         change = abs(old_alpha - alpha).max()
         iter += 1
     return alpha, iter < maxiter
@@ -211,5 +343,25 @@ def fit_to_data_infile(fname):
     return aver[0].flatten(), aver[1], array(wells.keys()), array(wells.values())
     
 
+def benchmark(nrows=(10**5, 10**6), K=3, seed=0):
+    '''Times fitting the histogram of distinct count vectors against the
+    row-wise fit it replaced, on simulated images with a few dozen objects
+    each.'''
+    import time
+    rs = random.RandomState(seed)
+    for n in nrows:
+        p = rs.dirichlet([2.0] + [1.0] * (K - 1), n)
+        counts = array([rs.multinomial(t, pi) for t, pi in zip(rs.poisson(30, n), p)])
+        t0 = time.time()
+        alpha, converged = fit_betabinom_minka_alternating(counts)
+        t1 = time.time()
+        row_alpha, row_converged = _rowwise_fit_alternating(counts)
+        t2 = time.time()
+        print '%d rows, %d distinct: histogram %.2fs, row-wise %.2fs, max difference %g' % \
+            (n, count_histogram(counts)[0].shape[0], t1 - t0, t2 - t1, abs(alpha - row_alpha).max())
+
 if __name__ == '__main__':
-    print fit_to_data_infile('PBscores.txt')[0]
+    if sys.argv[1:] == ['benchmark']:
+        benchmark()
+    else:
+        print fit_to_data_infile('PBscores.txt')[0]
@@ -22,6 +22,7 @@ import sys
 import os
 import logging
 import json
+from collections import deque
 from optparse import OptionParser
 import progressbar
 import numpy as np
@@ -32,6 +33,12 @@ import cpa.util
 
 logger = logging.getLogger(__name__)
 
+# Rows of the object table fetched at a time while building the cache
+FETCH_ROWS = 10000
+# Rows of feature files handed to a writer process at a time (see
+# _create_cache_features)
+WRITE_BATCH_ROWS = 50000
+
 def np_load(filename):
     "Work around bug in numpy that causes file handles to be left open."
     with open(filename, 'rb') as f:
@@ -305,10 +312,10 @@ class Cache(object):
     # Methods to create the cache
     #
 
-    def _create_cache(self, resume=False):
+    def _create_cache(self, resume=False, processes=None):
         self._create_cache_colnames(resume)
         self._create_cache_plate_map(resume)
-        self._create_cache_features(resume)
+        self._create_cache_features(resume, processes)
         self._create_cache_counts(resume)
 
     def _create_cache_colnames(self, resume):
@@ -331,26 +338,95 @@ class Cache(object):
                                                                  cpa.properties.image_table)))
         cpa.util.pickle(self._plate_map_filename, self._cached_plate_map)
 
-    def _create_cache_features(self, resume):
-        nimages = len(self._plate_map)
-        for plate, image_keys in make_progress_bar('Features')(invert_dict(self._plate_map).items()):
-            plate_dir = os.path.dirname(self._image_filename(plate, image_keys[0]))
+    def _create_cache_features(self, resume, processes=None):
+        """
+        Create the feature files of the images by reading the object
+        table once, ordered by image, and writing the files in batches
+        in a pool of processes (one per CPU unless processes is
+        given).  With resume, images that have a file are skipped.
+        """
+        todo = {}
+        for image_key, plate in self._plate_map.items():
+            filename = self._image_filename(plate, image_key)
+            if not (resume and os.path.exists(filename)):
+                todo[image_key] = filename
+        for plate_dir in set(os.path.dirname(f) for f in todo.values()):
             if not os.path.exists(plate_dir):
                 os.mkdir(plate_dir)
-            for image_key in image_keys:
-                self._create_cache_image(plate, image_key, resume)
-                
+        if not todo:
+            return
+        progress = make_progress_bar('Features')
+        progress.maxval = len(todo)
+        progress.start()
+        nprocesses = cpa.util.worker_count(processes)
+        with cpa.util.process_pool(nprocesses) as pool:
+            # batches being written, at most two per process so that
+            # the rows held in memory are bounded
+            pending = deque()
+            def write(batch):
+                while len(pending) >= 2 * nprocesses:
+                    pending.popleft().get()
+                pending.append(pool.apply_async(_write_feature_files, (batch,)))
+            batch, nrows, nimages = [], 0, 0
+            for image_key, rows in self._stream_object_rows():
+                filename = todo.pop(image_key, None)
+                if filename is None:
+                    continue
+                batch.append((filename, rows))
+                nrows += len(rows)
+                if nrows >= WRITE_BATCH_ROWS:
+                    write(batch)
+                    nimages += len(batch)
+                    progress.update(nimages)
+                    batch, nrows = [], 0
+            # images without objects get empty files
+            batch += [(filename, None) for filename in todo.values()]
+            if batch:
+                write(batch)
+            while pending:
+                pending.popleft().get()
+        progress.finish()
+
+    def _stream_object_rows(self):
+        """
+        Yield (image key, rows) for each image with objects, where rows
+        is an array of the object ids and features of its objects.  The
+        object table is read with one query, ordered by image, and the
+        rows are split by image as they arrive.
+        """
+        key_columns = cpa.dbconnect.image_key_columns()
+        nkeys = len(key_columns)
+        cpa.db.execute("""select %s, %s, %s from %s order by %s""" % (
+                ', '.join(key_columns), cpa.properties.object_id,
+                ','.join(self.colnames), cpa.properties.object_table,
+                ', '.join(key_columns)), return_result=False)
+        image_key, blocks = None, []
+        while True:
+            rows = cpa.db.GetNextResults(FETCH_ROWS)
+            if not rows:
+                break
+            data = np.array(rows, dtype=float)
+            keys = data[:, :nkeys]
+            starts = np.flatnonzero(np.r_[True, (keys[1:] != keys[:-1]).any(1)])
+            for start, stop in zip(starts, np.r_[starts[1:], len(rows)]):
+                key = tuple(rows[start][:nkeys])
+                if key != image_key:
+                    if blocks:
+                        yield image_key, np.vstack(blocks)
+                    image_key, blocks = key, []
+                blocks.append(data[start:stop, nkeys:])
+        if blocks:
+            yield image_key, np.vstack(blocks)
+
     def _create_cache_image(self, plate, image_key, resume=False):
         filename = self._image_filename(plate, image_key)
         if resume and os.path.exists(filename):
             return
-        features = cpa.db.execute("""select %s from %s where %s""" % (
-                ','.join(self.colnames), cpa.properties.object_table, 
-                cpa.dbconnect.GetWhereClauseForImages([image_key])))
-        cellids  = cpa.db.execute("""select %s from %s where %s""" % (
-                cpa.properties.object_id, cpa.properties.object_table, 
+        rows = cpa.db.execute("""select %s, %s from %s where %s""" % (
+                cpa.properties.object_id, ','.join(self.colnames),
+                cpa.properties.object_table,
                 cpa.dbconnect.GetWhereClauseForImages([image_key])))
-        np.savez(filename, features=np.array(features, dtype=float), cellids=np.squeeze(np.array(cellids)))
+        _write_feature_files([(filename, np.array(rows, dtype=float) if rows else None)])
 
     def _create_cache_counts(self, resume):
         """
@@ -366,6 +442,23 @@ class Cache(object):
             np.save(f, counts)
 
 
+def _write_feature_files(batch):
+    """
+    Write the feature files of a batch of (filename, rows), where rows
+    is an array of object ids and features, or None for an image
+    without objects.  Files are written under a temporary name first,
+    so that an interrupted build leaves no partial files to resume from.
+    """
+    for filename, rows in batch:
+        if rows is None or len(rows) == 0:
+            features, cellids = np.array([], dtype=float), np.array([])
+        else:
+            features, cellids = rows[:, 1:], rows[:, :1].astype(int)
+        tmp = filename + '.tmp'
+        with open(tmp, 'wb') as f:
+            np.savez(f, features=features, cellids=np.squeeze(cellids))
+        os.rename(tmp, filename)
+
 def _check_directory(dir, resume):
     if os.path.exists(dir):
         if not resume:
@@ -377,8 +470,10 @@ def _check_directory(dir, resume):
 if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO)
 
-    parser = OptionParser("usage: %prog [-r] PROPERTIES-FILE CACHE-DIR PREDICATE")
+    parser = OptionParser("usage: %prog [-r] [-p PROCESSES] PROPERTIES-FILE CACHE-DIR PREDICATE")
     parser.add_option('-r', dest='resume', action='store_true', help='resume')
+    parser.add_option('-p', dest='processes', type='int', default=None,
+                      help='number of processes writing the cache (default: one per CPU)')
     options, args = parser.parse_args()
     if len(args) != 3:
         parser.error('Incorrect number of arguments')
@@ -390,7 +485,7 @@ if __name__ == '__main__':
 
     cache = Cache(cache_dir)
 
-    cache._create_cache(options.resume)
+    cache._create_cache(options.resume, options.processes)
     if predicate != '':
         RobustLinearNormalization(cache)._create_cache(predicate, options.resume)
     else:
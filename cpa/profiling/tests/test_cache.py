@@ -1,3 +1,4 @@
+import os
 import tempfile
 import numpy as np
 import unittest
@@ -268,18 +269,49 @@ class CacheTestCase(unittest.TestCase):
                                         (3, 14): 'p1'})
 
     @patch('cpa.profiling.cache.make_progress_bar')
-    @patch.object(cache.Cache, '_plate_map')
-    def test_create_cache_features(self, plate_map, make_progress_bar):
-        cache_dir = tempfile.mkdtemp()
-        c = cache.Cache(cache_dir)
-        plate_map.__get__ = Mock(return_value={(0L, 42L): 'p1', (1L, 23L): 'p2'})
-        make_progress_bar.return_value = lambda x: x
-        c._create_cache_image = Mock()
-        c._create_cache_features(False)
-        calls = c._create_cache_image.call_args_list
-        assert len(calls) == 2
-        assert call('p1', (0L, 42L), False) in calls
-        assert call('p2', (1L, 23L), False) in calls
+    @patch('cpa.dbconnect.image_key_columns')
+    @patch('cpa.properties')
+    @patch('cpa.db')
+    def test_create_cache_features(self, db, properties, image_key_columns,
+                                   make_progress_bar):
+        image_key_columns.return_value = ('TableNumber', 'ImageNumber')
+        properties.object_id = 'ObjectNumber'
+        properties.object_table = 'per_object'
+        rows = [(0L, 1L, 1L, 0.5, 1.5), (0L, 1L, 2L, 2.5, None),
+                (0L, 1L, 3L, 4.5, 5.5), (0L, 2L, 1L, 6.5, 7.5),
+                (1L, 2L, 7L, 8.5, 9.5), (1L, 3L, 1L, 0.0, 1.0)]
+        for processes in [1, 2]:
+            c = cache.Cache(tempfile.mkdtemp())
+            c._cached_colnames = ['a', 'b']
+            c._cached_plate_map = {(0L, 1L): 'p1', (0L, 2L): 'p1', (1L, 2L): 'p2',
+                                   (1L, 3L): 'p2', (1L, 4L): 'p2'}
+            # resuming skips the images that have files already
+            os.mkdir(os.path.join(c.cache_dir, 'p2'))
+            open(c._image_filename('p2', (1L, 3L)), 'w').close()
+            # the rows arrive in chunks that split images
+            db.GetNextResults.side_effect = [rows[:2], rows[2:5], rows[5:], []]
+            c._create_cache_features(True, processes)
+
+            query = db.execute.call_args[0][0]
+            assert query.startswith('select TableNumber, ImageNumber, ObjectNumber, a,b from per_object')
+            assert query.endswith('order by TableNumber, ImageNumber')
+            def load(plate, imKey):
+                raw = np.load(c._image_filename(plate, imKey))
+                return raw['features'], raw['cellids']
+            features, cellids = load('p1', (0L, 1L))
+            np.testing.assert_array_equal(features, [[0.5, 1.5], [2.5, np.nan], [4.5, 5.5]])
+            np.testing.assert_array_equal(cellids, [1, 2, 3])
+            features, cellids = load('p1', (0L, 2L))
+            np.testing.assert_array_equal(features, [[6.5, 7.5]])
+            assert cellids.shape == () and cellids == 1
+            features, cellids = load('p2', (1L, 2L))
+            np.testing.assert_array_equal(features, [[8.5, 9.5]])
+            # images without objects get empty files
+            features, cellids = load('p2', (1L, 4L))
+            assert len(features) == 0 and len(cellids) == 0
+            assert os.path.getsize(c._image_filename('p2', (1L, 3L))) == 0
+            assert not [f for d in ['p1', 'p2'] for f in os.listdir(os.path.join(c.cache_dir, d))
+                        if f.endswith('.tmp')]
 
     # TODO: test_create_image
 
@@ -47,12 +47,23 @@ string_vars = ['db_type',
                'image_url_prepend',
                'image_tile_size', 
                'image_buffer_size',
+               'image_cache_mb',
+               'image_spill_dir',
+               'image_spill_mb',
+               'image_prefetch',
+               'image_http_cache_dir',
+               'image_http_cache_mb',
+               'image_http_connections',
+               'image_http_ranges',
+               'tile_store_dir',
                'tile_buffer_size',
                'area_scoring_column',
                'training_set',
                'class_table',
                'plate_type',
                'check_tables',
+               'classifier_score_cache',
+               'classifier_workers',
                'db_sql_file',
                'db_sqlite_file',
                'use_larger_image_scale', 
@@ -94,6 +105,15 @@ optional_vars = ['db_port',
                  'training_set',
                  'class_table',
                  'image_buffer_size', 
+                 'image_cache_mb',
+                 'image_spill_dir',
+                 'image_spill_mb',
+                 'image_prefetch',
+                 'image_http_cache_dir',
+                 'image_http_cache_mb',
+                 'image_http_connections',
+                 'image_http_ranges',
+                 'tile_store_dir',
                  'tile_buffer_size',
                  'plate_id', 
                  'well_id', 
@@ -105,6 +125,8 @@ optional_vars = ['db_port',
                  'classifier_ignore_substrings', 'classifier_ignore_columns',
                  'object_name',
                  'check_tables',
+                 'classifier_score_cache',
+                 'classifier_workers',
                  'db_sql_file',
                  'db_sqlite_file',
                  'object_table', 
@@ -550,6 +572,34 @@ class Properties(Singleton):
             logging.info('PROPERTIES: Using default image_buffer_size=1')
             self.image_buffer_size = '1'
             
+        if not self.field_defined('image_cache_mb'):
+            logging.info('PROPERTIES: Using default image_cache_mb=512')
+            self.image_cache_mb = '512'
+            
+        if not self.field_defined('image_spill_dir'):
+            self.image_spill_dir = ''
+            
+        if not self.field_defined('image_spill_mb'):
+            self.image_spill_mb = '0'
+            
+        if not self.field_defined('image_prefetch'):
+            self.image_prefetch = '4'
+            
+        if not self.field_defined('image_http_cache_dir'):
+            self.image_http_cache_dir = ''
+            
+        if not self.field_defined('image_http_cache_mb'):
+            self.image_http_cache_mb = '1024'
+            
+        if not self.field_defined('image_http_connections'):
+            self.image_http_connections = '4'
+            
+        if not self.field_defined('image_http_ranges'):
+            self.image_http_ranges = 'no'
+            
+        if not self.field_defined('tile_store_dir'):
+            self.tile_store_dir = ''
+            
         if not self.field_defined('tile_buffer_size'):
             logging.info('PROPERTIES: Using default tile_buffer_size=1')
             self.tile_buffer_size = '1'
@@ -621,6 +671,20 @@ class Properties(Singleton):
             logging.warn('PROPERTIES WARNING (check_tables): Field value "%s" is invalid. Replacing with "yes".'%(self.check_tables))
             self.check_tables = 'yes'
             
+        if self.field_defined('classifier_score_cache') and self.classifier_score_cache.lower() in ['true', 'yes', 'on', 't', 'y']:
+            self.classifier_score_cache = 'yes'
+        elif not self.field_defined('classifier_score_cache') or self.classifier_score_cache.lower() in ['false', 'no', 'off', 'f', 'n']:
+            self.classifier_score_cache = 'no'
+        else:
+            logging.warn('PROPERTIES WARNING (classifier_score_cache): Field value "%s" is invalid. Replacing with "no".'%(self.classifier_score_cache))
+            self.classifier_score_cache = 'no'
+            
+        if not self.field_defined('classifier_workers'):
+            self.classifier_workers = '1'
+        elif not self.classifier_workers.strip().isdigit():
+            logging.warn('PROPERTIES WARNING (classifier_workers): Field value "%s" is invalid. Replacing with "1".'%(self.classifier_workers))
+            self.classifier_workers = '1'
+            
         if self.use_larger_image_scale in [True, False]:
             pass
         elif not self.field_defined('use_larger_image_scale') or self.use_larger_image_scale.lower() in ['false', 'no', 'off', 'f', 'n']:
@@ -1,11 +1,15 @@
 #!/usr/bin/env python
+from __future__ import with_statement
 from dbconnect import *
 from datamodel import DataModel
 from properties import Properties
 from StringIO import StringIO, StringIO
 from trainingset import TrainingSet
+from compiledmodel import CompiledModel
 from time import time
 import dirichletintegrate
+import hashlib
+import json
 import fastgentleboostingmulticlass
 import multiclasssql
 import polyafit
@@ -13,7 +17,8 @@ import logging
 import numpy as np
 import os
 import sys
-import wx
+
+db = DBConnect.getInstance()
 
 USAGE = '''
 ABOUT:
@@ -21,12 +26,168 @@ This script will train a classifier for a given properties file and training
 set and output a results table. You can also use it to write directly to a
 database table.
 
+Per-image counts are computed in about 100 partitions.  With --checkpoint,
+the counts of each partition are appended to a file as they are computed,
+and rerunning the same command resumes from the partitions that are done.
+
 USAGE:
-python scoreall.py <propertiesfile> <trainingset>
+python scoreall.py [options] <propertiesfile> <trainingset> <nrules>
+python scoreall.py [options] --model <modelfile> <propertiesfile>
 '''
 
+def train(ts, nRules):
+    '''Trains a classifier with nRules rules on TrainingSet ts and 
+    returns the weak learners.'''
+    assert 200 > nRules > 0, '# of rules must be between 1 and 200.  Value was %s'%(nRules,)
+    output = StringIO()
+    logging.info('Training classifier with %s rules...'%nRules)
+    t0 = time()
+    weaklearners = fastgentleboostingmulticlass.train(ts.colnames,
+                                                      nRules, ts.label_matrix, 
+                                                      ts.values, output)
+    logging.info('Training done in %f seconds'%(time()-t0))
+    return weaklearners
+
+def _jsonable(value):
+    # MySQL returns SUMs as Decimals and keys as longs
+    if isinstance(value, (int, long)):
+        return int(value)
+    return float(value)
+
+def _read_checkpoint(checkpoint, fingerprint):
+    '''
+    Returns a dictionary of the partition results recorded in the
+    checkpoint file, or an empty dictionary if the file does not exist or
+    was written for different queries.  A partially written last record
+    (from an interrupted run) is discarded.
+    '''
+    done = {}
+    if not os.path.exists(checkpoint):
+        return done
+    good_bytes = 0
+    with open(checkpoint, 'r+') as f:
+        header = f.readline()
+        try:
+            if json.loads(header)['fingerprint'] != fingerprint:
+                logging.warn('Checkpoint %s was written for a different classifier or filter. Starting over.'%(checkpoint))
+                return done
+        except (ValueError, KeyError):
+            logging.warn('Checkpoint %s is not readable. Starting over.'%(checkpoint))
+            return done
+        good_bytes = f.tell()
+        for line in iter(f.readline, ''):
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break
+            done[record['partition']] = record['rows']
+            good_bytes = f.tell()
+        f.truncate(good_bytes)
+    return done
+
+def _count_partition(query):
+    return db.execute(query, silent=True)
+
+def _count_partitions(queries, n_workers, record):
+    '''
+    Runs the count queries, a dictionary of partition index to query, on
+    n_workers threads and calls record(idx, rows) from this thread as each
+    finishes.  The queries run on the database server, so threads (each
+    with their own connection, closed when the thread is done) are enough
+    to run them in parallel.  The first error stops the threads and is
+    raised once they are finished.
+    '''
+    import Queue
+    import threading
+    tasks = Queue.Queue()
+    for idx in sorted(queries.keys()):
+        tasks.put(idx)
+    results = Queue.Queue()
+    stop = threading.Event()
+
+    def work():
+        connected = False
+        try:
+            while not stop.isSet():
+                try:
+                    idx = tasks.get_nowait()
+                except Queue.Empty:
+                    break
+                connected = True
+                try:
+                    results.put((idx, _count_partition(queries[idx]), None))
+                except Exception:
+                    results.put((idx, None, sys.exc_info()))
+                    break
+        finally:
+            if connected:
+                db.CloseConnection()
+
+    threads = [threading.Thread(target=work, name='CountObjects-%d'%(i))
+               for i in range(min(n_workers, len(queries)))]
+    for thread in threads:
+        thread.setDaemon(True)
+        thread.start()
+    try:
+        for i in range(len(queries)):
+            # with a timeout, waiting can be interrupted with Ctrl-C
+            idx, rows, error = results.get(True, 1e6)
+            if error is not None:
+                raise error[0], error[1], error[2]
+            record(idx, rows)
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+def count_objects(weaklearners, filter_name=None, checkpoint=None, n_workers=1):
+    '''
+    Returns the per-image class counts of multiclasssql.PerImageCounts.
+    checkpoint -- file to record the counts of each partition in as they
+                  are computed.  Partitions already in this file are not
+                  recomputed.
+    n_workers  -- number of partitions to query in parallel
+    '''
+    queries = multiclasssql.PerImageCountQueries(weaklearners, filter_name)
+    fingerprint = hashlib.sha1('\n'.join(queries)).hexdigest()
+    done = {}
+    out = None
+    if checkpoint:
+        done = _read_checkpoint(checkpoint, fingerprint)
+        if done:
+            logging.info('Resuming from %s: %d of %d partitions are done.'%(checkpoint, len(done), len(queries)))
+            out = open(checkpoint, 'a')
+        else:
+            out = open(checkpoint, 'w')
+            out.write(json.dumps({'fingerprint' : fingerprint}) + '\n')
+            out.flush()
+    todo = [i for i in range(len(queries)) if i not in done]
+    
+    def record(idx, rows):
+        rows = [[_jsonable(v) for v in row] for row in rows]
+        done[idx] = rows
+        if out:
+            out.write(json.dumps({'partition' : idx, 'rows' : rows}) + '\n')
+            out.flush()
+            os.fsync(out.fileno())
+        logging.info('%d%% '%(100. * len(done) / len(queries),))
+        
+    try:
+        if n_workers > 1 and len(todo) > 1:
+            _count_partitions(dict((i, queries[i]) for i in todo), n_workers, record)
+        else:
+            for idx in todo:
+                record(idx, _count_partition(queries[idx]))
+    finally:
+        if out:
+            out.close()
+    results = sum([done[i] for i in range(len(queries))], [])
+    return multiclasssql.PerImageCountsFromResults(results, len(weaklearners[0][2]), filter_name)
+
 def score(properties, ts, nRules, filter_name=None, group='Image',
-          show_results=False, results_table=None, overwrite=False):
+          show_results=False, results_table=None, overwrite=False,
+          checkpoint=None, n_workers=1, timings=None, weaklearners=None,
+          keysAndCounts=None, labels=None):
     '''
     Trains a Classifier on a training set and scores the experiment
     returns the table of scores as a numpy array.
@@ -38,8 +199,16 @@ def score(properties, ts, nRules, filter_name=None, group='Image',
     group         -- name of a group to use from the properties file
     show_results  -- whether or not to show the results in TableViewer
     results_table -- table name to save results to or None.
+    checkpoint    -- file to record per-partition counts in (see count_objects)
+    n_workers     -- number of count partitions to query in parallel, and of
+                     processes computing enrichment scores
+    timings       -- if a dictionary is passed, the seconds spent in each
+                     step are added to it
+    weaklearners  -- an already trained classifier, to skip training
+    keysAndCounts -- per-image counts from a previous call, to skip counting
+    labels        -- class labels of weaklearners, by default ts.labels (ts 
+                     may then be None)
     '''
-    
     p = properties
     db = DBConnect.getInstance()
     dm = DataModel.getInstance()
@@ -49,42 +218,40 @@ def score(properties, ts, nRules, filter_name=None, group='Image',
         
     if results_table:
         if db.table_exists(results_table) and not overwrite:
-            print 'Table "%s" already exists. Delete this table before running scoreall.'%(results_table)
+            logging.error('Table "%s" already exists. Delete this table before running scoreall.'%(results_table))
             return None
 
-    print ''
-    print 'properties:    ', properties
-    print 'training set:  ', ts
-    print '# rules:       ', nRules
-    print 'filter:        ', filter_name
-    print 'grouping by:   ', group
-    print 'show results:  ', show_results
-    print 'results table: ', results_table
-    print 'overwrite:     ', overwrite
-    print ''
+    logging.info('properties:    %s'%(properties,))
+    logging.info('training set:  %s'%(ts,))
+    logging.info('# rules:       %s'%(nRules,))
+    logging.info('filter:        %s'%(filter_name,))
+    logging.info('grouping by:   %s'%(group,))
+    logging.info('show results:  %s'%(show_results,))
+    logging.info('results table: %s'%(results_table,))
+    logging.info('overwrite:     %s'%(overwrite,))
+    if timings is None:
+        timings = {}
             
-    nClasses = len(ts.labels)
+    if labels is None:
+        labels = ts.labels
+    nClasses = len(labels)
     nKeyCols = len(image_key_columns())
     
-    assert 200 > nRules > 0, '# of rules must be between 1 and 200.  Value was %s'%(nRules,)
     assert filter_name in p._filters.keys()+[None], 'Filter %s not found in properties file.  Valid filters are: %s'%(filter_name, ','.join(p._filters.keys()),)
     assert group in p._groups.keys()+['Image'], 'Group %s not found in properties file.  Valid groups are: %s'%(group, ','.join(p._groups.keys()),)
     
-    output = StringIO()
-    logging.info('Training classifier with %s rules...'%nRules)
-    t0 = time()
-    weaklearners = fastgentleboostingmulticlass.train(ts.colnames,
-                                                      nRules, ts.label_matrix, 
-                                                      ts.values, output)
-    logging.info('Training done in %f seconds'%(time()-t0))
+    if weaklearners is None:
+        t0 = time()
+        weaklearners = train(ts, nRules)
+        timings['training'] = timings.get('training', 0) + time() - t0
     
-    logging.info('Computing per-image class counts...')
-    t0 = time()
-    def update(frac): 
-        logging.info('%d%% '%(frac*100.,))
-    keysAndCounts = multiclasssql.PerImageCounts(weaklearners, filter_name=(filter_name or None), cb=update)
-    keysAndCounts.sort()
-    logging.info('Counts found in %f seconds'%(time()-t0))
+    if keysAndCounts is None:
+        logging.info('Computing per-image class counts...')
+        t0 = time()
+        keysAndCounts = count_objects(weaklearners, filter_name or None, checkpoint, n_workers)
+        keysAndCounts.sort()
+        timings['counting'] = timings.get('counting', 0) + time() - t0
+        logging.info('Counts found in %f seconds'%(time()-t0))
         
     if not keysAndCounts:
         logging.error('No images are in filter "%s". Please check the filter definition in your properties file.'%(filter_name))
@@ -107,14 +274,24 @@ def score(properties, ts, nRules, filter_name=None, group='Image',
     
     # FIT THE BETA BINOMIAL
     logging.info('Fitting beta binomial distribution to data...')
+    t0 = time()
     counts = groupedKeysAndCounts[:,-nClasses:]
     alpha, converged = polyafit.fit_betabinom_minka_alternating(counts)
     logging.info('   alpha = %s   converged = %s'%(alpha, converged))
     logging.info('   alpha/Sum(alpha) = %s'%([a/sum(alpha) for a in alpha]))
+    timings['fitting'] = timings.get('fitting', 0) + time() - t0
                 
     # CONSTRUCT ARRAY OF TABLE DATA
     logging.info('Computing enrichment scores for each group...')
     t0 = time()
+    # compute enrichment probabilities of each class for each image OR group
+    enrichments = dirichletintegrate.score_batch(alpha, np.asarray(counts, dtype=np.float64).astype(int), n_workers)
+    # compute logit of each probability
+    #   Special case: only calculate logit of "positives" for 2-classes
+    if nClasses==2:
+        logits = np.log10(enrichments[:,:1]) - np.log10(1 - enrichments[:,:1])
+    else:
+        logits = np.log10(enrichments) - np.log10(1 - enrichments)
     tableData = []
     for i, row in enumerate(groupedKeysAndCounts):
         # Start this row with the group key: 
@@ -132,21 +309,12 @@ def score(properties, ts, nRules, filter_name=None, group='Image',
             tableRow += [sum(countsRow)]
             tableRow += countsRow
             
-        # Append the scores:
-        #   compute enrichment probabilities of each class for this image OR group
-        scores = np.array( dirichletintegrate.score(alpha, np.array(countsRow)) )
-        #   clamp to [0,1] to 
-        scores[scores>1.] = 1.
-        scores[scores<0.] = 0.
-        tableRow += scores.tolist()
-        # Append the logit scores:
-        #   Special case: only calculate logit of "positives" for 2-classes
-        if nClasses==2:
-            tableRow += [np.log10(scores[0])-(np.log10(1-scores[0]))]   # compute logit of each probability
-        else:
-            tableRow += [np.log10(score)-(np.log10(1-score)) for score in scores]   # compute logit of each probability
+        # Append the scores and logit scores:
+        tableRow += enrichments[i].tolist()
+        tableRow += logits[i].tolist()
         tableData.append(tableRow)
     tableData = np.array(tableData, dtype=object)
+    timings['enrichment'] = timings.get('enrichment', 0) + time() - t0
     logging.info('Enrichments computed in %f seconds'%(time()-t0))
     
     # CREATE COLUMN LABELS LIST
@@ -163,18 +331,18 @@ def score(properties, ts, nRules, filter_name=None, group='Image',
         colnames += ['Number_of_Images']
     colnames += ['Total_%s_Count'%(p.object_name[0].capitalize())]
     for i in xrange(nClasses):
-        colnames += ['%s_%s_Count'%(ts.labels[i].capitalize(), p.object_name[0].capitalize())]
+        colnames += ['%s_%s_Count'%(labels[i].capitalize(), p.object_name[0].capitalize())]
     if p.area_scoring_column is not None:
         colnames += ['Total_%s_Area'%(p.object_name[0].capitalize())]
         for i in xrange(nClasses):
-            colnames += ['%s_%s_Area'%(ts.labels[i].capitalize(), p.object_name[0].capitalize())]
+            colnames += ['%s_%s_Area'%(labels[i].capitalize(), p.object_name[0].capitalize())]
     for i in xrange(nClasses):
-        colnames += ['pEnriched_%s'%(ts.labels[i])]
+        colnames += ['pEnriched_%s'%(labels[i])]
     if nClasses==2:
-        colnames += ['Enriched_Score_%s'%(ts.labels[0])]
+        colnames += ['Enriched_Score_%s'%(labels[0])]
     else:
         for i in xrange(nClasses):
-            colnames += ['Enriched_Score_%s'%(ts.labels[i])]
+            colnames += ['Enriched_Score_%s'%(labels[i])]
 
     title = results_table or "Enrichments_per_%s"%(group,)
     if filter_name:
@@ -182,10 +350,14 @@ def score(properties, ts, nRules, filter_name=None, group='Image',
     title += ' (%s)'%(os.path.split(p._filename)[1])
     
     if results_table:
-        print 'Creating table %s'%(results_table)
+        logging.info('Creating table %s'%(results_table))
+        t0 = time()
+        if overwrite and db.table_exists(results_table):
+            db.execute('DROP TABLE %s'%(results_table))
         success = db.CreateTableFromData(tableData, colnames, results_table, temporary=False)
+        timings['writing'] = timings.get('writing', 0) + time() - t0
         if not success:
-            print 'Failed to create results table :('
+            logging.error('Failed to create results table :(')
     
     if show_results:
         import tableviewer
@@ -204,40 +376,79 @@ def score(properties, ts, nRules, filter_name=None, group='Image',
 # run
 #
 if __name__ == "__main__":
-    logging.basicConfig(level=logging.DEBUG)
+    from optparse import OptionParser
+    logging.basicConfig(level=logging.INFO)
     
-    if len(sys.argv) < 3:
-        print USAGE
-        sys.exit()
+    parser = OptionParser(USAGE)
+    parser.add_option('-f', '--filter', dest='filter', help='only score images in this filter from the properties file')
+    parser.add_option('-g', '--group', dest='groups', action='append', default=[],
+                      help='group to compute enrichments for (may be given more than once; default: Image)')
+    parser.add_option('-o', '--results-table', dest='results_table', 
+                      help='database table to write the results to.  With several groups, the group name is appended')
+    parser.add_option('--overwrite', dest='overwrite', action='store_true', help='replace existing results tables')
+    parser.add_option('-c', '--checkpoint', dest='checkpoint', help='file to record per-partition counts in, for resuming')
+    parser.add_option('-j', '--workers', dest='workers', type='int', default=1, 
+                      help='number of partitions to count, and processes to compute enrichments with, in parallel')
+    parser.add_option('-m', '--model', dest='model', help='score with a saved model instead of training one')
+    parser.add_option('--save-model', dest='save_model', help='save the trained model to this file')
+    parser.add_option('--show', dest='show', action='store_true', help='show the results in a table viewer (requires a display)')
+    options, args = parser.parse_args()
+    if len(args) != (1 if options.model else 3):
+        parser.error('Incorrect number of arguments')
+    if options.model:
+        props_file, = args
+        ts, nRules = None, 0
+    else:
+        props_file, ts_file, nRules = args
+    groups = options.groups or ['Image']
 
-    props_file = sys.argv[1]
-    ts_file    = sys.argv[2]
-    
-    app = wx.PySimpleApp()
-    
-    nRules = int(raw_input('# of rules: '))
-    
-    filter_name = raw_input('Filter name (return for none): ')
-    if filter_name == '':
-        filter_name = None
-    
-    group = raw_input('Group name (return for none): ')
-    if group=='':
-        group = 'Image'
-        
-    results_table = raw_input('Results table name (return for none): ')
+    if options.show:
+        import wx
+        app = wx.PySimpleApp()
 
+    timings = {}
+    t0 = time()
     logging.info('Loading properties file...')
     p = Properties.getInstance()
     p.LoadFile(props_file)
-    logging.info('Loading training set...')
-    ts = TrainingSet(p)
-    ts.Load(ts_file)
+    if options.model:
+        logging.info('Loading model...')
+        model = CompiledModel.Load(options.model)
+        weaklearners, labels = model.learners(), model.labels
+        timings['loading'] = time() - t0
+    else:
+        logging.info('Loading training set...')
+        ts = TrainingSet(p)
+        ts.Load(ts_file)
+        timings['loading'] = time() - t0
 
-    score(p, ts, nRules, filter_name, group, show_results=True,
-          results_table=results_table, overwrite=False)
+        t0 = time()
+        weaklearners, labels = train(ts, int(nRules)), list(ts.labels)
+        timings['training'] = time() - t0
+        if options.save_model:
+            CompiledModel.FromLearners(weaklearners, labels).Save(options.save_model)
+    keysAndCounts = None
+    for group in groups:
+        results_table = options.results_table
+        if results_table and len(groups) > 1:
+            results_table += '_' + group
+        if keysAndCounts is None:
+            # counts are only computed once, then reused for each group
+            t0 = time()
+            keysAndCounts = count_objects(weaklearners, options.filter, options.checkpoint, options.workers)
+            keysAndCounts.sort()
+            timings['counting'] = time() - t0
+        score(p, ts, int(nRules), options.filter, group, show_results=options.show,
+              results_table=results_table, overwrite=options.overwrite, timings=timings,
+              weaklearners=weaklearners, keysAndCounts=keysAndCounts, labels=labels)
+    
+    logging.info('Time spent:')
+    for step in ['loading', 'training', 'counting', 'fitting', 'enrichment', 'writing']:
+        if step in timings:
+            logging.info('   %-12s %10.1fs'%(step, timings[step]))
     
-    app.MainLoop()
+    if options.show:
+        app.MainLoop()
     
     #
     # Kill the Java VM
@@ -248,4 +459,4 @@ if __name__ == "__main__":
     except:
         import traceback
         traceback.print_exc()
-        print "Caught exception while killing VM"
\ No newline at end of file
+        print "Caught exception while killing VM"
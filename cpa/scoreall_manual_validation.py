@@ -9,6 +9,7 @@ import dirichletintegrate
 import fastgentleboostingmulticlass
 import multiclasssql
 import polyafit
+from scoreall import train
 import logging
 import numpy as np
 import os
@@ -90,17 +91,10 @@ def score_objects(properties, ts, gt, nRules, filter_name=None, group='Image',
     nClasses = len(ts.labels)
     nKeyCols = len(image_key_columns())
     
-    assert 200 > nRules > 0, '# of rules must be between 1 and 200.  Value was %s'%(nRules,)
     assert filter_name in p._filters.keys()+[None], 'Filter %s not found in properties file.  Valid filters are: %s'%(filter_name, ','.join(p._filters.keys()),)
     assert group in p._groups.keys()+['Image', 'None'], 'Group %s not found in properties file.  Valid groups are: %s'%(group, ','.join(p._groups.keys()),)
     
-    output = StringIO()
-    logging.info('Training classifier with %s rules...'%nRules)
-    t0 = time()
-    weaklearners = fastgentleboostingmulticlass.train(ts.colnames,
-                                                      nRules, ts.label_matrix, 
-                                                      ts.values, output)
-    logging.info('Training done in %f seconds'%(time()-t0))
+    weaklearners = train(ts, nRules)
     
     t0 = time()
     #def update(frac): 
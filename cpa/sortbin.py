@@ -296,13 +296,18 @@ class SortBin(wx.ScrolledWindow):
             self.DeselectAll()
 
     def OnTileUpdated(self, evt):
-        ''' When the tile loader returns the cropped image update the tile. '''
-        self.UpdateTile(evt.data)
+        ''' When the tile loader returns the cropped images update the tiles. '''
+        self.UpdateTiles(evt.data)
             
     def UpdateTile(self, obKey):
         ''' Called when image data is available for a specific tile. '''
+        self.UpdateTiles([obKey])
+
+    def UpdateTiles(self, obKeys):
+        ''' Called when image data is available for some tiles. '''
+        obKeys = set(obKeys)
         for t in self.tiles:
-            if t.obKey == obKey:
+            if t.obKey in obKeys:
                 t.UpdateBitmap()
                 
     def UpdateSizer(self):
@@ -0,0 +1,144 @@
+'''
+A spatial index of points, eg: the object centers of an image, for finding
+the points near a position or in a region without looking at all of them.
+'''
+import numpy as np
+
+class PointIndex(object):
+    '''
+    Buckets points on a grid of square cells.
+    points: sequence of (x, y)
+    cell_size: width of the cells, by default chosen so that cells hold a
+               few points each
+    '''
+    def __init__(self, points, cell_size=None):
+        self.points = np.asarray(points, np.float64).reshape((-1, 2))
+        n = len(self.points)
+        if cell_size is None:
+            if n:
+                extent = self.points.max(0) - self.points.min(0)
+                # about 4 points per cell
+                cell_size = np.sqrt(max(extent[0] * extent[1], 1.) * 4 / n)
+            else:
+                cell_size = 1.
+        self.cell_size = max(float(cell_size), 1e-6)
+        self.cells = {}
+        self.bounds = None
+        if n:
+            self.bounds = (self.points.min(0), self.points.max(0))
+            cells = np.floor(self.points / self.cell_size).astype(np.int64)
+            order = np.lexsort((cells[:, 1], cells[:, 0]))
+            sorted_cells = cells[order]
+            starts = np.flatnonzero(np.r_[True, (sorted_cells[1:] != sorted_cells[:-1]).any(1)])
+            for start, stop in zip(starts, np.r_[starts[1:], n]):
+                self.cells[tuple(sorted_cells[start].tolist())] = order[start:stop]
+
+    def __len__(self):
+        return len(self.points)
+
+    def in_rect(self, x0, y0, x1, y1):
+        '''
+        Returns an array of the indices of the points with x0 <= x <= x1 and
+        y0 <= y <= y1.
+        '''
+        cx0, cy0 = int(np.floor(x0 / self.cell_size)), int(np.floor(y0 / self.cell_size))
+        cx1, cy1 = int(np.floor(x1 / self.cell_size)), int(np.floor(y1 / self.cell_size))
+        if (cx1 - cx0 + 1) * (cy1 - cy0 + 1) > len(self.cells):
+            # fewer occupied cells than cells in the rect
+            candidates = [idx for (cx, cy), idx in self.cells.items()
+                          if cx0 <= cx <= cx1 and cy0 <= cy <= cy1]
+        else:
+            candidates = [self.cells[cell] for cell in
+                          [(cx, cy) for cx in range(cx0, cx1 + 1) for cy in range(cy0, cy1 + 1)]
+                          if cell in self.cells]
+        if not candidates:
+            return np.zeros(0, np.int64)
+        idx = np.concatenate(candidates)
+        x, y = self.points[idx, 0], self.points[idx, 1]
+        return np.sort(idx[(x >= x0) & (x <= x1) & (y >= y0) & (y <= y1)])
+
+    def nearest(self, x, y, max_distance=None):
+        '''
+        Returns the index of the point closest to (x, y), or None if there
+        are no points or none within max_distance.
+        '''
+        if not len(self.points):
+            return None
+        # start with a square reaching the bounding box of the points
+        lo, hi = self.bounds
+        r = max(self.cell_size, lo[0] - x, x - hi[0], lo[1] - y, y - hi[1])
+        while True:
+            if max_distance is not None:
+                r = min(r, max_distance)
+            idx = self.in_rect(x - r, y - r, x + r, y + r)
+            if len(idx):
+                d = ((self.points[idx] - (x, y)) ** 2).sum(1)
+                i = np.argmin(d)
+                # the square holds every point within r
+                if d[i] <= r * r:
+                    return int(idx[i])
+                # and the closest point is within the distance of this one
+                next_r = np.sqrt(d[i])
+            else:
+                next_r = r * 2
+            if max_distance is not None and r >= max_distance:
+                return None
+            r = next_r
+
+    def in_radius(self, x, y, r):
+        ''' Returns an array of the indices of the points within r of (x, y). '''
+        idx = self.in_rect(x - r, y - r, x + r, y + r)
+        return idx[((self.points[idx] - (x, y)) ** 2).sum(1) <= r * r]
+
+    def in_polygon(self, vertices):
+        '''
+        Returns an array of the indices of the points inside the polygon with
+        the given (x, y) vertices, by the even-odd rule.
+        '''
+        vertices = np.asarray(vertices, np.float64).reshape((-1, 2))
+        if len(vertices) < 3:
+            return np.zeros(0, np.int64)
+        (x0, y0), (x1, y1) = vertices.min(0), vertices.max(0)
+        idx = self.in_rect(x0, y0, x1, y1)
+        x, y = self.points[idx, 0], self.points[idx, 1]
+        inside = np.zeros(len(idx), bool)
+        for (ax, ay), (bx, by) in zip(vertices, np.roll(vertices, -1, 0)):
+            # edges crossing the horizontal line through each point, to its right
+            crosses = (ay > y) != (by > y)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                at = ax + (y - ay) * (bx - ax) / (by - ay)
+            inside ^= crosses & (x < at)
+        return idx[inside]
+
+
+class ObjectIndex(object):
+    '''
+    The objects of an image indexed by position.
+    obKeys: the object keys
+    points: the (x, y) coordinates of each object
+    '''
+    def __init__(self, obKeys, points):
+        self.obKeys = [tuple(obKey) for obKey in obKeys]
+        self.index = PointIndex(points)
+        self.positions = dict(zip(self.obKeys, [tuple(pt) for pt in self.index.points.tolist()]))
+
+    def __len__(self):
+        return len(self.obKeys)
+
+    def position(self, obKey):
+        ''' Returns the (x, y) of an object, or None if it isn't indexed. '''
+        return self.positions.get(tuple(obKey), None)
+
+    def nearest(self, x, y, max_distance=None):
+        ''' Returns the key of the object closest to (x, y), or None. '''
+        i = self.index.nearest(x, y, max_distance)
+        return None if i is None else self.obKeys[i]
+
+    def in_rect(self, x0, y0, x1, y1):
+        return [self.obKeys[i] for i in self.index.in_rect(x0, y0, x1, y1)]
+
+    def in_radius(self, x, y, r):
+        return [self.obKeys[i] for i in self.index.in_radius(x, y, r)]
+
+    def in_polygon(self, vertices):
+        return [self.obKeys[i] for i in self.index.in_polygon(vertices)]
@@ -2,14 +2,16 @@
 #require "thread"
 #!/usr/bin/env python
 
+from __future__ import with_statement
 # TODO:
-# Multiprocessing module for Python 2.5, substitute linear_scale for lambda,
+# Substitute linear_scale for lambda,
 # change the c and g intervals definition, maybe use np.nan_to_num before scaling
 
 import dbconnect
 import dimensredux as dr
 import logging
 import numpy as np
+import util
 import wx
 from datamodel import DataModel
 from properties import Properties
@@ -70,9 +72,13 @@ class SupportVectorMachines(object):
         self.classBins = []
         self.classifier = classifier
         self.percentile = 90
+        # Number of processes for grid search and cross-validation, None
+        # for the classifier_workers property (1 unless the user raises it:
+        # cpa.py has been seen to crash with more)
+        self.n_workers = None
 
-        # Initialize the total object storage
-        self.perClassObjects = {}
+        # Keys and classes of all objects scored by PerImageCounts
+        self.objectKeys, self.objectClasses = None, None
         self.feat_min, self.feat_max = None, None
         self.svm_train_labels, self.svm_train_values = None, None
 
@@ -130,20 +136,18 @@ class SupportVectorMachines(object):
         if actual is None or predicted is None:
             for actualClassNum, actualClassObjects in \
                 enumerate([bin.GetObjectKeys() for bin in self.classBins]):
-                for predictedLabel in [(classLabels[i], i) for i in range(nClasses)]:
-                    confusionMatrix[predictedLabel[1], actualClassNum] += \
-                        len([obj for obj in actualClassObjects if \
-                        obj in self.perClassObjects[predictedLabel[0]]])
-        else:
-            # Generate the confusion matrix for a list of actual and predicted classes
-            for i, actualClass in enumerate(actual):
-                # Count the number of correct classifications and store them in the
-                # confusion matrix
-                actualClass = np.int(actualClass)
-
-                # Count all misclassifications
-                for j in predicted[i]:
-                    confusionMatrix[np.int(j), actualClass] += 1
+                if actualClassObjects:
+                    keys, values = self.FetchObjectValues(actualClassObjects)
+                    confusionMatrix[:, actualClassNum] += \
+                        np.bincount(self.PredictClasses(values) - 1, minlength=nClasses)
+        elif len(actual) > 0:
+            # Generate the confusion matrix for a list of actual and predicted
+            # classes, counting all (mis)classifications of each object
+            actualClasses = np.concatenate([[actualClass] * len(predicted[i])
+                                            for i, actualClass in enumerate(actual)]).astype(int)
+            predictedClasses = np.concatenate([np.asarray(p) for p in predicted]).astype(int)
+            confusionMatrix += np.bincount(predictedClasses * nClasses + actualClasses,
+                                           minlength=nClasses * nClasses).reshape((nClasses, nClasses))
 
         return confusionMatrix, classLabels
 
@@ -157,62 +161,70 @@ class SupportVectorMachines(object):
 
     def CreatePerObjectClassTable(self, classes):
         '''
-    	Saves object keys and classes to a SQL table
+    	Saves the object keys and classes found by PerImageCounts to a SQL table
     	'''
         p = Properties.getInstance()
         if p.class_table is None:
             raise ValueError('"class_table" in properties file is not set.')
 
         index_cols = dbconnect.UniqueObjectClause()
-        class_cols = dbconnect.UniqueObjectClause() + ', class, class_number'
-        class_col_defs = dbconnect.object_key_defs() + ', class VARCHAR (%d)'%(max([len(c.label) for c in self.classBins])+1) + ', class_number INT'
+        class_cols = list(dbconnect.object_key_columns()) + ['class', 'class_number']
+        class_col_defs = dbconnect.object_key_defs() + ', class VARCHAR (%d)'%(max([len(c) for c in classes])+1) + ', class_number INT'
+        class_col_types = ['INT'] * len(dbconnect.object_key_columns()) + ['VARCHAR', 'INT']
 
-        # Drop must be explicitly asked for Classifier.ScoreAll
+        # Write a new table and swap it in once complete
+        db = dbconnect.DBConnect.getInstance()
+        table = p.class_table + '_new'
+        db.execute('DROP TABLE IF EXISTS %s'%(table))
+        db.execute('CREATE TABLE %s (%s)'%(table, class_col_defs))
+        if self.objectKeys is not None:
+            rows = (tuple(key) + (classes[clNum-1], clNum)
+                    for key, clNum in zip(self.objectKeys.tolist(), self.objectClasses.tolist()))
+            db.insert_rows_into_table(table, class_cols, class_col_types, rows)
+        # indexing after loading is faster than maintaining the index while inserting
+        db.replace_table(table, p.class_table, index_cols)
+        db.Commit()
+
+    def FetchObjectValues(self, keys):
+        '''
+        Fetches the classifier columns of objects in one query.
+        keys: a list of object keys, a list of image keys whose objects are 
+              fetched, or a string WHERE clause
+        Returns an int array of object keys and a float array of values, with
+        non-numeric and NULL values set to 0 as in the training set.
+        '''
+        p = Properties.getInstance()
         db = dbconnect.DBConnect.getInstance()
-        db.execute('DROP TABLE IF EXISTS %s'%(p.class_table))
-        db.execute('CREATE TABLE %s (%s)'%(p.class_table, class_col_defs))
-        db.execute('CREATE INDEX idx_%s ON %s (%s)'%(p.class_table, p.class_table, index_cols))
-        for clNum, clName in enumerate(self.perClassObjects.keys()):
-            for obj in self.perClassObjects[clName]:
-                query = ''.join(['INSERT INTO ',p.class_table,' (',class_cols,') VALUES (',str(obj[0]),', ',str(obj[1]),', "',clName,'", ',str(clNum+1),')'])
-                db.execute(query)
-
-        if p.db_type.lower() == 'mysql':
-            query = ''.join(['ALTER TABLE ',p.class_table,' ORDER BY ',p.image_id,' ASC, ',p.object_id,' ASC'])
-            db.execute(query)
-            db.Commit()
+        if isinstance(keys, str):
+            whereclause = keys
+        elif len(keys[0]) == len(dbconnect.image_key_columns()):
+            whereclause = dbconnect.GetWhereClauseForImages(list(keys))
+        else:
+            whereclause = dbconnect.GetWhereClauseForImageObjects(keys)
+        colnames = db.GetColnamesForClassifier()
+        nkeycols = len(dbconnect.object_key_columns())
+        res = db.execute('SELECT %s, %s FROM %s WHERE %s'%(dbconnect.UniqueObjectClause(), 
+                         ', '.join(['`%s`'%c for c in colnames]), p.object_table, whereclause), silent=True)
+        keys = np.array([row[:nkeycols] for row in res], np.int32).reshape((-1, nkeycols))
+        values = np.array([[x if type(x) in [int, long, float] else 0.0 for x in row[nkeycols:]]
+                           for row in res], np.float64).reshape((-1, len(colnames)))
+        return keys, values
 
     def FilterObjectsFromClassN(self, classN = None, keys = None):
         '''
     	Filter the input objects to output the keys of those in classN, 
     	using a defined SVM model classifier.
     	'''
-        # Retrieve instance of the database connection
-        db = dbconnect.DBConnect.getInstance()
-        object_data = {}
-        if isinstance(keys, str):
-            object_data[0] = db.GetCellDataForClassifier(keys)
-        elif keys != []:
-            if len(keys) == len(dbconnect.image_key_columns()):
-                # Retrieve instance of the data model and retrieve objects in the requested image
-                dm = DataModel.getInstance()
-                obKeys = dm.GetObjectsFromImage(keys[0])
-            else:
-                obKeys = keys
-            for key in obKeys:
-                object_data[key] = db.GetCellDataForClassifier(key)
-
-        sorted_keys = sorted(object_data.keys())
-        values_array = np.array([object_data[key] for key in sorted_keys])
-        scaled_values = self.ScaleData(values_array)
-        pred_labels = self.model.predict(scaled_values)
-
-        # Group the object keys per class
         classObjects = {}
         for index in range(1, len(self.classBins)+1):
             classObjects[float(index)] = []
-        for index, label in enumerate(pred_labels):
-            classObjects[np.int(label)+1].append(sorted_keys[index])
+        if keys:
+            obKeys, values = self.FetchObjectValues(keys)
+            if len(obKeys) > 0:
+                # Group the object keys per class
+                order = np.lexsort(obKeys.T[::-1])
+                for key, clNum in zip(obKeys[order].tolist(), self.PredictClasses(values[order]).tolist()):
+                    classObjects[clNum].append(tuple(key))
 
         # Return either a summary of all classes and their corresponding objects
         # or just the objects for a specific class
@@ -242,29 +254,25 @@ class SupportVectorMachines(object):
         finally:
             fh.close()
 
+    def WorkerCount(self):
+        ''' Returns the number of processes to use, see n_workers. '''
+        if self.n_workers is not None:
+            return util.worker_count(self.n_workers)
+        return util.worker_count(int(Properties.getInstance().classifier_workers) or None)
+
     def ParameterGridSearch(self, callback = None, nValidation = 5):
         '''
         Grid search for the best C and gamma parameters for the RBF Kernel.
         The efficiency of the parameters is evaluated using nValidation-fold
         cross-validation of the training data.
     
-        As this process is time consuming and parallelizable, a number of
-        threads equal to the number of cores in the computer is used for the
-        calculations
+        As this process is time consuming and parallelizable, it can use
+        several processes for the calculations (see WorkerCount)
         '''
         from scikits.learn.grid_search import GridSearchCV
         from scikits.learn.metrics import precision_score
         from scikits.learn.cross_val import StratifiedKFold
-        # 
-        # XXX: program crashes with >1 worker when running cpa.py
-        #      No crash when running from classifier.py. Why?
-        #
-        n_workers = 1
-        #try:
-            #from multiprocessing import cpu_count
-            #n_workers = cpu_count()
-        #except:
-            #n_workers = 1
+        n_workers = self.WorkerCount()
 
         # Define the parameter ranges for C and gamma and perform a grid search for the optimal setting
         parameters = {'C': 2**np.arange(-5,11,2, dtype=float),
@@ -282,55 +290,49 @@ class SupportVectorMachines(object):
         return bestC, bestGamma
 
     def PerImageCounts(self, filter_name=None, cb=None):
-        # Clear the current perClassObjects storage
-        for bin in self.classBins:
-            self.perClassObjects[bin.label] = []
-
+        '''
+        Classifies the objects of all images, a block of images at a time.
+        Returns a list of rows of the image key followed by the number of
+        objects in each class, and keeps the class of every object for
+        CreatePerObjectClassTable.
+        '''
         # Retrieve a data model instance
         dm = DataModel.getInstance()
 
         # Retrieve image keys and initialize variables
-        imageKeys = dm.GetAllImageKeys(filter_name)
-        imageAmount = float(len(imageKeys))
-        perImageData = []
-
-        # Process all images
-        for k_index, imKey in enumerate(imageKeys):
-            try:
-                # Retrieve the keys of the objects in the current image
-                obKeys = dm.GetObjectsFromImage(imKey)
-            except:
-                raise 'No such image: %s' % (imKey,)
-                return
-
-            # Calculate the amount of hits for each of the classes in the current image
-            classHits = {}
-            objectCount = [imKey[0]]
-            if obKeys:
-                classObjects = self.FilterObjectsFromClassN(keys = [imKey])
-                for clNum, bin in enumerate(self.classBins):
-                    # Get the objects from the image which belong to the selected class
-                    classHits[bin.label] = classObjects[float(clNum+1)]
-
-                    # Store the total object count of this class for the current image
-                    nrHits = len(classHits[bin.label])
-                    objectCount.append(nrHits)
-
-                    # Store the objects for the current class and image grouped
-                    # by class if any are found for this class in the selected image
-                    if nrHits > 0:
-                        self.perClassObjects[bin.label] += classHits[bin.label]
-            else:
-                # If there are objects in the image, add zeros for all bins
-                [objectCount.append(0) for bin in self.classBins]
-
-            # Store the results for the current image and update the callback
-            # function if available
-            perImageData.append(objectCount)
+        imageKeys = [tuple(imKey) for imKey in dm.GetAllImageKeys(filter_name)]
+        imageIndex = dict((imKey, index) for index, imKey in enumerate(imageKeys))
+        counts = np.zeros((len(imageKeys), len(self.classBins)), int)
+        objectKeys, objectClasses = [], []
+
+        # Process the images in blocks
+        for start in range(0, len(imageKeys), dbconnect.IMAGES_PER_QUERY):
+            block = imageKeys[start:start + dbconnect.IMAGES_PER_QUERY]
+            keys, values = self.FetchObjectValues(block)
+            if len(keys) > 0:
+                classes = self.PredictClasses(values)
+                rows = np.array([imageIndex[tuple(imKey)] for imKey in keys[:, :-1].tolist()])
+                counts += np.bincount(rows * counts.shape[1] + classes - 1,
+                                      minlength=counts.size).reshape(counts.shape)
+                objectKeys.append(keys)
+                objectClasses.append(classes.astype(np.int16))
+
+            # Update the callback function if available
             if cb:
-                cb(min(1, k_index/imageAmount))
+                cb(min(1, (start + len(block)) / float(len(imageKeys))))
 
-        return perImageData
+        if objectKeys:
+            self.objectKeys = np.vstack(objectKeys)
+            self.objectClasses = np.concatenate(objectClasses)
+        else:
+            self.objectKeys, self.objectClasses = None, None
+        return [list(imKey) + counts[index].tolist() for index, imKey in enumerate(imageKeys)]
+
+    def PredictClasses(self, values):
+        '''
+        Returns the class numbers (starting at 1) predicted for each row of values.
+        '''
+        return np.asarray(self.model.predict(self.ScaleData(values))).astype(int) + 1
 
     def SaveModel(self, model_file_name, bin_labels):       
         import cPickle
@@ -390,12 +392,17 @@ class SupportVectorMachines(object):
     def UpdateBins(self, classBins):
         self.classBins = classBins
 
-        # Reinitialize the objects per class storage
-        self.perClassObjects = {}
-        for bin in self.classBins:
-            self.perClassObjects[bin.label] = []
+        # Scored objects no longer match the classes
+        self.objectKeys, self.objectClasses = None, None
 
-    def XValidate(self, nPermutations):
+    def XValidate(self, nPermutations, seed=None):
+        '''
+        Cross-validate the classifier over nPermutations random splits of
+        the training set.  Folds are trained on WorkerCount() processes;
+        given a seed the splits, and so the results, are reproducible.
+        Returns, for each training object, the list of wrong classes it
+        was assigned to.
+        '''
         # Make sure all data is available in the training set
         if not self.classifier.UpdateTrainingSet():
             return
@@ -430,13 +437,7 @@ class SupportVectorMachines(object):
                                ('svc', SVC(kernel='rbf', C=C, gamma=gamma, eps=0.1))])
         nObjects = self.classifier.trainingSet.label_matrix.shape[0]
         subsetSize = np.ceil(nObjects / float(totalGroups))
-        indices = np.arange(nObjects)
         misclassifications = [[] for i in range(nObjects)]
-
-        # Create group combinations and arrays of all labels and values
-        dt = ','.join('i'*trainingGroups)
-        trainingTotalGroups = list(np.fromiter(combinations(range(totalGroups),trainingGroups), dtype=dt, count=-1))
-        #trainingTotalGroups = list(combinations(range(totalGroups), trainingGroups))
         allLabels = np.array(self.svm_train_labels)
         allValues = np.array(self.svm_train_values)
 
@@ -449,33 +450,28 @@ class SupportVectorMachines(object):
         dlg = wx.ProgressDialog('Calculating average cross-validation accuracy...', '0% Complete', 100,
                                 self.classifier, wx.PD_ELAPSED_TIME | wx.PD_ESTIMATED_TIME | 
                                 wx.PD_REMAINING_TIME | wx.PD_CAN_ABORT)
-        nTrainingTotalGroups = len(trainingTotalGroups)
-        nOperations = float(nPermutations * nTrainingTotalGroups)
-        for per in range(nPermutations):
-            # Split the training set into subsets
-            np.random.shuffle(indices)
-            lastGroupStart = (totalGroups-1)*subsetSize
-            subsets = np.hsplit(indices[0:lastGroupStart], (totalGroups-1))
-            subsets.append(indices[lastGroupStart:],)
 
-            for index, group in enumerate(trainingTotalGroups):
-                # Retrieve indices of all objects in the training set
-                trainingSet = np.hstack([subsets[i] for i in range(totalGroups) if i in group])
-
-                # Train a classifier on the subset
-                classifier.fit(allValues[trainingSet], allLabels[trainingSet])
-
-                # Predict the test set using the trained classifier
-                testSet = np.hstack([subsets[i] for i in range(totalGroups) if i not in group])
-                testLabels = classifier.predict(allValues[testSet])
-
-                # Store all misclassifications
-                [misclassifications[testSet[i]].append(testLabels[i]) \
-                    for i in range(len(testLabels)) \
-                    if testLabels[i] != allLabels[testSet][i]]
+        # Split the training set into random subsets for each permutation,
+        # every combination of trainingGroups subsets is one fold
+        random_state = np.random.RandomState(seed)
+        tasks = []
+        for per in range(nPermutations):
+            subsetOfObject = np.empty(nObjects, int)
+            subsetOfObject[random_state.permutation(nObjects)] = np.arange(nObjects) // subsetSize
+            for group in combinations(range(totalGroups), trainingGroups):
+                trainingSet = np.nonzero(np.in1d(subsetOfObject, group))[0]
+                testSet = np.nonzero(~ np.in1d(subsetOfObject, group))[0]
+                tasks.append((classifier, allValues[trainingSet], allLabels[trainingSet],
+                              allValues[testSet], testSet))
+
+        # Train and test the folds in parallel, storing all misclassifications
+        with util.process_pool(self.WorkerCount()) as pool:
+            for index, (testSet, testLabels) in enumerate(pool.imap(_fit_and_predict, tasks)):
+                for i in np.nonzero(testLabels != allLabels[testSet])[0]:
+                    misclassifications[testSet[i]].append(testLabels[i])
 
                 # Update progress dialog
-                cb((nTrainingTotalGroups * per + index) / nOperations)
+                cb((index + 1) / float(len(tasks)))
 
         # Calculate average classification accuracy
         dlg.Destroy()
@@ -485,6 +481,13 @@ class SupportVectorMachines(object):
 
         return misclassifications
 
+def _fit_and_predict((classifier, trainingValues, trainingLabels, testValues, testSet)):
+    '''
+    Fits the classifier on the training data and predicts the test data.  Defined at module level so it can be run in a multiprocessing Pool.
+    '''
+    classifier.fit(trainingValues, trainingLabels)
+    return testSet, classifier.predict(testValues)
+
 class visualizationChoiceBox(wx.Frame):
     def __init__(self, parent, id, title, btn1Cb = None, btn2Cb = None):
         # Initialize frame and containing panel
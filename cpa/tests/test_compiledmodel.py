@@ -0,0 +1,42 @@
+import tempfile
+import numpy as np
+from nose.tools import assert_raises
+from cpa.compiledmodel import CompiledModel, is_compiled_model
+from cpa.objectscores import score_values
+
+learners = [('f0', 0.5, np.array([1.0, -1.0]), np.array([-1.0, 1.0]), 0.0),
+            ('f1', 0.0, np.array([0.5, -0.5]), np.array([-0.25, 0.25]), 0.0),
+            ('f0', 2.0, np.array([3.0, -3.0]), np.array([0.0, 0.0]), 0.0)]
+colnames = ['f0', 'f1', 'f2']
+
+def test_margins_match_score_values():
+    model = CompiledModel.FromLearners(learners, ['pos', 'neg'], colnames)
+    values = np.array([[1.0, 1.0], [3.0, -1.0], [np.nan, np.nan]])
+    np.testing.assert_allclose(model.margins(values), score_values(learners, ['f0', 'f1'], values, 2))
+    np.testing.assert_array_equal(model.classify(values), [1, 1, 2])
+
+def test_save_and_load():
+    model = CompiledModel.FromLearners(learners, [u'pos', 'neg'], colnames)
+    filename = tempfile.mktemp()
+    model.Save(filename)
+    assert is_compiled_model(filename)
+    loaded = CompiledModel.Load(filename, colnames=colnames)
+    assert loaded.columns == ['f0', 'f1']
+    assert loaded.labels == ['pos', 'neg']
+    assert loaded.schema == model.schema
+    for (c1, t1, a1, b1, e1), (c2, t2, a2, b2, e2) in zip(loaded.learners(), learners):
+        assert c1 == c2 and t1 == t2
+        np.testing.assert_array_equal(a1, a2)
+        np.testing.assert_array_equal(b1, b2)
+
+def test_load_validates_columns():
+    filename = tempfile.mktemp()
+    CompiledModel.FromLearners(learners, ['pos', 'neg'], colnames).Save(filename)
+    assert_raises(ValueError, CompiledModel.Load, filename, True, ['f1', 'f2'])
+    CompiledModel.Load(filename, False)
+
+def test_scaling():
+    model = CompiledModel(['f0'], [0], [1.0], [[1.0, 0.0]], [[0.0, 1.0]], ['a', 'b'],
+                          offset=[10.0], scale=[0.5])
+    np.testing.assert_array_equal(model.classify(np.array([[11.0], [13.0]])), [2, 1])
+    np.testing.assert_allclose(model._scaled_thresholds(), [12.0])
@@ -0,0 +1,22 @@
+import numpy as np
+from cpa import dirichletintegrate
+
+def check_batch_matches_score(K):
+    rs = np.random.RandomState(K)
+    alpha = rs.uniform(0.5, 3, K)
+    counts = rs.poisson(3, (50, K))
+    expected = np.clip([dirichletintegrate.score(alpha, c) for c in counts], 0, 1)
+    np.testing.assert_allclose(dirichletintegrate.score_batch(alpha, counts, n_workers=1),
+                               expected, atol=1e-6)
+
+def test_score_batch_matches_score():
+    for K in [2, 3]:
+        yield check_batch_matches_score, K
+
+def test_score_batch_scores_each_count_vector_once():
+    alpha = np.array([1.5, 2.5])
+    counts = np.array([[0, 0], [3, 1], [0, 0], [3, 1]])
+    scores = dirichletintegrate.score_batch(alpha, counts, n_workers=1)
+    assert len(dirichletintegrate._score_cache['scores']) == 2
+    np.testing.assert_array_equal(scores[0], scores[2])
+    np.testing.assert_allclose(scores.sum(axis=1), 1.0)
@@ -0,0 +1,70 @@
+import numpy as np
+from cpa.fastgentleboosting import FastGentleBoosting, assign_folds
+
+def make_training_set(n=60, seed=0):
+    rs = np.random.RandomState(seed)
+    values = rs.normal(size=(n, 4)).astype(np.float32)
+    labels = (values[:, 0] + 0.5 * rs.normal(size=n) > 0).astype(int)
+    label_matrix = -np.ones((n, 2), np.int32)
+    label_matrix[np.arange(n), labels] = 1
+    return ['f%d' % i for i in range(4)], label_matrix, values
+
+def test_assign_folds_keeps_groups_together():
+    groups = [(i % 7,) for i in range(70)]
+    folds = assign_folds(groups, 3, np.random.RandomState(1))
+    for g in set(groups):
+        members = [f for f, h in zip(folds, groups) if h == g]
+        assert len(set(members)) == 1
+    assert set(folds) == set([0, 1, 2])
+
+def test_assign_folds_single_group():
+    folds = assign_folds(['a'] * 20, 20, np.random.RandomState(1))
+    assert sorted(folds) == range(20)
+
+def test_xvalidate_reproducible_with_seed():
+    colnames, label_matrix, values = make_training_set()
+    groups = range(len(values))
+    fgb = FastGentleBoosting()
+    serial = fgb.XValidate(colnames, 5, label_matrix, values, 3, groups,
+                           None, seed=42, repeats=2, n_workers=1)
+    parallel = fgb.XValidate(colnames, 5, label_matrix, values, 3, groups,
+                             None, seed=42, repeats=2, n_workers=2)
+    assert len(serial) == 2
+    for s, p in zip(serial, parallel):
+        assert np.array_equal(s, p)
+        assert s.shape == (5,)
+
+def test_warm_start_more_rules_matches_cold_start():
+    colnames, label_matrix, values = make_training_set()
+    keys = [(1, i) for i in range(len(values))]
+    cold = FastGentleBoosting()
+    cold.Train(colnames, 8, label_matrix, values)
+    warm = FastGentleBoosting()
+    warm.Train(colnames, 5, label_matrix, values, keys=keys, warm_start=True)
+    warm.Train(colnames, 8, label_matrix, values, keys=keys, warm_start=True)
+    removed, added = warm.changed_learners
+    assert removed == [] and len(added) == 3
+    assert [l[:2] for l in warm.model] == [l[:2] for l in cold.model]
+    assert np.allclose([l[4] for l in warm.model], [l[4] for l in cold.model])
+
+def test_warm_start_new_examples_retrains_last_rules():
+    colnames, label_matrix, values = make_training_set(80)
+    keys = [(1, i) for i in range(len(values))]
+    fgb = FastGentleBoosting()
+    fgb.Train(colnames, 10, label_matrix[:60], values[:60], keys=keys[:60], warm_start=True)
+    first = list(fgb.model)
+    fgb.Train(colnames, 10, label_matrix, values, keys=keys, warm_start=True)
+    removed, added = fgb.changed_learners
+    # 20 of 80 examples are new, so a quarter of the rules is retrained
+    assert len(removed) == 3 and len(added) == 3
+    assert [l[:2] for l in fgb.model[:7]] == [l[:2] for l in first[:7]]
+    assert fgb.margins.shape == label_matrix.shape
+
+def test_warm_start_relabelled_examples_trains_from_scratch():
+    colnames, label_matrix, values = make_training_set()
+    keys = [(1, i) for i in range(len(values))]
+    fgb = FastGentleBoosting()
+    fgb.Train(colnames, 5, label_matrix, values, keys=keys, warm_start=True)
+    fgb.Train(colnames, 5, -label_matrix, values, keys=keys, warm_start=True)
+    removed, added = fgb.changed_learners
+    assert len(removed) == 5 and len(added) == 5
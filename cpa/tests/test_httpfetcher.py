@@ -0,0 +1,167 @@
+import BaseHTTPServer
+import os
+import shutil
+import SocketServer
+import tempfile
+import threading
+from cpa.httpfetcher import DiskCache, HTTPFetcher
+
+class FileHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''Serves the files of the server's directory, with range requests and
+    keep-alive, and counts requests and connections.'''
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_GET(self):
+        self.server.requests.append((self.path, self.headers.get('Range')))
+        try:
+            data = open(os.path.join(self.server.directory, self.path.lstrip('/')), 'rb').read()
+        except IOError:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        status = 200
+        byte_range = self.headers.get('Range')
+        if byte_range and self.server.ranges:
+            start, stop = byte_range.split('=')[1].split('-')
+            start, stop = int(start), min(int(stop) + 1, len(data))
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d'%(start, stop - 1, len(data)))
+            data = data[start:stop]
+        else:
+            self.send_response(status)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+def serve(directory, ranges=True):
+    '''Starts a server of directory's files, returns it and its base url.'''
+    server = Server(('127.0.0.1', 0), FileHandler)
+    server.directory = directory
+    server.ranges = ranges
+    server.requests = []
+    server.connections = 0
+    thread = threading.Thread(target=server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+    return server, 'http://127.0.0.1:%d/'%(server.server_address[1])
+
+directory = None
+server = None
+url = None
+
+def setup():
+    global directory, server, url
+    directory = tempfile.mkdtemp()
+    os.mkdir(os.path.join(directory, 'images'))
+    for i in range(6):
+        f = open(os.path.join(directory, 'images', 'im%d.tif'%(i)), 'wb')
+        f.write(''.join([chr((i + j) % 256) for j in range(1000)]))
+        f.close()
+    server, url = serve(os.path.join(directory, 'images'))
+
+def teardown():
+    server.shutdown()
+    server.server_close()
+    shutil.rmtree(directory)
+
+def expected(i):
+    return ''.join([chr((i + j) % 256) for j in range(1000)])
+
+def test_keep_alive():
+    fetcher = HTTPFetcher(max_connections=1)
+    connections = server.connections
+    for i in range(3):
+        assert fetcher.Get(url + 'im%d.tif'%(i)) == expected(i)
+    assert fetcher.requests == 3
+    assert fetcher.connections == 1
+    assert server.connections == connections + 1
+    fetcher.close()
+
+def test_get_many():
+    fetcher = HTTPFetcher(max_connections=3)
+    urls = [url + 'im%d.tif'%(i) for i in range(6)]
+    assert fetcher.GetMany(urls) == [expected(i) for i in range(6)]
+    assert fetcher.connections <= 3
+    try:
+        fetcher.GetMany([url + 'missing.tif'])
+        assert False
+    except IOError:
+        pass
+    fetcher.close()
+
+def test_disk_cache():
+    cache = DiskCache(os.path.join(directory, 'cache'), 10000)
+    fetcher = HTTPFetcher(cache)
+    del server.requests[:]
+    assert fetcher.Get(url + 'im1.tif') == expected(1)
+    fetcher.close()
+    assert fetcher.Get(url + 'im1.tif') == expected(1)
+    filename, temporary = fetcher.GetFile(url + 'im1.tif')
+    assert not temporary and filename.endswith('.tif')
+    assert open(filename, 'rb').read() == expected(1)
+    assert fetcher.GetRange(url + 'im1.tif', 10, 20) == expected(1)[10:20]
+    assert len(server.requests) == 1
+    # a new cache of the same directory finds the files
+    fetcher = HTTPFetcher(DiskCache(os.path.join(directory, 'cache'), 10000))
+    assert fetcher.Get(url + 'im1.tif') == expected(1)
+    assert len(server.requests) == 1
+    cache.clear()
+
+def test_eviction():
+    cache = DiskCache(os.path.join(directory, 'evict'), 2500)
+    fetcher = HTTPFetcher(cache)
+    for i in range(3):
+        fetcher.Get(url + 'im%d.tif'%(i))
+    # im0 is the least recently used
+    assert cache.path(url + 'im0.tif') is None
+    assert cache.get(url + 'im2.tif') == expected(2)
+    assert cache.nbytes == 2000
+    # using im1 makes im2 the least recently used
+    cache.path(url + 'im1.tif')
+    fetcher.Get(url + 'im3.tif')
+    assert cache.path(url + 'im2.tif') is None
+    assert cache.path(url + 'im1.tif') is not None
+    fetcher.close()
+
+def test_ranges():
+    fetcher = HTTPFetcher()
+    del server.requests[:]
+    assert fetcher.GetRange(url + 'im4.tif', 100, 150) == expected(4)[100:150]
+    assert fetcher.GetRange(url + 'im4.tif', 990, 1200) == expected(4)[990:]
+    assert server.requests[0] == ('/im4.tif', 'bytes=100-149')
+    assert fetcher.GetSize(url + 'im4.tif') == 1000
+    f = fetcher.Open(url + 'im4.tif')
+    f.block_size = 64
+    f.seek(500)
+    assert f.read(10) == expected(4)[500:510]
+    f.seek(-5, 2)
+    assert f.read() == expected(4)[-5:]
+    f.prefetch([(0, 64), (128, 200)])
+    nrequests = len(server.requests)
+    assert f.read_range(130, 140) == expected(4)[130:140]
+    assert len(server.requests) == nrequests
+    fetcher.close()
+
+def test_no_range_support():
+    plain, plain_url = serve(os.path.join(directory, 'images'), ranges=False)
+    try:
+        fetcher = HTTPFetcher(DiskCache(os.path.join(directory, 'plain'), 10000))
+        assert fetcher.GetRange(plain_url + 'im5.tif', 5, 10) == expected(5)[5:10]
+        # the whole file came back, so it was cached
+        assert fetcher.Get(plain_url + 'im5.tif') == expected(5)
+        assert len(plain.requests) == 1
+        fetcher.close()
+    finally:
+        plain.shutdown()
+        plain.server_close()
@@ -0,0 +1,50 @@
+import shutil
+import tempfile
+import numpy as np
+from cpa.imagecache import ImageCache
+
+def image(value, n=2):
+    # channels of 1000 bytes
+    return [np.zeros(250, np.float32) + value for i in range(n)]
+
+def test_lru_eviction():
+    cache = ImageCache(4000, min_images=0)
+    cache.put_image((1,), image(1))
+    cache.put_image((2,), image(2))
+    assert cache.get_image((1,))[0][0] == 1
+    cache.put_image((3,), image(3))
+    assert cache.get_image((2,)) is None
+    assert cache.get_image((1,)) is not None
+    assert cache.get_image((3,)) is not None
+    stats = cache.stats()
+    assert stats['evictions'] == 2
+    assert stats['bytes'] <= 4000
+    assert stats['hits'] == 6
+
+def test_min_images_and_pins():
+    cache = ImageCache(1000, min_images=1)
+    cache.put_image((1,), image(1))
+    assert cache.get_image((1,)) is not None
+    cache.pin((1,))
+    cache.put_image((2,), image(2))
+    assert cache.get_image((1,)) is not None
+    assert cache.get_image((2,)) is None
+    cache.unpin((1,))
+    assert cache.get_image((1,)) is not None
+    cache.put_image((3,), image(3))
+    assert cache.get_image((1,)) is None
+
+def test_spill():
+    spill_dir = tempfile.mkdtemp()
+    try:
+        cache = ImageCache(4000, min_images=0, spill_dir=spill_dir, spill_bytes=4000)
+        for i in range(1, 4):
+            cache.put_image((i,), image(i))
+        assert cache.stats()['spilled_entries'] == 2
+        imgs = cache.get_image((1,))
+        assert imgs[1][0] == 1 and imgs[0].dtype == np.float32
+        assert cache.stats()['spill_hits'] == 2
+        cache.clear()
+        assert cache.stats()['spilled_bytes'] == 0
+    finally:
+        shutil.rmtree(spill_dir)
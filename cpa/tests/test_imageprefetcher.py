@@ -0,0 +1,35 @@
+import threading
+import time
+from cpa.imageprefetcher import ImagePrefetcher
+
+def test_prefetch():
+    fetched = []
+    release = threading.Event()
+    def fetch(imKey):
+        release.wait()
+        fetched.append(imKey)
+    prefetcher = ImagePrefetcher(fetch, nthreads=1, max_pending=4)
+    try:
+        prefetcher.Prefetch([(1,)])
+        # wait for the thread to start reading (1,)
+        for i in range(100):
+            if not prefetcher.Pending():
+                break
+            time.sleep(0.01)
+        prefetcher.Prefetch([(2,), (3,), (1,)])
+        prefetcher.Prefetch([(4,)], first=False)
+        prefetcher.Prefetch([(5,), (3,)])
+        # images being read aren't queued again, the oldest are dropped
+        assert prefetcher.Pending() == [(5,), (3,), (2,), (4,)]
+        prefetcher.Prefetch([(6,)], first=False)
+        assert prefetcher.Pending() == [(5,), (3,), (2,), (4,)]
+        prefetcher.Prefetch([(6,)], first=False, max_pending=2)
+        assert prefetcher.Pending() == [(5,), (3,)]
+        release.set()
+        for i in range(100):
+            if len(fetched) == 3:
+                break
+            time.sleep(0.01)
+        assert fetched == [(1,), (5,), (3,)]
+    finally:
+        prefetcher.abort()
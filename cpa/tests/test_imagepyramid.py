@@ -0,0 +1,37 @@
+import numpy as np
+from cpa.imagepyramid import ImagePyramid, GetPyramid
+
+def test_levels():
+    im = np.arange(35, dtype=np.float32).reshape(5, 7)
+    pyramid = ImagePyramid(im)
+    assert pyramid.level(0) is im
+    level = pyramid.level(1)
+    assert level.shape == (3, 4)
+    assert level[0, 0] == im[:2, :2].mean()
+    # odd edges repeat the last row and column
+    assert level[2, 3] == im[4, 6]
+    assert pyramid.level(2).shape == (2, 2)
+    assert pyramid.nbytes == level.nbytes + pyramid.level(2).nbytes
+
+def test_level_for_scale():
+    pyramid = ImagePyramid(np.zeros((64, 100)))
+    assert [pyramid.level_for_scale(s) for s in [2, 1, 0.75, 0.5, 0.3, 0.25, 0.01]] == \
+           [0, 0, 0, 1, 1, 2, 5]
+
+def test_region():
+    rs = np.random.RandomState(0)
+    im = rs.rand(20, 30).astype(np.float32)
+    pyramid = ImagePyramid(im)
+    np.testing.assert_array_equal(pyramid.region(1.0, (3, 4, 13, 9)), im[4:9, 3:13])
+    # zoomed in, display pixels map to the nearest pixel
+    np.testing.assert_array_equal(pyramid.region(2.0, (0, 0, 60, 40)),
+                                  im.repeat(2, 0).repeat(2, 1))
+    np.testing.assert_array_equal(pyramid.region(0.5, (0, 0, 15, 10)), pyramid.level(1))
+    # past the edge
+    assert pyramid.region(1.0, (25, 15, 35, 25)).shape == (10, 10)
+
+def test_get_pyramid():
+    im = np.ones((4, 4))
+    assert GetPyramid(im) is GetPyramid(im)
+    assert GetPyramid(im) is not GetPyramid(np.ones((4, 4)))
+    assert GetPyramid(im).binary
@@ -0,0 +1,199 @@
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import zlib
+import numpy as np
+from cpa.properties import Properties
+from cpa.imagestats import ChannelStats
+from cpa.imagereader import ImageReader, choose_decoders, get_decoder
+
+p = Properties.getInstance()
+directory = None
+
+def setup():
+    global directory
+    directory = tempfile.mkdtemp()
+    p.image_url_prepend = directory
+    p.image_rescale = None
+    p.channels_per_image = ['1']
+
+def teardown():
+    shutil.rmtree(directory)
+
+def write_tiff(filename, im, rows_per_strip=None, tile=None, compress=False, max_sample=None):
+    '''Writes a single channel little endian TIFF with strips or tiles.'''
+    h, w = im.shape
+    if tile:
+        th, tw = tile
+        padded = np.zeros((-(-h // th) * th, -(-w // tw) * tw), im.dtype)
+        padded[:h, :w] = im
+        blocks = [padded[y:y + th, x:x + tw] for y in range(0, h, th) for x in range(0, w, tw)]
+    else:
+        blocks = [im[y:y + rows_per_strip] for y in range(0, h, rows_per_strip)]
+    data = [b.astype('<' + im.dtype.str[1:]).tostring() for b in blocks]
+    if compress:
+        data = [zlib.compress(d) for d in data]
+    offsets = []
+    body = ''
+    for d in data:
+        offsets.append(8 + len(body))
+        body += d
+    tags = [(256, 4, [w]), (257, 4, [h]), (258, 3, [im.dtype.itemsize * 8]),
+            (259, 3, [8 if compress else 1]), (262, 3, [1])]
+    if tile:
+        tags += [(322, 4, [tw]), (323, 4, [th]), (324, 4, offsets), (325, 4, map(len, data))]
+    else:
+        tags += [(273, 4, offsets), (278, 4, [rows_per_strip]), (279, 4, map(len, data))]
+    if max_sample:
+        tags += [(281, 3, [max_sample])]
+    ifd_offset = 8 + len(body)
+    extra_offset = ifd_offset + 2 + 12 * len(tags) + 4
+    entries = ''
+    extra = ''
+    for code, type, values in sorted(tags):
+        fmt = '<%d%s'%(len(values), 'I' if type == 4 else 'H')
+        packed = struct.pack(fmt, *values)
+        if len(packed) <= 4:
+            value = packed.ljust(4, '\0')
+        else:
+            value = struct.pack('<I', extra_offset + len(extra))
+            extra += packed
+        entries += struct.pack('<HHI', code, type, len(values)) + value
+    f = open(os.path.join(directory, filename), 'wb')
+    f.write('II' + struct.pack('<HI', 42, ifd_offset) + body)
+    f.write(struct.pack('<H', len(tags)) + entries + struct.pack('<I', 0) + extra)
+    f.close()
+
+def expected_region(im, (x0, y0, x1, y1), scale):
+    out = np.zeros((y1 - y0, x1 - x0), np.float32)
+    padded = np.zeros((im.shape[0] + 40, im.shape[1] + 40), np.float32)
+    padded[20:-20, 20:-20] = im / scale
+    out[:] = padded[y0 + 20:y1 + 20, x0 + 20:x1 + 20]
+    return out
+
+def test_read_regions():
+    im = (np.arange(45 * 37) * 40 % 65536).reshape(45, 37).astype(np.uint16)
+    write_tiff('strips.tif', im, rows_per_strip=8)
+    write_tiff('tiles.tif', im, tile=(16, 16))
+    bboxes = [(0, 0, 10, 10), (-5, 30, 15, 50), (30, 3, 40, 21)]
+    ir = ImageReader()
+    stats = ChannelStats.FromChannel(ir.ReadFile('strips.tif')[0])
+    for filename in ['strips.tif', 'tiles.tif']:
+        # the scale of 16 bit images isn't known without the image's stats
+        assert ir.read_regions(filename, bboxes) is None
+        regions = ir.read_regions(filename, bboxes, stats)
+        for region, bbox in zip(regions, bboxes):
+            np.testing.assert_allclose(region, expected_region(im, bbox, 65535.), rtol=1e-6)
+    regions = ir.ReadRegions(['strips.tif'], bboxes[:1], [stats])
+    assert len(regions) == 1 and regions[0][0].shape == (10, 10)
+    # or the MaxSampleValue tag
+    write_tiff('maxsample.tif', im, rows_per_strip=8, max_sample=65535)
+    region, = ir.read_regions('maxsample.tif', bboxes[:1])
+    np.testing.assert_allclose(region, expected_region(im, bboxes[0], 65535.), rtol=1e-6)
+
+def test_regions_match_full_read():
+    im = (np.arange(60 * 50) % 4096).reshape(60, 50).astype(np.uint16)
+    bboxes = [(0, 0, 10, 10), (20, 30, 35, 45), (-5, -5, 5, 5)]
+    ir = ImageReader()
+    # a bright corner outside all regions makes the whole image 16 bit
+    for corner in [None, 40000]:
+        if corner:
+            im[-1, -1] = corner
+        write_tiff('full.tif', im, rows_per_strip=7)
+        full = ir.ReadFile('full.tif')[0]
+        stats = ChannelStats.FromChannel(full)
+        regions = ir.read_regions('full.tif', bboxes, stats)
+        for region, bbox in zip(regions, bboxes):
+            np.testing.assert_array_equal(region, expected_region(full, bbox, 1.))
+    # an image of only 0 and 4095 or 65535 scales to the same stats either
+    # way, so the regions can't tell which scale ReadBitmap used
+    write_tiff('full.tif', np.where(im % 2, 4095, 0).astype(np.uint16), rows_per_strip=7)
+    stats = ChannelStats.FromChannel(ir.ReadFile('full.tif')[0])
+    assert ir.read_regions('full.tif', bboxes, stats) is None
+
+def test_compressed_falls_back():
+    im = (np.arange(20 * 20) % 256).reshape(20, 20).astype(np.uint8)
+    write_tiff('deflate.tif', im, rows_per_strip=5, compress=True)
+    ir = ImageReader()
+    assert ir.read_regions('deflate.tif', [(0, 0, 5, 5)]) is None
+    assert ir.ReadRegions(['deflate.tif'], [(0, 0, 5, 5)]) is None
+    region, = ir.read_region('deflate.tif', (15, 15, 25, 25))
+    np.testing.assert_array_equal(region[:5, :5], im[15:, 15:])
+    assert not region[5:, :].any()
+
+def test_remote_regions():
+    from cpa.httpfetcher import http_fetcher
+    from cpa.tests.test_httpfetcher import serve
+    im = (np.arange(300 * 200) % 4096).reshape(300, 200).astype(np.uint16)
+    write_tiff('remote.tif', im, rows_per_strip=10)
+    stats = ChannelStats.FromChannel(ImageReader().ReadFile('remote.tif')[0])
+    server, url = serve(directory)
+    try:
+        p.image_url_prepend = url
+        p.image_http_cache_dir = ''
+        p.image_http_cache_mb = '1024'
+        p.image_http_connections = '4'
+        ir = ImageReader()
+        p.image_http_ranges = 'no'
+        assert ir.read_regions('remote.tif', [(0, 0, 10, 10)]) is None
+        p.image_http_ranges = 'yes'
+        bbox = (50, 100, 70, 130)
+        region, = ir.read_regions('remote.tif', [bbox], stats)
+        np.testing.assert_allclose(region, expected_region(im, bbox, 4095.), rtol=1e-6)
+        # only the header and the strips of the region were fetched
+        assert all([r is not None for path, r in server.requests])
+        region, = ir.read_region('remote.tif', bbox)
+        np.testing.assert_allclose(region, expected_region(im, bbox, 4095.), rtol=1e-6)
+    finally:
+        p.image_url_prepend = directory
+        p.image_http_ranges = 'no'
+        http_fetcher().close()
+        server.shutdown()
+        server.server_close()
+
+def test_choose_decoders():
+    assert choose_decoders('a.tif', 'II*\0\x08\0\0\0') == ['bitmap', 'bioformats']
+    assert choose_decoders('a.png', '\x89PNG\r\n') == ['bitmap', 'bioformats']
+    assert choose_decoders('a.dib', '(\0\0\0\x10\0') == ['dib', 'bioformats']
+    # by signature when the extension doesn't say
+    assert choose_decoders('a.img', 'MM\0*\0\0') == ['bitmap', 'bioformats']
+    assert choose_decoders('a.flex', 'something else') == ['bioformats']
+    assert choose_decoders('a.tif', '') == ['bioformats']
+
+def test_native_decoders():
+    im = (np.arange(30 * 20) * 7 % 4096).reshape(30, 20).astype(np.uint16)
+    write_tiff('native.tif', im, rows_per_strip=10)
+    header = struct.pack('<IIIHH', 40, 20, 30, 1, 16).ljust(52, '\0')
+    f = open(os.path.join(directory, 'native.dib'), 'wb')
+    f.write(header + im.astype('<u2').tostring())
+    f.close()
+    ir = ImageReader()
+    channels = ir.ReadFile('native.tif') + ir.ReadFile('native.dib')
+    assert len(channels) == 2
+    for channel in channels:
+        np.testing.assert_allclose(channel, im / 4095., rtol=1e-6)
+    # plain TIFFs and DIBs don't need bioformats (or its Java VM)
+    assert 'bioformats' not in sys.modules
+
+def test_unreadable():
+    f = open(os.path.join(directory, 'garbage.tif'), 'wb')
+    f.write('not an image')
+    f.close()
+    if get_decoder('bioformats') is None:
+        try:
+            ImageReader().ReadFile('garbage.tif')
+            assert False
+        except Exception, e:
+            assert 'garbage.tif' in str(e)
+
+def test_decoders_per_thread():
+    decoder = get_decoder('bitmap')
+    assert get_decoder('bitmap') is decoder
+    others = []
+    thread = threading.Thread(target=lambda: others.append(get_decoder('bitmap')))
+    thread.start()
+    thread.join()
+    assert others[0] is not None and others[0] is not decoder
@@ -0,0 +1,20 @@
+import numpy as np
+from cpa.imagestats import ChannelStats, NBINS
+
+def test_from_channel():
+    im = np.array([[0., 0.25], [0.5, 1.]], np.float32)
+    stats = ChannelStats.FromChannel(im)
+    assert stats.interval() == (0., 1.)
+    assert stats.min_positive == 0.25
+    assert stats.hist.sum() == 4 and stats.hist[0] == 1 and stats.hist[-1] == 1
+    flat = ChannelStats.FromChannel(np.zeros((3, 3)))
+    assert flat.interval() == (0., 0.) and flat.min_positive == 0.
+    assert flat.hist[0] == 9 and flat.percentile(50) == 0.
+
+def test_percentile():
+    im = np.arange(10000, dtype=np.float32) / 9999
+    stats = ChannelStats.FromChannel(im)
+    assert stats.percentile(0) == 0.
+    assert abs(stats.percentile(100) - 1.) < 1e-6
+    for q in [1, 25, 50, 99]:
+        assert abs(stats.percentile(q) - np.percentile(im, q)) < 1. / NBINS
@@ -0,0 +1,50 @@
+import tempfile
+import numpy as np
+from cpa.properties import Properties
+from cpa.dbconnect import DBConnect
+from cpa import multiclasssql
+
+p = Properties.getInstance()
+db = DBConnect.getInstance()
+
+learners = [('f0', 0.5, np.array([1.0, -1.0]), np.array([-1.0, 1.0]), 0.0)]
+
+def setup():
+    p.db_type = 'sqlite'
+    p.db_sqlite_file = tempfile.mktemp()
+    p.image_id = 'ImageNumber'
+    p.object_id = 'ObjectNumber'
+    p.table_id = None
+    p.plate_id = None
+    p.well_id = None
+    p.image_table = 'per_image'
+    p.object_table = 'per_object'
+    p.class_table = 'per_object_class'
+    db.Disconnect()
+    db.connect(empty_sqlite_db=True)
+    db.execute('CREATE TABLE per_object (ImageNumber INT, ObjectNumber INT, f0 FLOAT)')
+    for im in range(1, 4):
+        for ob in range(1, 5):
+            db.execute('INSERT INTO per_object VALUES (%d, %d, %f)'%(im, ob, (ob - 1) / 2.0))
+
+def teardown():
+    db.Disconnect()
+
+def check_class_table():
+    rows = db.execute('SELECT ImageNumber, ObjectNumber, class, class_number FROM per_object_class '
+                      'ORDER BY ImageNumber, ObjectNumber')
+    assert len(rows) == 12
+    for im, ob, name, number in rows:
+        expected = 1 if ob > 2 else 2
+        assert number == expected
+        assert name == ['pos', 'neg'][expected - 1]
+
+def test_create_perobject_class_table():
+    multiclasssql.create_perobject_class_table(['pos', 'neg'], learners, swap=False)
+    check_class_table()
+
+def test_create_perobject_class_table_swap():
+    multiclasssql.create_perobject_class_table(['pos', 'neg'], learners)
+    multiclasssql.create_perobject_class_table(['pos', 'neg'], learners)
+    check_class_table()
+    assert not db.table_exists('per_object_class_new')
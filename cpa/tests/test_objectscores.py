@@ -0,0 +1,47 @@
+import numpy as np
+from cpa.objectscores import ObjectScores, score_values, learner_columns, same_learners
+
+learners = [('f0', 0.5, np.array([1.0, -1.0]), np.array([-1.0, 1.0]), 0.0),
+            ('f1', 0.0, np.array([0.5, -0.5]), np.array([-0.25, 0.25]), 0.0),
+            ('f0', 2.0, np.array([3.0, -3.0]), np.array([0.0, 0.0]), 0.0)]
+
+def test_score_values_null_selects_b():
+    columns = learner_columns(learners)
+    assert columns == ['f0', 'f1']
+    values = np.array([[1.0, 1.0], [3.0, -1.0], [np.nan, np.nan]])
+    margins = score_values(learners, columns, values, 2)
+    np.testing.assert_allclose(margins, [[1.5, -1.5], [3.75, -3.75], [-1.25, 1.25]])
+
+def test_get_random_objects_by_class_and_image():
+    keys = np.array([(im, ob) for im in range(1, 5) for ob in range(1, 4)])
+    values = np.array([[float(ob - 1), 0.0] for im, ob in keys])
+    scores = ObjectScores(learners, keys, score_values(learners, ['f0', 'f1'], values, 2))
+    assert scores.GetObjectCount(1) == 8
+    assert scores.GetObjectCount(2) == 4
+    assert sorted(scores.GetRandomObjects(10, 2)) == [(im, 1) for im in range(1, 5)]
+    assert len(scores.GetRandomObjects(5, 1)) == 5
+    assert sorted(scores.GetRandomObjects(10, 1, [(2,), (4,), (9,)])) == [(2, 2), (2, 3), (4, 2), (4, 3)]
+    assert same_learners(scores.learners, list(learners))
+    assert not same_learners(scores.learners, learners[:2])
+
+def test_per_image_counts_follow_updates():
+    keys = np.array([(im, ob) for im in range(1, 4) for ob in range(1, 4)])
+    values = np.array([[float(ob - 1), float(im - 2)] for im, ob in keys])
+    scores = ObjectScores(learners[:2], keys, score_values(learners[:2], ['f0', 'f1'], values, 2))
+    # image 9 has no objects
+    assert scores.PerImageCounts([(1,), (3,), (9,)]) == [[1, 2, 1], [3, 2, 1], [9, 0, 0]]
+    # adding a learner updates the margins, and so the counts, of each object
+    added = [('f1', 0.5, np.array([-2.0, 2.0]), np.array([0.0, 0.0]), 0.0)]
+    margins = scores.margins + score_values(added, ['f0', 'f1'], values, 2)
+    updated = ObjectScores(learners[:2] + added, keys, margins)
+    assert updated.PerImageCounts([(1,), (3,)]) == [[1, 2, 1], [3, 0, 3]]
+
+def test_per_image_counts_many_images():
+    nimages = 200000
+    keys = np.column_stack([np.repeat(np.arange(1, nimages + 1), 2), np.tile([1, 2], nimages)])
+    values = np.array([[float(ob - 1), 0.0] for ob in (1, 2)] * nimages)
+    scores = ObjectScores(learners[:1], keys, score_values(learners[:1], ['f0', 'f1'], values, 2))
+    imKeys = [(im,) for im in range(nimages + 10, 0, -1)]
+    counts = scores.PerImageCounts(imKeys)
+    assert counts[:10] == [[im, 0, 0] for im in range(nimages + 10, nimages, -1)]
+    assert counts[10:] == [[im, 1, 1] for im in range(nimages, 0, -1)]
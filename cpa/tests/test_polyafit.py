@@ -0,0 +1,40 @@
+import numpy as np
+from cpa import polyafit
+
+def make_counts(n=2000, K=3, seed=0):
+    rs = np.random.RandomState(seed)
+    p = rs.dirichlet([2.0] + [1.0] * (K - 1), n)
+    return np.array([rs.multinomial(t, pi) for t, pi in zip(rs.poisson(10, n), p)])
+
+def test_count_histogram():
+    counts, weights = polyafit.count_histogram([[1, 2], [0, 0], [1, 2], [3, 0]])
+    np.testing.assert_array_equal(counts, [[1, 2], [3, 0]])
+    np.testing.assert_array_equal(weights, [2, 1])
+
+def test_histogram_fit_matches_row_fit():
+    counts = make_counts()
+    alpha, converged = polyafit.fit_betabinom_minka_alternating(counts)
+    rows = counts[counts.sum(axis=1) > 0].astype(float)
+    row_alpha, row_converged = polyafit._fit_alternating(rows, np.ones(len(rows)), 1000, 1e-6)
+    assert converged and row_converged
+    np.testing.assert_allclose(alpha, row_alpha, rtol=1e-8)
+
+def test_histogram_fit_matches_rowwise_fit():
+    counts = make_counts(300)
+    alpha, converged = polyafit.fit_betabinom_minka_alternating(counts)
+    old_alpha, old_converged = polyafit._rowwise_fit_alternating(counts)
+    assert converged and old_converged
+    np.testing.assert_allclose(alpha, old_alpha, rtol=1e-8)
+    rows = counts[counts.sum(axis=1) > 0].astype(float)
+    assert np.isclose(polyafit.logP(alpha, counts), polyafit._rowwise_logP(alpha, rows))
+
+def test_warm_start_and_diagnostics():
+    counts = make_counts()
+    alpha, converged = polyafit.fit_betabinom_minka_alternating(counts)
+    diagnostics = []
+    warm_alpha, converged = polyafit.fit_betabinom_minka_alternating(counts, initial_guess=alpha,
+                                                                     diagnostics=diagnostics)
+    assert converged
+    assert len(diagnostics) == 1
+    np.testing.assert_allclose(warm_alpha, alpha, rtol=1e-5)
+    assert np.isclose(diagnostics[-1][2], polyafit.logP(warm_alpha, counts))
@@ -0,0 +1,48 @@
+import numpy as np
+from cpa.spatialindex import PointIndex, ObjectIndex
+
+def test_in_rect():
+    rs = np.random.RandomState(0)
+    points = rs.rand(1000, 2) * [500, 300]
+    index = PointIndex(points)
+    for x0, y0, x1, y1 in [(0, 0, 500, 300), (10, 20, 60, 25), (-50, -50, 5, 400),
+                           (200, 100, 200.5, 100.5), (600, 0, 700, 10)]:
+        inside = np.flatnonzero((points[:, 0] >= x0) & (points[:, 0] <= x1) &
+                                (points[:, 1] >= y0) & (points[:, 1] <= y1))
+        np.testing.assert_array_equal(index.in_rect(x0, y0, x1, y1), inside)
+
+def test_empty():
+    index = PointIndex([])
+    assert len(index) == 0
+    assert len(index.in_rect(0, 0, 10, 10)) == 0
+    assert list(PointIndex([(3, 4)]).in_rect(0, 0, 10, 10)) == [0]
+
+def test_nearest():
+    rs = np.random.RandomState(1)
+    points = rs.rand(500, 2) * [800, 600]
+    index = PointIndex(points)
+    for x, y in rs.rand(50, 2) * [1000, 800] - 100:
+        d = ((points - (x, y)) ** 2).sum(1)
+        assert index.nearest(x, y) == np.argmin(d)
+        if d.min() > 25:
+            assert index.nearest(x, y, max_distance=5) is None
+        else:
+            assert index.nearest(x, y, max_distance=5) == np.argmin(d)
+    assert PointIndex([]).nearest(0, 0) is None
+
+def test_radius_and_polygon():
+    points = [(x, y) for x in range(10) for y in range(10)]
+    index = PointIndex(points)
+    assert sorted(index.in_radius(5, 5, 1).tolist()) == [45, 54, 55, 56, 65]
+    # a triangle with the right angle at (0, 0)
+    inside = index.in_polygon([(-0.5, -0.5), (4.5, -0.5), (-0.5, 4.5)])
+    assert sorted([points[i] for i in inside]) == \
+           sorted([(x, y) for x in range(5) for y in range(5) if x + y <= 3])
+    assert len(index.in_polygon([(0, 0), (1, 1)])) == 0
+
+def test_object_index():
+    index = ObjectIndex([(1, 1), (1, 2), (1, 3)], [(10, 10), (20, 10), (50, 50)])
+    assert index.nearest(18, 12) == (1, 2)
+    assert index.position((1, 3)) == (50, 50)
+    assert index.in_radius(15, 10, 6) == [(1, 1), (1, 2)]
+    assert index.in_polygon([(0, 0), (30, 0), (30, 30), (0, 30)]) == [(1, 1), (1, 2)]
@@ -0,0 +1,75 @@
+import shutil
+import tempfile
+import numpy as np
+from cpa.imagestats import ChannelStats
+from cpa.tilestore import TileStore, tile_signature
+
+directory = None
+
+def setup():
+    global directory
+    directory = tempfile.mkdtemp()
+
+def teardown():
+    shutil.rmtree(directory)
+
+def tiles(value):
+    return [np.zeros((4, 4), np.float32) + value, np.zeros((4, 4), np.float32) - value]
+
+def test_put_and_get():
+    store = TileStore(directory, 4, 2, tile_signature(['a']))
+    store.put_many('plate 1', [((1, 1), tiles(0.25), [(0, 1), (-1, 0)]),
+                               ((1, 2), tiles(0.5), [(0, 1), (-1, 0)])])
+    store.put('plate 2', (2, 1), tiles(1), [(0, 2), (-2, 0)])
+    assert store.get('plate 1', (2, 1)) is None
+    assert store.contains('plate 2', (2, 1))
+    stored, intervals = store.get('plate 1', (1, 2))
+    assert stored[0].dtype == np.float32
+    np.testing.assert_array_equal(stored[1], tiles(0.5)[1])
+    assert intervals == [(0, 1), (-1, 0)]
+
+    # reopening reads the tiles from the files
+    store = TileStore(directory, 4, 2, tile_signature(['a']))
+    np.testing.assert_array_equal(store.get('plate 2', (2, 1))[0][0], tiles(1)[0])
+    assert store.contains('plate 1', (1, 1))
+
+def test_invalidation():
+    TileStore(directory, 4, 2, tile_signature(['b'])).put('plate', (1, 1), tiles(1), [(0, 1)] * 2)
+    assert TileStore(directory, 4, 2, tile_signature(['b'])).contains('plate', (1, 1))
+    assert not TileStore(directory, 4, 2, tile_signature(['c'])).contains('plate', (1, 1))
+    store = TileStore(directory, 6, 2, tile_signature(['c']))
+    assert not store.contains('plate', (1, 1))
+    store.put('plate', (1, 1), [np.ones((6, 6))] * 2, [(0, 1)] * 2)
+    assert store.get('plate', (1, 1))[0][0].shape == (6, 6)
+
+def test_stats():
+    stats = [ChannelStats.FromChannel(np.arange(16.).reshape(4, 4) / 16),
+             ChannelStats.FromChannel(np.zeros((4, 4)))]
+    store = TileStore(directory, 4, 2, tile_signature(['d']))
+    assert store.get_stats((1,)) is None
+    store.put_stats((1,), stats)
+    store.put('plate', (1, 1), tiles(1), [(0, 1)] * 2)
+    assert TileStore(directory, 4, 2, tile_signature(['d'])).get_stats((1,)) == stats
+    assert TileStore(directory, 4, 2, tile_signature(['e'])).get_stats((1,)) is None
+
+def test_shared_store():
+    # two stores on the same directory, as in two processes
+    store1 = TileStore(directory, 4, 2, tile_signature(['f']))
+    store2 = TileStore(directory, 4, 2, tile_signature(['f']))
+    assert not store2.contains('plate', (1, 1))
+    store1.put('plate', (1, 1), tiles(1), [(0, 1)] * 2)
+    assert not store2.contains('plate', (1, 1))
+    store2.put_many('plate', [((1, 1), tiles(2), [(0, 2)] * 2),
+                              ((1, 2), tiles(3), [(0, 3)] * 2)])
+    # store2 saw store1's tile instead of storing its own again
+    np.testing.assert_array_equal(store2.get('plate', (1, 1))[0][0], tiles(1)[0])
+    # a partly written record is dropped by the next write
+    f = open(store1.files['plate'].filename, 'ab')
+    f.write('\0' * 10)
+    f.close()
+    store1.put('plate', (1, 3), tiles(4), [(0, 4)] * 2)
+    store = TileStore(directory, 4, 2, tile_signature(['f']))
+    assert store.files.get('plate') is None and store.contains('plate', (1, 3))
+    for key, value in [((1, 1), 1), ((1, 2), 3), ((1, 3), 4)]:
+        np.testing.assert_array_equal(store.get('plate', key)[0][0], tiles(value)[0])
+    assert store.files['plate'].nrecords == 3
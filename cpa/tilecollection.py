@@ -2,7 +2,7 @@ from __future__ import with_statement
 from dbconnect import DBConnect
 from properties import Properties
 from singleton import Singleton
-from heapq import heappush, heappop
+from heapq import heappush, heappop, heapify
 from weakref import WeakValueDictionary
 import imagetools
 import logging
@@ -13,12 +13,91 @@ import wx
 db = DBConnect.getInstance()
 p = Properties.getInstance()
 
+# number of TileLoader threads
+try:
+    from multiprocessing import cpu_count
+    LOADER_THREADS = max(2, min(8, cpu_count()))
+except (ImportError, NotImplementedError):
+    LOADER_THREADS = 2
+
 def load_lock():
     return TileCollection.getInstance().load_lock
 
 class List(list):
     pass
 
+class LoadLock(object):
+    '''
+    A lock that any number of tile loading threads can hold at once with
+    shared(), but that only one thread can hold exclusively, eg: to pause
+    tile loading while training.  Used as a context manager it is taken
+    exclusively.
+    '''
+    def __init__(self):
+        self.cv = threading.Condition(threading.Lock())
+        self.sharers = 0
+        self.owner = None
+        self.depth = 0
+        self.waiting = 0
+
+    def acquire(self):
+        me = threading.currentThread()
+        with self.cv:
+            if self.owner is me:
+                self.depth += 1
+                return
+            self.waiting += 1
+            while self.owner is not None or self.sharers:
+                self.cv.wait()
+            self.waiting -= 1
+            self.owner = me
+            self.depth = 1
+
+    def release(self):
+        with self.cv:
+            self.depth -= 1
+            if self.depth == 0:
+                self.owner = None
+                self.cv.notifyAll()
+
+    def __enter__(self):
+        self.acquire()
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    def shared(self):
+        return _SharedLoadLock(self)
+
+
+class _SharedLoadLock(object):
+    def __init__(self, lock):
+        self.lock = lock
+        self.exclusive = False
+
+    def __enter__(self):
+        lock = self.lock
+        with lock.cv:
+            if lock.owner is threading.currentThread():
+                # already held exclusively by this thread
+                lock.depth += 1
+                self.exclusive = True
+                return
+            # exclusive holders go first, so training isn't starved
+            while lock.owner is not None or lock.waiting:
+                lock.cv.wait()
+            lock.sharers += 1
+
+    def __exit__(self, *exc_info):
+        if self.exclusive:
+            self.exclusive = False
+            self.lock.release()
+            return
+        with self.lock.cv:
+            self.lock.sharers -= 1
+            if not self.lock.sharers:
+                self.lock.cv.notifyAll()
+
 class TileCollection(Singleton):
     '''
     Main access point for loading tiles through the TileLoader.
@@ -27,13 +106,14 @@ class TileCollection(Singleton):
         self.tileData  = WeakValueDictionary()
         self.loadq     = []
         self.cv        = threading.Condition()
-        self.load_lock = threading.Lock()
+        self.load_lock = LoadLock()
         self.group_priority = 0
         # Gray placeholder for unloaded images
         self.imagePlaceholder = List([numpy.zeros((int(p.image_tile_size),
                                                    int(p.image_tile_size)))+0.1
                                       for i in range(sum(map(int,p.channels_per_image)))])
-        self.loader = TileLoader(self, None)
+        self.notify_window = None
+        self.loaders = [TileLoader(self, None) for i in range(LOADER_THREADS)]
 
     def GetTileData(self, obKey, notify_window, priority=1):
         return self.GetTiles([obKey], notify_window, priority)[0]
@@ -48,7 +128,7 @@ class TileCollection(Singleton):
         Returns: a list of lists of tile data (in numpy arrays) in the order
             of the obKeys that were passed in.
         '''
-        self.loader.notify_window = notify_window
+        self.notify_window = notify_window
         self.group_priority -= 1
         tiles = []
         temp = {} # for weakrefs
@@ -60,9 +140,36 @@ class TileCollection(Singleton):
                     temp[order] = List(self.imagePlaceholder)
                     self.tileData[obKey] = temp[order]
             tiles = [self.tileData[obKey] for obKey in obKeys]
-            self.cv.notify()
+            self.cv.notifyAll()
         return tiles    
 
+    def PopImageRequests(self):
+        '''
+        Removes the first request from the load queue along with every other
+        queued request for an object in the same image, dropping requests
+        for tiles that are no longer displayed.  Must be called with cv
+        held.  Returns the list of obKeys to load in priority order.
+        '''
+        obKey = heappop(self.loadq)[1]
+        imKey = obKey[:-1]
+        same_image = [entry for entry in self.loadq if entry[1][:-1] == imKey]
+        if same_image:
+            self.loadq = [entry for entry in self.loadq if entry[1][:-1] != imKey]
+            heapify(self.loadq)
+        obKeys = [obKey] + [entry[1] for entry in sorted(same_image)]
+        return [k for k in obKeys if self.tileData.get(k, None)]
+
+    def AddTiles(self, tiles):
+        '''
+        tiles: a list of (obKey, tile data) pairs for tiles that were loaded
+            outside the TileLoader.  The caller must hold a reference to the
+            tile data until the tiles are displayed.
+        '''
+        with self.cv:
+            for obKey, data in tiles:
+                if not self.tileData.get(obKey, None):
+                    self.tileData[obKey] = data
+
     
 # Event generated by the TileLoader thread.
 EVT_TILE_UPDATED_ID = wx.NewId()
@@ -77,83 +184,78 @@ def EVT_TILE_UPDATED(win, func):
    
 class TileUpdatedEvent(wx.PyEvent):
     '''
-    This event type is posted whenever an ImageTile has been updated by the
-    TileLoader thread.
+    This event type is posted whenever ImageTiles have been updated by a
+    TileLoader thread.  data is the list of obKeys of the updated tiles.
     '''
     def __init__(self, data):
         wx.PyEvent.__init__(self)
         self.SetEventType(EVT_TILE_UPDATED_ID)
-        self.data = data    
+        self.data = data
 
 
 class TileLoader(threading.Thread):
     '''
-    This thread is owned by the TileCollection singleton and is kept
-    running for the duration of the app execution.  Whenever
-    TileCollection has obKeys in its load queue (loadq), this thread
-    will remove them from the queue and fetch the tile data for
-    them. The tile data is then written back into TileCollection's
-    tileData dict over the existing placeholder. Finally an event is
-    posted to the svn to tell it to refresh the tiles.
+    A pool of these threads is owned by the TileCollection singleton and
+    kept running for the duration of the app execution.  Whenever
+    TileCollection has obKeys in its load queue (loadq), a thread will
+    remove the first one from the queue along with all others in the same
+    image, read the image once and crop all of their tiles. The tile data
+    is then written back into TileCollection's tileData dict over the
+    existing placeholders. Finally one event is posted to the notify
+    window to tell it to refresh the tiles.
     '''
     def __init__(self, tc, notify_window):
         threading.Thread.__init__(self)
         self.setName('TileLoader_%s'%(self.getName()))
-        self.notify_window = notify_window
+        self.setDaemon(True)
         self.tile_collection = tc
         self._want_abort = False
         self.start()
-    
+
     def run(self):
-        try:
-            from bioformats import jutil
-            jutil.start_vm([])
-            jutil.attach()
-        except:
-            import traceback
-            logging.error('Error occurred while starting VM.')
-            traceback.print_exc()
-        while 1:            
-            self.tile_collection.cv.acquire()
-            # If there are no objects in the queue then wait
-            while not self.tile_collection.loadq:
-                self.tile_collection.cv.wait()
-                
-            if self._want_abort:
-                self.tile_collection.cv.release()
-                logging.info('%s aborted'%self.getName())
-                return
+        tc = self.tile_collection
+        while 1:
+            with tc.cv:
+                # If there are no objects in the queue then wait
+                while not tc.loadq and not self._want_abort:
+                    tc.cv.wait()
 
-            obKey = heappop(self.tile_collection.loadq)[1]
-            self.tile_collection.cv.release()
+                if self._want_abort:
+                    logging.info('%s aborted'%self.getName())
+                    return
 
-            # wait until loading has completed before continuing
-            with self.tile_collection.load_lock:
-                # Make sure tile hasn't been deleted outside this thread
-                if not self.tile_collection.tileData.get(obKey, None):
-                    continue
+                obKeys = tc.PopImageRequests()
+                # the coordinates of the queued tiles are fetched together
+                queued = [entry[1] for entry in tc.loadq]
+                notify_window = tc.notify_window
+            if not obKeys:
+                continue
 
-                # Get the tile
-                new_data = imagetools.FetchTile(obKey)
-                if new_data is None:
-                    #if fetching fails, leave the tile blank
+            # wait until training has completed before continuing
+            with tc.load_lock.shared():
+                try:
+                    new_data = dict(zip(obKeys, imagetools.FetchTiles(obKeys, prefetch=queued)))
+                except Exception, e:
+                    #if fetching fails, leave the tiles blank
+                    logging.error('Error loading tiles from image %s: %s'%(obKeys[0][:-1], e))
                     continue
-                
-                tile_data = self.tile_collection.tileData.get(obKey, None)
-                
+
+            updated = []
+            for obKey in obKeys:
+                tile_data = tc.tileData.get(obKey, None)
                 # Make sure tile hasn't been deleted outside this thread
-                if tile_data is not None:
+                if tile_data is not None and new_data[obKey] is not None:
                     # copy each channel
                     for i in range(len(tile_data)):
-                        tile_data[i] = new_data[i]
-                    wx.PostEvent(self.notify_window, TileUpdatedEvent(obKey))
+                        tile_data[i] = new_data[obKey][i]
+                    updated.append(obKey)
+            if updated and notify_window is not None:
+                wx.PostEvent(notify_window, TileUpdatedEvent(updated))
 
     def abort(self):
-        self._want_abort = True
-        self.tile_collection.cv.acquire()
-        heappush(self.tile_collection.loadq, ((0, 0, 0), '<ABORT>'))
-        self.tile_collection.cv.notify()
-        self.tile_collection.cv.release()        
+        with self.tile_collection.cv:
+            self._want_abort = True
+            self.tile_collection.cv.notifyAll()
 
 
 
@@ -0,0 +1,295 @@
+'''
+A persistent store of object tiles, so tiles that have been cropped once
+are never cropped from the full images again, along with the intensity
+statistics of the images (see imagestats).
+
+Tiles are kept in one file per plate in a directory, and the statistics in
+one more file.  Each file starts with a header recording the tile size,
+the number of channels and a signature of the settings the tiles were
+cropped with (see tile_signature); a file whose header doesn't match is
+discarded and started over.  The header is followed by fixed size
+records, one per object, of
+    int64   object key
+    float32 (min, max) intensity of each channel of the object's image, or
+            NaN if it wasn't known
+    float16 tile of each channel
+or one per image, of
+    int64   image key
+    float32 (min, max, min_positive) of each channel
+    uint32  histogram of each channel
+Records are appended as they are stored and are read through a
+memory-map, so fetching a stored tile doesn't touch the image files.
+Several processes, eg: Classifier and buildtiles.py, may share a store:
+records are appended at the end of the file while holding an OS lock on
+it, and stored records are never overwritten.
+'''
+import cPickle
+import hashlib
+import logging
+import os
+import re
+import threading
+import numpy as np
+from imagestats import ChannelStats, NBINS
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+STORE_MAGIC = 'CPA tile store 1\n'
+STATS_FILE = 'images.stats'
+
+def tile_signature(values):
+    '''
+    Returns a signature of the given settings, eg: the image paths and
+    rescaling properties, to invalidate stored tiles when they change.
+    '''
+    return hashlib.sha1(repr(values)).hexdigest()
+
+
+def lock_file(f):
+    ''' Waits for an exclusive lock on an open file, between processes. '''
+    if fcntl is not None:
+        fcntl.lockf(f.fileno(), fcntl.LOCK_EX)
+    else:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+
+def unlock_file(f):
+    if fcntl is not None:
+        fcntl.lockf(f.fileno(), fcntl.LOCK_UN)
+    else:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+class RecordFile(object):
+    ''' A file of fixed size records with a key field, see above. '''
+    def __init__(self, filename, header, dtype):
+        self.filename = filename
+        self.header = header
+        self.dtype = dtype
+        self.index = {}
+        self.records = None
+        self.offset = None
+        self.nrecords = 0
+        if not self._open():
+            self._create()
+
+    def _open(self):
+        try:
+            f = open(self.filename, 'rb')
+        except IOError:
+            return False
+        try:
+            if f.read(len(STORE_MAGIC)) != STORE_MAGIC:
+                logging.warn('Replacing unrecognized tile store %s'%(self.filename))
+                return False
+            header_length = int(f.readline())
+            header = cPickle.loads(f.read(header_length))
+            self.offset = f.tell()
+        except Exception, e:
+            logging.warn('Replacing unreadable tile store %s: %s'%(self.filename, e))
+            return False
+        finally:
+            f.close()
+        if header != self.header:
+            logging.info('Tile store %s is out of date.'%(self.filename))
+            return False
+        self._map()
+        return True
+
+    def _create(self):
+        header = cPickle.dumps(self.header, 2)
+        f = open(self.filename, 'wb')
+        try:
+            f.write(STORE_MAGIC)
+            f.write('%d\n'%(len(header)))
+            f.write(header)
+            self.offset = f.tell()
+        finally:
+            f.close()
+        self.index = {}
+        self.records = None
+        self.nrecords = 0
+
+    def _map(self):
+        ''' Maps the records in the file, indexing any that are new. '''
+        # ignore a partly written last record
+        nrecords = (os.path.getsize(self.filename) - self.offset) // self.dtype.itemsize
+        if nrecords == self.nrecords:
+            return
+        self.records = np.memmap(self.filename, dtype=self.dtype, mode='r',
+                                 offset=self.offset, shape=(nrecords,))
+        for i, key in enumerate(self.records['key'][self.nrecords:].tolist()):
+            self.index[tuple(key)] = self.nrecords + i
+        self.nrecords = nrecords
+
+    def get_record(self, key):
+        i = self.index.get(key, None)
+        if i is None:
+            return None
+        return self.records[i]
+
+    def put_records(self, records):
+        '''
+        Appends a record array, skipping records whose keys are stored,
+        including by other processes.
+        '''
+        f = open(self.filename, 'r+b')
+        try:
+            lock_file(f)
+            try:
+                # index the records other processes appended
+                self._map()
+                new = np.array([tuple(key) not in self.index for key in records['key'].tolist()], bool)
+                records = records[new]
+                if len(records):
+                    f.seek(0, 2)
+                    end = f.tell()
+                    # drop a record left partly written by a process that
+                    # died, which no one has mapped
+                    partial = (end - self.offset) % self.dtype.itemsize
+                    if partial:
+                        f.truncate(end - partial)
+                    f.seek(end - partial)
+                    records.tofile(f)
+                    f.flush()
+            finally:
+                unlock_file(f)
+        finally:
+            f.close()
+        self._map()
+
+
+class TileFile(RecordFile):
+    ''' The stored tiles of one plate. '''
+    def __init__(self, filename, tile_size, nchannels, nkeycols, signature):
+        RecordFile.__init__(self, filename,
+                            {'tile_size': tile_size, 'nchannels': nchannels,
+                             'nkeycols': nkeycols, 'signature': signature},
+                            np.dtype([('key', '<i8', (nkeycols,)),
+                                      ('interval', '<f4', (nchannels, 2)),
+                                      ('tile', '<f2', (nchannels, tile_size, tile_size))]))
+
+    def get(self, obKey):
+        record = self.get_record(obKey)
+        if record is None:
+            return None
+        return ([np.array(t, np.float32) for t in record['tile']],
+                [None if np.isnan(lo) else (lo, hi) for lo, hi in record['interval'].tolist()])
+
+    def put_many(self, items):
+        ''' items: list of (obKey, tiles, intervals) '''
+        records = np.zeros(len(items), self.dtype)
+        for record, (obKey, tiles, intervals) in zip(records, items):
+            record['key'] = obKey
+            record['interval'] = [(np.nan, np.nan) if interval is None else interval
+                                  for interval in intervals]
+            record['tile'] = tiles
+        self.put_records(records)
+
+
+class StatsFile(RecordFile):
+    ''' The ChannelStats of the channels of each stored image. '''
+    def __init__(self, filename, nchannels, nkeycols, signature):
+        RecordFile.__init__(self, filename,
+                            {'nbins': NBINS, 'nchannels': nchannels,
+                             'nkeycols': nkeycols, 'signature': signature},
+                            np.dtype([('key', '<i8', (nkeycols,)),
+                                      ('range', '<f4', (nchannels, 3)),
+                                      ('hist', '<u4', (nchannels, NBINS))]))
+
+    def get(self, imKey):
+        record = self.get_record(imKey)
+        if record is None:
+            return None
+        return [ChannelStats(lo, hi, min_positive, hist) for (lo, hi, min_positive), hist
+                in zip(record['range'].tolist(), record['hist'])]
+
+    def put(self, imKey, stats):
+        records = np.zeros(1, self.dtype)
+        records['key'] = imKey
+        records['range'] = [(s.min, s.max, s.min_positive) for s in stats]
+        records['hist'] = [s.hist for s in stats]
+        self.put_records(records)
+
+
+class TileStore(object):
+    '''
+    directory: where to keep the tile files
+    tile_size: width and height of the tiles
+    nchannels: number of channels of each tile
+    signature: see tile_signature
+    '''
+    def __init__(self, directory, tile_size, nchannels, signature):
+        self.directory = directory
+        self.tile_size = tile_size
+        self.nchannels = nchannels
+        self.signature = signature
+        self.lock = threading.Lock()
+        self.files = {}
+        self.stats_file = None
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _file(self, plate, nkeycols):
+        tf = self.files.get(plate, None)
+        if tf is None:
+            name = re.sub(r'[^\w.-]', '_', str(plate)) + '.tiles'
+            tf = TileFile(os.path.join(self.directory, name), self.tile_size,
+                          self.nchannels, nkeycols, self.signature)
+            self.files[plate] = tf
+        return tf
+
+    def _stats_file(self, nkeycols):
+        if self.stats_file is None:
+            self.stats_file = StatsFile(os.path.join(self.directory, STATS_FILE),
+                                        self.nchannels, nkeycols, self.signature)
+        return self.stats_file
+
+    def get(self, plate, obKey):
+        '''
+        Returns (tiles, intervals) for a stored object, where tiles is the
+        list of float32 channel tiles and intervals the (min, max) of each
+        channel of its image (None if unknown), or None if the object's tile
+        isn't stored.
+        '''
+        obKey = tuple(obKey)
+        with self.lock:
+            return self._file(plate, len(obKey)).get(obKey)
+
+    def contains(self, plate, obKey):
+        obKey = tuple(obKey)
+        with self.lock:
+            return obKey in self._file(plate, len(obKey)).index
+
+    def put(self, plate, obKey, tiles, intervals):
+        self.put_many(plate, [(obKey, tiles, intervals)])
+
+    def put_many(self, plate, items):
+        ''' Stores a list of (obKey, tiles, intervals) of objects in a plate. '''
+        if not items:
+            return
+        items = [(tuple(obKey), tiles, intervals) for obKey, tiles, intervals in items]
+        with self.lock:
+            try:
+                self._file(plate, len(items[0][0])).put_many(items)
+            except (IOError, OSError), e:
+                logging.error('Could not store tiles in %s: %s'%(self.directory, e))
+
+    def get_stats(self, imKey):
+        ''' Returns the list of ChannelStats of a stored image, or None. '''
+        imKey = tuple(imKey)
+        with self.lock:
+            return self._stats_file(len(imKey)).get(imKey)
+
+    def put_stats(self, imKey, stats):
+        ''' Stores the list of ChannelStats of the channels of an image. '''
+        imKey = tuple(imKey)
+        with self.lock:
+            try:
+                self._stats_file(len(imKey)).put(imKey, stats)
+            except (IOError, OSError), e:
+                logging.error('Could not store image statistics in %s: %s'%(self.directory, e))
@@ -6,12 +6,17 @@ import base64
 import zlib
 import wx
 import collections
+import os
 
 from dbconnect import *
 from singleton import Singleton
 
 db = DBConnect.getInstance()
 
+def cache_filename(filename):
+    '''Returns the name of the cell cache saved alongside a training set.'''
+    return filename + '.cache'
+
 class TrainingSet:
     "A class representing a set of manually labeled cells."
 
@@ -49,27 +54,24 @@ class TrainingSet:
         self.labels = numpy.array(labels)
         self.classifier_labels = 2 * numpy.eye(len(labels), dtype=numpy.int) - 1
         
-        num_to_fetch = sum([len(k) for k in keyLists])
-        num_fetched = [0] # use a list to get static scoping
-
-        # Populate the label_matrix, entries, and values
+        # Populate the label_matrix and entries
         for label, cl_label, keyList in zip(labels, self.classifier_labels, keyLists):
             self.label_matrix += ([cl_label] * len(keyList))
             self.entries += zip([label] * len(keyList), keyList)
+        self.label_matrix = numpy.array(self.label_matrix)
 
-            if labels_only:
-                self.values += []
-            else:
-                def get_data(k):
-                    d = self.cache.get_object_data(k)
-                    if callback is not None:
-                        callback(num_fetched[0] / float(num_to_fetch))
-                    num_fetched[0] = num_fetched[0] + 1
-                    return d
-                self.values += [get_data(k) for k in keyList]
+        if labels_only:
+            self.values = numpy.array(self.values, numpy.float64)
+            return
 
-        self.label_matrix = numpy.array(self.label_matrix)
-        self.values = numpy.array(self.values, np.float64)
+        # Fetch the objects that aren't cached in bulk, then fill in values
+        keys = self.get_object_keys()
+        self.cache.fetch_objects_data(keys, callback)
+        # float64 like the database columns that classifier thresholds are
+        # compared against
+        self.values = numpy.zeros((len(keys), len(self.cache.colnames)), numpy.float64)
+        for row, key in enumerate(keys):
+            self.values[row] = self.cache.get_object_data(key)
 
 
     def Load(self, filename, labels_only=False):
@@ -78,6 +80,7 @@ class TrainingSet:
         lines = f.read()
 #        lines = lines.replace('\r', '\n')    # replace CRs with LFs
         lines = lines.split('\n')
+        self.cache.load_from_file(cache_filename(filename))
         labelDict = collections.OrderedDict()
         for l in lines:
             try:
@@ -113,12 +116,15 @@ class TrainingSet:
         
         have_asked = False
         progress = None
+        # look up the current positions of all objects at once
+        coords = db.GetObjectsCoords([key[:obkey_length] for keys in label_dict.values() 
+                                      for key in keys if len(key) > obkey_length], silent=True)
         for label in label_dict.keys():
             for idx, key in enumerate(label_dict[label]):
                 if len(key) > obkey_length:
                     obkey = key[:obkey_length]
                     x, y = key[obkey_length:obkey_length+2]
-                    coord = db.GetObjectCoords(obkey, none_ok=True, silent=True) 
+                    coord = coords.get(obkey, None)
                     if coord == None or (int(coord[0]), int(coord[1])) != (x, y):
                         if not have_asked:
                             dlg = wx.MessageDialog(None, 'Cells in the training set and database have different image positions.  This could be caused by running CellProfiler with different image analysis parameters.  Should CPA attempt to remap cells in the training set to their nearest match in the database?',
@@ -166,10 +172,11 @@ class TrainingSet:
             p = Properties.getInstance()
             f.write('# Training set created while using properties: %s\n'%(p._filename))
             f.write('label '+' '.join(self.labels)+'\n')
+            coords = db.GetObjectsCoords(self.get_object_keys())
             for label, obKey in self.entries:
-                line = '%s %s %s\n'%(label, ' '.join([str(int(k)) for k in obKey]), ' '.join([str(int(k)) for k in db.GetObjectCoords(obKey)]))
+                line = '%s %s %s\n'%(label, ' '.join([str(int(k)) for k in obKey]), ' '.join([str(int(k)) for k in coords[obKey]]))
                 f.write(line)
-            f.write('# ' + self.cache.save_to_string([k[1] for k in self.entries]) + '\n')
+            self.cache.save_to_file(cache_filename(filename), [k[1] for k in self.entries])
         except:
             logging.error("Error saving training set %s" % (filename))
             f.close()
@@ -182,19 +189,25 @@ class TrainingSet:
     def get_object_keys(self):
         return [e[1] for e in self.entries]
 
+CACHE_MAGIC = 'CPA cell cache 2\n'
+
 class CellCache(Singleton):
-    ''' caching front end for holding cell data '''
+    '''
+    caching front end for holding cell data
+    Only the classifier columns of each object are kept, as float64 like
+    the database columns that classifier thresholds are compared against.
+    Rows are saved to a sidecar file next to the training set (see
+    save_to_file), which is memory-mapped when loaded so rows are only read
+    as they are used.
+    '''
     def __init__(self):
         self.data        = {}
-        self.colnames    = db.GetColumnNames(p.object_table)
-        if db.GetColnamesForClassifier() is not None:
-            self.col_indices = [self.colnames.index(v) for v in db.GetColnamesForClassifier()]
-        else:
-            self.col_indices = []
+        self.colnames    = list(db.GetColnamesForClassifier() or [])
         self.last_update = db.get_objects_modify_date()
 
     def load_from_string(self, str):
         'load data from a string, verifying that the table has not changed since it was created (encoded in string)'
+        # Training sets saved by older versions embed the cache as a comment
         try:
             date, colnames, oldcache = cPickle.loads(zlib.decompress(base64.b64decode(str)))
         except:
@@ -206,27 +219,115 @@ class CellCache(Singleton):
             if oldcache.values()[0].dtype.kind == 'S':
                 return
         # verify the database hasn't been changed
-        if db.verify_objects_modify_date_earlier(date):
-            self.data.update(oldcache)
-            self.colnames = colnames
+        if not db.verify_objects_modify_date_earlier(date):
+            return
+        try:
+            col_indices = [colnames.index(c) for c in self.colnames]
+        except ValueError:
+            return
+        for key, row in oldcache.items():
+            self.data[key] = numpy.asarray(row)[col_indices].astype(numpy.float64)
+
+    def load_from_file(self, filename):
+        '''
+        load data saved by save_to_file, verifying that the table has not 
+        changed since it was saved and that the same columns are used.
+        The rows are memory-mapped rather than read.
+        '''
+        try:
+            f = open(filename, 'rb')
+        except IOError:
+            return
+        try:
+            if f.read(len(CACHE_MAGIC)) != CACHE_MAGIC:
+                logging.warn('Ignoring unrecognized cell cache %s'%(filename))
+                return
+            header_length = int(f.readline())
+            date, hash, nkeys, nkeycols = cPickle.loads(f.read(header_length))
+            offset = f.tell()
+        except Exception, e:
+            logging.warn('Ignoring unreadable cell cache %s: %s'%(filename, e))
+            return
+        finally:
+            f.close()
+        if hash != schema_hash(self.colnames) or not db.verify_objects_modify_date_earlier(date):
+            logging.info('Cell cache %s is out of date.'%(filename))
+            return
+        if nkeys == 0:
+            return
+        keys = numpy.memmap(filename, dtype='<i8', mode='r', offset=offset, shape=(nkeys, nkeycols))
+        offset += keys.nbytes
+        values = numpy.memmap(filename, dtype='<f8', mode='r', offset=offset, shape=(nkeys, len(self.colnames)))
+        for idx, key in enumerate(keys.tolist()):
+            self.data[tuple(key)] = values[idx]
 
-    def save_to_string(self, keys):
-        'convert the cache data to a string, but only for certain keys'
-        temp = {}
-        for k in keys:
-            if k in self.data:
-                temp[k] = self.data[k]
-        output = (db.get_objects_modify_date(), self.colnames, temp)
-        return base64.b64encode(zlib.compress(cPickle.dumps(output)))
+    def save_to_file(self, filename, keys):
+        'save the cache data to a file, but only for certain keys'
+        keys = [k for k in keys if k in self.data]
+        nkeycols = len(keys[0]) if keys else len(object_key_columns())
+        key_array = numpy.array(keys, dtype='<i8').reshape((len(keys), nkeycols))
+        value_array = numpy.array([self.data[k] for k in keys], dtype='<f8').reshape((len(keys), len(self.colnames)))
+        header = cPickle.dumps((db.get_objects_modify_date(), schema_hash(self.colnames), len(keys), nkeycols), 2)
+        tmp = filename + '.tmp'
+        f = open(tmp, 'wb')
+        try:
+            f.write(CACHE_MAGIC)
+            f.write('%d\n'%(len(header)))
+            f.write(header)
+            key_array.tofile(f)
+            value_array.tofile(f)
+        finally:
+            f.close()
+        # rows memory-mapped from the old file, saved or not, must let go of
+        # it before it can be replaced
+        path = os.path.abspath(filename)
+        for k, row in self.data.items():
+            if isinstance(row, numpy.memmap) and row.filename == path:
+                self.data[k] = numpy.array(row)
+        if os.path.exists(filename):
+            os.remove(filename)
+        os.rename(tmp, filename)
+
+    def fetch_object_data(self, key):
+        '''fetch the classifier columns for an object from the database'''
+        query = 'SELECT %s FROM %s WHERE %s' %(', '.join(['`%s`'%c for c in self.colnames]), 
+                                               p.object_table, GetWhereClauseForObjects([key]))
+        data = db.execute(query, silent=True)
+        if len(data) == 0:
+            logging.error('No data for obKey: %s'%str(key))
+            return None
+        # fetch out only numeric data
+        return numpy.array([x if type(x) in [int, long, float] else 0.0 for x in data[0]], numpy.float64)
+
+    def fetch_objects_data(self, keys, callback=None):
+        '''
+        fetch the classifier columns for any of the given objects that 
+        aren't cached, with one query per chunk of images.
+        callback(fraction) is called after each chunk.
+        '''
+        missing = [k for k in set(keys) if k not in self.data]
+        chunks = chunk_objects_by_image(missing, IMAGES_PER_QUERY)
+        nkeycols = len(object_key_columns())
+        select = ', '.join([UniqueObjectClause()] + ['`%s`'%c for c in self.colnames])
+        for i, chunk in enumerate(chunks):
+            query = 'SELECT %s FROM %s WHERE %s'%(select, p.object_table, GetWhereClauseForImageObjects(chunk))
+            for row in db.execute(query, silent=(i > 0)):
+                # fetch out only numeric data
+                self.data[tuple([int(k) for k in row[:nkeycols]])] = numpy.array(
+                    [x if type(x) in [int, long, float] else 0.0 for x in row[nkeycols:]], numpy.float64)
+            if callback is not None:
+                callback((i + 1) / float(len(chunks)))
 
     def get_object_data(self, key):
         if key not in self.data:
-            self.data[key] = db.GetCellData(key)
-        return self.data[key][self.col_indices]
+            self.data[key] = self.fetch_object_data(key)
+        return self.data[key]
 
     def clear_if_objects_modified(self):
-        if not db.verify_objects_modify_date_earlier(self.last_update):
+        colnames = list(db.GetColnamesForClassifier() or [])
+        if colnames != self.colnames or not db.verify_objects_modify_date_earlier(self.last_update):
             self.data = {}
+            self.colnames = colnames
             self.last_update = db.get_objects_modify_date()
         
 
@@ -5,6 +5,7 @@ it is not used by the CPA application itself.
 
 import os
 import operator
+import itertools
 import cPickle
 from contextlib import contextmanager
 import numpy as np
@@ -190,6 +191,66 @@ def replace_atomically(filename):
             os.remove(tmp)
             raise
 
+def worker_count(n_workers=None):
+    """
+    Return the number of worker processes to use for N_WORKERS (None
+    means one per CPU).  Frozen (py2app/py2exe) builds cannot re-import
+    their main module in child processes, so they always get 1.
+    """
+    import sys
+    if getattr(sys, 'frozen', False):
+        return 1
+    if n_workers is None:
+        try:
+            from multiprocessing import cpu_count
+            n_workers = cpu_count()
+        except (ImportError, NotImplementedError):
+            n_workers = 1
+    return max(1, int(n_workers))
+
+class _SerialResult(object):
+    def __init__(self, value):
+        self.value = value
+
+    def get(self, timeout=None):
+        return self.value
+
+class _SerialPool(object):
+    """Stand-in for multiprocessing.Pool that runs tasks in-process."""
+    imap = staticmethod(itertools.imap)
+
+    @staticmethod
+    def apply_async(function, args=()):
+        return _SerialResult(function(*args))
+
+@contextmanager
+def process_pool(n_workers=None):
+    """
+    Yield an object with an imap method that runs tasks on N_WORKERS
+    processes (see worker_count).  With a single worker, tasks run in
+    the calling process.  Task functions must be picklable, i.e.,
+    defined at module level.
+
+    >>> with process_pool() as pool:
+    ...     results = list(pool.imap(function, tasks))
+    """
+    n_workers = worker_count(n_workers)
+    pool = None
+    if n_workers > 1:
+        try:
+            from multiprocessing import Pool
+            pool = Pool(n_workers)
+        except (ImportError, OSError):
+            pool = None
+    if pool is None:
+        yield _SerialPool()
+        return
+    try:
+        yield pool
+    finally:
+        pool.terminate()
+        pool.join()
+
 def auc(positives, negatives):
     queue = sorted([(v, True) for v in positives] + 
                    [(v, False) for v in negatives])